@@ -0,0 +1,523 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+from dateutil.tz import tzlocal
+from concurrent.futures import ThreadPoolExecutor
+from bluesky.plan_stubs import abs_set, wait
+from bluesky.preprocessors import finalize_wrapper
+from bluesky.utils import short_uid, make_decorator
+
+
+###SNAPSHOTS
+###   The following set of code is used to read every axis and signal of a set of devices at once and to
+###   record the readings in an append-only HDF5 log, so that the status of the beamline can be compared
+###   between any two times. The status reports (eg. Beamline.status() and BeamSource.status()) are
+###   rendered from a snapshot.
+
+
+def ESM_read_value(obj):
+    '''
+    Returns the current value of an axis (its position) or a signal (its value) as a float.
+
+    PARAMETERS
+    ----------
+
+    obj : object
+        The ophyd positioner or signal to read.
+
+    value : float, output
+        The value, NaN if it can not be read or is not a number.
+
+    '''
+    try:
+        if hasattr(obj, 'position'):
+            value=obj.position
+        else:
+            value=obj.get()
+        return float(value)
+    except Exception:
+        return np.nan
+
+
+def _snapshot_times(timestamps):
+    '''
+    Converts an array of unix timestamps to (timezone naive) local times.
+    '''
+    times=pd.to_datetime(np.asarray(timestamps, dtype=float), unit='s', utc=True)
+    return times.tz_convert(tzlocal()).tz_localize(None)
+
+
+def _snapshot_time(value):
+    '''
+    Converts a time (str, datetime or pandas.Timestamp) to a (timezone naive) local time.
+    '''
+    value=pd.Timestamp(value)
+    if value.tzinfo is not None:
+        value=value.tz_convert(tzlocal()).tz_localize(None)
+    return value
+
+
+class ESM_snapshot_log:
+    def __init__(self, file_path, max_workers=16):
+        '''
+        An append-only log of snapshots, stored in an HDF5 file with one column per axis or signal.
+
+        Each set of devices is stored in its own group (given by the label, eg. 'BEAMLINE'), with a 'time'
+        dataset and one dataset per axis or signal. Columns that are added to a set later are filled with
+        NaN for the earlier snapshots.
+
+        PARAMETERS
+        ----------
+
+        file_path : str
+            The path to the HDF5 file.
+
+        max_workers : int, optional
+            The maximum number of values read in parallel.
+
+        '''
+        self.file_path=file_path
+        self.max_workers=max_workers
+
+
+    def take(self, objects, label=None):
+        '''
+        Reads every axis and signal in parallel and returns them as one snapshot.
+
+        PARAMETERS
+        ----------
+
+        objects : dict
+            A dictionary mapping each column name (eg. 'M1_X') to the ophyd object to read.
+
+        label : str, optional
+            The label of the set of devices, if given the snapshot is appended to the log.
+
+        snapshot : pandas.Series, output
+            The values, indexed by the column names, with the time of the snapshot (as a datetime) as the
+            name.
+
+        '''
+        timestamp=time.time()
+        names=list(objects.keys())
+        with ThreadPoolExecutor(max_workers=max(min(self.max_workers, len(names)), 1)) as executor:
+            values=list(executor.map(ESM_read_value, [objects[name] for name in names]))
+
+        snapshot=pd.Series(values, index=names, dtype=float, name=_snapshot_times([timestamp])[0])
+        if label is not None:
+            self.append(label, snapshot)
+
+        return snapshot
+
+
+    def append(self, label, snapshot):
+        '''
+        Appends a snapshot to the log, see take.
+
+        If the log can not be written (eg. it is locked by another session) a message is printed and the
+        snapshot is not recorded.
+
+        '''
+        import h5py
+
+        try:
+            with h5py.File(self.file_path, 'a') as f:
+                group=f.require_group(label)
+                if 'time' not in group:
+                    group.create_dataset('time', shape=(0,), maxshape=(None,), dtype='f8', chunks=(1024,))
+                rows=group['time'].shape[0]
+
+                group['time'].resize((rows+1,))
+                group['time'][rows]=snapshot.name.tz_localize(tzlocal()).timestamp()
+                for name in group:
+                    if name != 'time' and name not in snapshot.index:
+                        group[name].resize((rows+1,))
+                        group[name][rows]=np.nan
+                for name, value in snapshot.items():
+                    if name not in group:
+                        group.create_dataset(name, data=np.full(rows, np.nan), maxshape=(None,), dtype='f8',
+                                             chunks=(1024,))
+                    group[name].resize((rows+1,))
+                    group[name][rows]=value
+        except OSError as error:
+            print ('unable to write the snapshot to '+self.file_path+': '+str(error))
+
+
+    def labels(self):
+        '''
+        Returns the labels of the sets of devices in the log.
+        '''
+        import h5py
+
+        if not os.path.exists(self.file_path):
+            return []
+        with h5py.File(self.file_path, 'r') as f:
+            return list(f.keys())
+
+
+    def times(self, label):
+        '''
+        Returns the times of the snapshots in the log for a set of devices.
+
+        PARAMETERS
+        ----------
+
+        label : str
+            The label of the set of devices, eg. 'BEAMLINE'.
+
+        times : pandas.DatetimeIndex, output
+            The time of each snapshot, oldest first.
+
+        '''
+        import h5py
+
+        if label not in self.labels():
+            raise RuntimeError('no snapshots of '+str(label)+' found in '+self.file_path)
+        with h5py.File(self.file_path, 'r') as f:
+            return _snapshot_times(f[label]['time'][:])
+
+
+    def _row(self, label, snapshot):
+        '''
+        Returns the row in the log for a snapshot given as a row number or a time.
+        '''
+        if isinstance(snapshot, (int, np.integer)):
+            return int(snapshot)
+
+        times=self.times(label)
+        row=times.searchsorted(_snapshot_time(snapshot), side='right')-1
+        if row < 0:
+            raise RuntimeError('no snapshot of '+str(label)+' found before '+str(snapshot))
+        return int(row)
+
+
+    def history(self, label, columns=None, start=None, end=None):
+        '''
+        Returns the logged snapshots for a set of devices.
+
+        PARAMETERS
+        ----------
+
+        label : str
+            The label of the set of devices, eg. 'BEAMLINE'.
+
+        columns : list, optional
+            The axes or signals to return, the default (None) returns all of them.
+
+        start, end : str or datetime, optional
+            The time range of the snapshots to return, the default (None) returns all of them.
+
+        history : pandas.DataFrame, output
+            One row per snapshot (indexed by time) and one column per axis or signal.
+
+        '''
+        import h5py
+
+        times=self.times(label)
+        mask=np.ones(len(times), dtype=bool)
+        if start is not None:
+            mask&=times >= _snapshot_time(start)
+        if end is not None:
+            mask&=times <= _snapshot_time(end)
+        rows=np.flatnonzero(mask)
+
+        with h5py.File(self.file_path, 'r') as f:
+            group=f[label]
+            if columns is None:
+                columns=[name for name in group if name != 'time']
+            data={}
+            for name in columns:
+                if len(rows):
+                    data[name]=group[name][rows[0]:rows[-1]+1][rows-rows[0]]
+                else:
+                    data[name]=np.zeros(0)
+
+        return pd.DataFrame(data, index=times[rows])
+
+
+    def snapshot(self, label, snapshot=-1):
+        '''
+        Returns one logged snapshot for a set of devices.
+
+        PARAMETERS
+        ----------
+
+        label : str
+            The label of the set of devices, eg. 'BEAMLINE'.
+
+        snapshot : int, str or datetime, optional
+            The row number of the snapshot (negative values count back from the latest, the default is the
+            latest) or a time, which returns the last snapshot taken at or before that time.
+
+        snapshot : pandas.Series, output
+            The values, indexed by the column names, with the time of the snapshot as the name.
+
+        '''
+        import h5py
+
+        row=self._row(label, snapshot)
+        with h5py.File(self.file_path, 'r') as f:
+            group=f[label]
+            names=[name for name in group if name != 'time']
+            values=[group[name][row] for name in names]
+            timestamp=group['time'][row]
+
+        return pd.Series(values, index=names, dtype=float, name=_snapshot_times([timestamp])[0])
+
+
+    def diff(self, label, old, new=-1, atol=0.):
+        '''
+        Compares two logged snapshots of a set of devices.
+
+        PARAMETERS
+        ----------
+
+        label : str
+            The label of the set of devices, eg. 'BEAMLINE'.
+
+        old, new : int, str or datetime
+            The snapshots to compare, see snapshot. The default for new is the latest snapshot.
+
+        atol : float, optional
+            Differences smaller than or equal to atol are not included.
+
+        difference : pandas.DataFrame, output
+            The 'old' and 'new' values and the 'difference' (new-old) for each axis or signal that changed.
+
+        '''
+        old=self.snapshot(label, old)
+        new=self.snapshot(label, new)
+        frame=pd.DataFrame({'old' : old, 'new' : new})
+        frame['difference']=frame['new']-frame['old']
+
+        changed=(frame['difference'].abs() > atol) | (frame['old'].isna() != frame['new'].isna())
+        return frame[changed]
+
+
+def ESM_render_status(name, snapshot, signal_groups, motor_groups):
+    '''
+    Returns the status report for a set of devices, rendered from a snapshot.
+
+    PARAMETERS
+    ----------
+
+    name : str
+        The name of the set of devices, used in the header.
+
+    snapshot : pandas.Series
+        The snapshot, see ESM_snapshot_log.take.
+
+    signal_groups, motor_groups : dict
+        Dictionaries mapping each device name to the list of signal (or axis) names to report for it.
+
+    f_string : str, output
+        The formatted report.
+
+    '''
+    lines=['************************************************************',
+           name+' STATUS:  '+snapshot.name.strftime('%c'),
+           '************************************************************', '']
+
+    for title, groups in (('EPICS SIGNAL COMPONENTS', signal_groups), ('EPICS MOTOR COMPONENTS', motor_groups)):
+        lines+=[title, '-----------------------']
+        for key, names in groups.items():
+            lines.append('    '+key+':')
+            for column in names:
+                lines.append('\t '+column.ljust(25)+' -->  %f' % snapshot.get(column, np.nan))
+            lines.append('')
+
+    return '\n'.join(lines)+'\n'
+
+
+###SETTINGS SNAPSHOTS
+###   The following set of code is used by the alignment and check routines to record the settings (motor
+###   positions and detector settings) that they change, and to restore them concurrently when they finish
+###   (or fail).
+
+
+def _read_setting(obj):
+    '''
+    Returns the current setting of an axis (its position) or a signal (its value).
+    '''
+    if hasattr(obj, 'position'):
+        return obj.position
+    return obj.get()
+
+
+def _read_settings(objects, max_workers=16):
+    '''
+    Returns the current settings of a list of axes and signals, read in parallel.
+    '''
+    if not objects:
+        return []
+    with ThreadPoolExecutor(max_workers=max(min(max_workers, len(objects)), 1)) as executor:
+        return list(executor.map(_read_setting, objects))
+
+
+def _same_setting(obj, value, target, atol, rtol):
+    '''
+    Returns True if a setting matches its target, numbers are compared using atol and rtol, with atol
+    increased to the display precision of the object (eg. the PREC field of an EpicsMotor) if it has one.
+    '''
+    try:
+        precision=getattr(obj, 'precision', None)
+    except Exception:
+        precision=None
+    if isinstance(precision, int) and precision >= 0:
+        atol=max(atol, 0.5*10**-precision)
+    try:
+        return bool(np.isclose(float(value), float(target), atol=atol, rtol=rtol))
+    except (TypeError, ValueError):
+        return value == target
+
+
+class ESM_settings_snapshot:
+    def __init__(self, objects, atol=1e-6, rtol=1e-6, max_workers=16):
+        '''
+        The settings of a set of axes and signals, read concurrently, which can be restored with one plan.
+
+        PARAMETERS
+        ----------
+
+        objects : list
+            The ophyd positioners and signals to record, eg. [M3.Ry, qem07.em_range].
+
+        atol, rtol : float, optional
+            The absolute and relative tolerances used to decide if a setting has changed, and to verify the
+            readback after it is restored.
+
+        max_workers : int, optional
+            The maximum number of settings read in parallel.
+
+        '''
+        self.objects=list(objects)
+        self.atol=atol
+        self.rtol=rtol
+        self.max_workers=max_workers
+        self.values=dict(zip(self.objects, self._read(self.objects)))
+
+
+    def _read(self, objects):
+        '''
+        Returns the current settings of a list of objects, read in parallel.
+        '''
+        return _read_settings(objects, self.max_workers)
+
+
+    def restore(self, exclude=(), verify=True):
+        '''
+        A plan that restores the recorded settings, all of the settings that have changed are set at once.
+
+        PARAMETERS
+        ----------
+
+        exclude : list, optional
+            The objects not to restore.
+
+        verify : boolean, optional
+            If True (default) the settings are read back afterwards and any that do not match are listed in a
+            warning.
+
+        '''
+        settings=[(obj, self.values[obj]) for obj in self.objects if obj not in exclude]
+        yield from ESM_apply_settings(settings, atol=self.atol, rtol=self.rtol, verify=verify,
+                                      max_workers=self.max_workers, action='RESTORED')
+
+
+def ESM_apply_settings(settings, atol=1e-6, rtol=1e-6, verify=True, max_workers=16, action='SET'):
+    '''
+    A plan that sets a list of axes and signals to their target values in one concurrent step.
+
+    The current settings are read in parallel and only the ones that differ from their target are set, the
+    moves are all started at once and then waited on together. The settings are then read back and any that
+    do not match their target are listed in a warning.
+
+    PARAMETERS
+    ----------
+
+    settings : list
+        A list of (object, value) tuples, eg. [(qem07.em_range, '350 pC'), (BTA2diag.trans, -63)].
+
+    atol, rtol : float, optional
+        The absolute and relative tolerances used to decide if a setting is already at its target.
+
+    verify : boolean, optional
+        If True (default) the settings are read back afterwards.
+
+    max_workers : int, optional
+        The maximum number of settings read in parallel.
+
+    action : str, optional
+        The word used in the warning, eg. 'WARNING:: qem07_em_range WAS NOT SET, ...'.
+
+    changed : list, output
+        The list of objects that were set.
+
+    '''
+    settings=list(settings)
+    objects=[obj for obj, target in settings]
+    changed=[(obj, target) for (obj, target), value in zip(settings, _read_settings(objects, max_workers))
+             if not _same_setting(obj, value, target, atol, rtol)]
+
+    group=short_uid('settings')
+    for obj, target in changed:
+        yield from abs_set(obj, target, group=group)
+    yield from wait(group)
+
+    if verify and changed:
+        values=_read_settings([obj for obj, target in changed], max_workers)
+        for (obj, target), value in zip(changed, values):
+            if not _same_setting(obj, value, target, atol, rtol):
+                print ('WARNING:: '+obj.name+' WAS NOT '+action+', it is '+str(value)+' instead of '+
+                       str(target))
+
+    return [obj for obj, target in changed]
+
+
+def ESM_restore_wrapper(plan, objects, restore=True, exclude=None, **kwargs):
+    '''
+    Records the settings of a set of axes and signals when the plan starts and restores them (concurrently)
+    when it finishes or fails, see ESM_settings_snapshot.
+
+    PARAMETERS
+    ----------
+
+    plan : iterable or iterator
+        The plan to wrap.
+
+    objects : list or ESM_settings_snapshot
+        The ophyd positioners and signals to record and restore, or a snapshot already taken.
+
+    restore : boolean, optional
+        If False the settings are not restored, this allows a routine's 'return_all' option to be passed on.
+
+    exclude : list, optional
+        The objects not to restore, the list is read when the plan finishes so the wrapped plan can add the
+        axes that it has moved to a new (eg. optimum) position.
+
+    **kwargs : optional
+        The keyword arguments passed to ESM_settings_snapshot.
+
+    '''
+    snapshot=None
+
+    def recorded_plan():
+        nonlocal snapshot
+        if isinstance(objects, ESM_settings_snapshot):
+            snapshot=objects
+        else:
+            snapshot=ESM_settings_snapshot(objects, **kwargs)
+        return (yield from plan)
+
+    def restore_plan():
+        if restore and snapshot is not None:
+            yield from snapshot.restore(exclude=exclude or ())
+
+    return (yield from finalize_wrapper(recorded_plan(), restore_plan()))
+
+
+ESM_restore_decorator = make_decorator(ESM_restore_wrapper)
+
+
+ESM_snapshots = ESM_snapshot_log('/direct/XF21ID1/status_files/ESM_snapshots.h5')
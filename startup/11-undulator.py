@@ -1,6 +1,7 @@
 from ophyd import (PVPositioner, Component as Cpt, EpicsSignal, EpicsSignalRO,
                    Device)
 from ophyd.utils import ReadOnlyError
+from bluesky.plan_stubs import mv
 import time as ttime
 
 def safe_to_actuate_epu57():
@@ -92,7 +93,162 @@ class UphasePositioner(SlowStopPVPositioner):
     # TODO subscribe kill switch pressed and stop motion
 
 
-class EPU(Device):
+class EPU_polarization_planner:
+    '''
+    Plans the fastest safe (gap, phase) trajectory between two polarization states of an undulator.
+
+    The safe envelope is declared by the attributes below:
+        - the phase can move at any gap if the end phase is a linear state (LH, phase 0, or LV, phase
+          period/2), as in Eph.move_to.
+        - a phase move that ends at a non-linear (circular) phase requires the gap to be at least
+          circular_min_gap during the phase move.
+    Within the envelope the gap and phase move concurrently, each leg of the trajectory moves all of its
+    axes together and the next leg starts when they have all finished.
+
+    The device needs 'gap' and 'phase' positioners and a 'period' attribute (in mm).
+    '''
+    gap_speed = 1.               # estimated gap speed (mm/s)
+    phase_speed = 1.             # estimated phase speed (mm/s)
+    circular_min_gap = 100.      # the minimum gap during a phase move that ends at a circular phase (mm)
+    linear_tolerance = 0.1       # the tolerance for a phase to be considered a linear state (mm)
+
+    def is_linear_phase(self, phase):
+        '''
+        Returns True if the phase corresponds to a linear polarization state (LH or LV).
+        '''
+        return (abs(phase) < self.linear_tolerance or
+                abs(abs(phase) - self.period/2) < self.linear_tolerance)
+
+
+    def plan_polarization_move(self, gap, phase, start=None):
+        '''
+        Returns the legs of the fastest safe trajectory to the requested gap and phase.
+
+        PARAMETERS
+        ----------
+
+        gap, phase : float
+            The requested gap and phase in mm.
+
+        start : tuple, optional
+            The starting (gap, phase), defaults to the current positions.
+
+        legs : list, output
+            A list of dictionaries, each mapping 'gap' and/or 'phase' to the target for that leg. The axes
+            in each leg move concurrently.
+
+        '''
+        if start is None:
+            start = (self.gap.position, self.phase.position)
+        start_gap, start_phase = start
+
+        if abs(phase - start_phase) < self.linear_tolerance:
+            if abs(gap - start_gap) > 0:
+                return [{'gap' : gap}]
+            return []
+
+        if self.is_linear_phase(phase):
+            return [{'gap' : gap, 'phase' : phase}]
+
+        legs = []
+        if start_gap < self.circular_min_gap:
+            legs.append({'gap' : self.circular_min_gap})
+        legs.append({'gap' : max(gap, self.circular_min_gap), 'phase' : phase})
+        if gap < self.circular_min_gap:
+            legs.append({'gap' : gap})
+
+        return legs
+
+
+    def sequential_polarization_move(self, gap, phase, start=None):
+        '''
+        Returns the legs of the sequential trajectory used by Eph.move_to (without the planner).
+
+        For circular (non-linear) phases the gap is opened to circular_min_gap, then the phase and then
+        the gap are moved, otherwise the phase and then the gap are moved.
+
+        PARAMETERS
+        ----------
+
+        gap, phase : float
+            The requested gap and phase in mm.
+
+        start : tuple, optional
+            The starting (gap, phase), defaults to the current positions.
+
+        legs : list, output
+            A list of dictionaries, each containing one axis and its target.
+
+        '''
+        if start is None:
+            start = (self.gap.position, self.phase.position)
+        start_gap, start_phase = start
+
+        if not self.is_linear_phase(phase):
+            return [{'gap' : self.circular_min_gap}, {'phase' : phase}, {'gap' : gap}]
+
+        legs = []
+        if abs(phase - start_phase) >= self.linear_tolerance:
+            legs.append({'phase' : phase})
+        legs.append({'gap' : gap})
+        return legs
+
+
+    def estimate_legs_time(self, legs, start=None):
+        '''
+        Returns the estimated time (in s) for a trajectory, using gap_speed and phase_speed.
+
+        PARAMETERS
+        ----------
+
+        legs : list
+            The legs returned by plan_polarization_move.
+
+        start : tuple, optional
+            The starting (gap, phase), defaults to the current positions.
+
+        time : float, output
+            The estimated time in seconds.
+
+        '''
+        if start is None:
+            start = (self.gap.position, self.phase.position)
+        position = {'gap' : start[0], 'phase' : start[1]}
+        speed = {'gap' : self.gap_speed, 'phase' : self.phase_speed}
+
+        total = 0.
+        for leg in legs:
+            total += max(abs(target - position[axis])/speed[axis] for axis, target in leg.items())
+            position.update(leg)
+
+        return total
+
+
+    def polarization_stages(self, gap, phase):
+        '''
+        Returns the planned trajectory as a list of stages of (positioner, value) tuples, see
+        plan_polarization_move.
+        '''
+        return [[(getattr(self, axis), target) for axis, target in leg.items()]
+                for leg in self.plan_polarization_move(gap, phase)]
+
+
+    def move_polarization(self, gap, phase):
+        '''
+        Moves the undulator to the requested gap and phase along the planned safe trajectory.
+
+        PARAMETERS
+        ----------
+
+        gap, phase : float
+            The requested gap and phase in mm.
+
+        '''
+        for stage in self.polarization_stages(gap, phase):
+            yield from mv(*[item for pair in stage for item in pair])
+
+
+class EPU(Device, EPU_polarization_planner):
     gap = Cpt(UgapPositioner, '', settle_time=0, kind='hinted')
     phase = Cpt(UphasePositioner, '', settle_time=0, kind='hinted')
 
@@ -101,12 +257,14 @@ EPU57.gap.read_attrs = ['setpoint', 'readback']
 EPU57.gap.readback.name='EPU57_gap'
 EPU57.phase.read_attrs = ['setpoint', 'readback']
 EPU57.phase.readback.name='EPU57_phase'
+EPU57.period = 57.
 
 EPU105 = EPU('SR:C21-ID:G1B{EPU:2', name='EPU105')
 EPU105.gap.read_attrs = ['setpoint', 'readback']
 EPU105.gap.readback.name='EPU105_gap'
 EPU105.phase.read_attrs = ['setpoint', 'readback']
 EPU105.phase.readback.name='EPU105_phase'
+EPU105.period = 105.
 
 EPU57.gap.other = EPU105.gap
 EPU105.gap.other = EPU57.gap
@@ -115,6 +273,77 @@ EPU105.gap.other = EPU57.gap
 #EPU105.safe_to_actuate = safe_to_actuate_epu105
 
 
+def benchmark_EPU_polarization_switch(EPU='105', photon_energy=200., sequence=('LH', 'CL', 'CR', 'LV', 'CL', 'LH'),
+                                      time_scale=0.05):
+    '''
+    Compares the time taken for each polarization switch using the sequential moves and the planned
+    trajectories (see EPU_polarization_planner).
+
+    The moves are run on a simulated undulator (see ESM_sim_devices) with a separate RunEngine, the gap and
+    phase targets are taken from Eph.energy_table.
+
+    PARAMETERS
+    ----------
+
+    EPU : str, optional
+        The undulator to simulate, can be '57' or '105' (default).
+
+    photon_energy : float, optional
+        The photon energy used for every polarization state.
+
+    sequence : list, optional
+        The sequence of polarization states to switch between.
+
+    time_scale : float, optional
+        The factor used to multiply all of the simulated move times (the reported times are rescaled).
+
+    results : pandas.DataFrame, output
+        The number of legs and the estimated and measured time (in s, at real speed) of each switch for
+        both methods.
+
+    '''
+    import pandas as pd
+    from bluesky import RunEngine
+
+    sim_RE = RunEngine({})
+    targets = {LP : Eph.energy_table(photon_energy, grating='800', EPU=EPU, LP=LP).iloc[0] for LP in set(sequence)}
+
+    results = []
+    for method in ('sequential', 'planned'):
+        epu = ESM_sim_devices(time_scale=time_scale)['EPU'+EPU]
+        epu.gap_speed = epu.gap.velocity.get()
+        epu.phase_speed = epu.phase.velocity.get()
+        sim_RE(mv(epu.gap, targets[sequence[0]]['Gap'], epu.phase, targets[sequence[0]]['Phase']))
+
+        for previous, LP in zip(sequence[:-1], sequence[1:]):
+            gap, phase = targets[LP]['Gap'], targets[LP]['Phase']
+            if method == 'sequential':
+                legs = epu.sequential_polarization_move(gap, phase)
+            else:
+                legs = epu.plan_polarization_move(gap, phase)
+
+            def switch():
+                for leg in legs:
+                    yield from mv(*[item for axis, target in leg.items() for item in (getattr(epu, axis), target)])
+
+            estimate = epu.estimate_legs_time(legs)
+            start = ttime.perf_counter()
+            sim_RE(switch())
+            results.append({'method' : method, 'switch' : previous+'->'+LP, 'legs' : len(legs),
+                            'estimated' : estimate, 'measured' : (ttime.perf_counter()-start)/time_scale})
+
+    results = pd.DataFrame(results)
+    sequential = results[results['method'] == 'sequential'].set_index('switch')
+    planned = results[results['method'] == 'planned'].set_index('switch')
+    summary = pd.DataFrame({'sequential' : sequential['measured'], 'planned' : planned['measured'],
+                            'saved' : sequential['measured']-planned['measured']})
+    print ('EPU{} polarization switches at {} eV (s):'.format(EPU, photon_energy))
+    print (summary.to_string(float_format='{:.1f}'.format))
+    print ('total: sequential {:.1f} s, planned {:.1f} s, saved {:.1f} s'.format(*summary.sum()))
+
+    return results
+
+
 class Source(Device):
     #This is a class to be used to define the readback values of the beam source front the
     #front end.
@@ -143,61 +372,36 @@ class Source(Device):
                     - 'string_and_file', indicates the routine should return a formatted string and append to a
                        status file for the device.
                     - 'dict', indicates the routine should return a dictionary of positions.
+                For 'string_and_file' the snapshot is also appended to the snapshot log ESM_snapshots.
 
             f_string : str
-                Possible output string for formatting.
+                Possible output string for formatting, rendered from a snapshot of all of the values.
 
             status_dict : dict
                 Possible outputted dictionary, which has keywords for each motor in the axis list and contains
                 a dictionary of axes names and positions.
 
             '''
-            #Define the list of EPICS signal status values.
-            det_status_dict={}
-            det_status_dict[self.name]={self.name+'_Current':self.Current.get(),
-                                        self.name+'_Xoffset':self.Xoffset.get(),
-                                        self.name+'_Xangle':self.Xangle.get(),
-                                        self.name+'_Yoffset':self.Yoffset.get(),
-                                        self.name+'_Yangle':self.Yangle.get()}
+            #Define the EPICS signals and motors, grouped by device.
+            signal_groups={self.name : {self.name+'_'+attr : getattr(self, attr) for attr in
+                                        ('Current', 'Xoffset', 'Xangle', 'Yoffset', 'Yangle')}}
+            motor_groups={'EPU_105' : {'EPU105_gap':EPU105.gap, 'EPU105_phase':EPU105.phase},
+                          'EPU57' : {'EPU57_gap':EPU57.gap, 'EPU57_phase':EPU57.phase},
+                          'FEslit' : {'FEslit_h_center':FEslit.h_center, 'FEslit_h_gap':FEslit.h_gap,
+                                      'FEslit_v_center':FEslit.v_center, 'FEslit_v_gap':FEslit.v_gap}}
+
+            #read all of the signals and axes at once, recording the snapshot in the log if requested.
+            objects={}
+            for group in list(signal_groups.values())+list(motor_groups.values()):
+                objects.update(group)
+            snapshot=ESM_snapshots.take(objects, label=self.name if output.endswith('file') else None)
 
             #Define the list of EPICS motor status values.
-            status_dict={}
-            status_dict['EPU_105']={'EPU105_gap':EPU105.gap.position,
-                                    'EPU105_phase':EPU105.phase.position}
-
-            status_dict['EPU57']={'EPU57_gap':EPU57.gap.position,
-                                  'EPU57_phase':EPU57.phase.position}
-
-            status_dict['FEslit']={'FEslit_h_center':FEslit.h_center.position,
-                                 'FEslit_h_gap':FEslit.h_gap.position,
-                                 'FEslit_v_center':FEslit.v_center.position,
-                                 'FEslit_v_gap':FEslit.v_gap.position}
-
-            f_string='************************************************************\n'
-            f_string+=self.name+' STATUS:  '+time.strftime("%c") + '\n'
-            f_string+='************************************************************\n\n'
-
-            #step through the detectors and read the values.
-            f_string+='EPICS SIGNAL COMPONENTS\n'
-            f_string+='-----------------------\n'
-            for key in list(det_status_dict.keys()):
-                f_string+='    '+key+':\n'
-                key_dict = det_status_dict[key]
-                for det in key_dict:
-                    obj,_,attr = det.partition('_')
-                    f_string+='\t '+det+' -->  %f\n' % getattr(ip.user_ns[obj],attr).value
-                f_string+='\n'
-
-            # step through the motors and read the values
-            f_string+='EPICS MOTOR COMPONENTS\n'
-            f_string+='-----------------------\n'
-            for key in list(status_dict.keys()):
-                f_string+='    '+key+':\n'
-                key_dict = status_dict[key]
-                for axis in key_dict:
-                    obj,_,attr = axis.partition('_')
-                    f_string+='\t '+axis+' -->  %f\n' % getattr(ip.user_ns[obj],attr).position
-                    f_string+='\n'
+            status_dict={key : {name : snapshot[name] for name in group} for key, group in motor_groups.items()}
+
+            f_string=ESM_render_status(self.name, snapshot,
+                                       {key : list(group.keys()) for key, group in signal_groups.items()},
+                                       {key : list(group.keys()) for key, group in motor_groups.items()})
 
             if output.startswith('string'):
                 print (f_string)
@@ -0,0 +1,441 @@
+import os
+import re
+import json
+import time
+import shutil
+import datetime
+import numpy as np
+import pandas as pd
+
+
+###CALIBRATION STORE
+###   The following set of code is used to collect all of the monochromator and undulator calibration
+###   tables (the .csv files in motion_definition_files) into a single binary (.npz) file. The historical
+###   copies of each table (eg. 'Grt_Offset_A_before24Oct2024.csv') are included as earlier versions, so
+###   that the calibration 'as of' a given date can be selected and two calibrations can be compared.
+
+ESM_calibration_tables = ['Grt_Translation', 'Grt_Offset_A', 'Grt_Offset_B', 'M2_Offset_A', 'M2_Offset_B',
+                          'c_value_A', 'c_value_B', 'Und_Energy_EPU57_theory', 'Und_Energy_EPU57_LH_theory',
+                          'Und_Energy_EPU57_LV_theory', 'Und_Energy_EPU105_theory', 'Und_Energy_EPU57',
+                          'Und_Energy_EPU105', 'Und_Energy_LV_EPU105', 'Und_Energy_EPU105_Cgap_theory',
+                          'Und_Energy_EPU105_Cphase_theory', 'Und_Energy_EPU57_Cgap_theory',
+                          'Und_Energy_EPU57_Cphase_theory']
+
+
+def _calibration_date(date_str):
+    '''
+    Converts the date in the file name of a historical calibration table to a datetime.
+
+    Handles the formats used in motion_definition_files, eg. '24Oct2024', 'June24_2024', '19Sept2022',
+    'Sep28_2022' and '2020', a year on its own is taken as the end of that year.
+
+    PARAMETERS
+    ----------
+
+    date_str : str
+        The date section of the file name.
+
+    date : datetime.datetime, output
+        The date, or None if the string could not be converted.
+
+    '''
+    date_str=date_str.strip('_').replace('_', '').replace(' ', '').replace('Sept', 'Sep')
+
+    if re.fullmatch(r'\d{4}', date_str):
+        return datetime.datetime(int(date_str)+1, 1, 1)
+
+    for date_format in ('%d%b%Y', '%b%d%Y', '%B%d%Y', '%d%B%Y'):
+        try:
+            return datetime.datetime.strptime(date_str, date_format)
+        except ValueError:
+            pass
+
+    return None
+
+
+class ESM_calibration_store:
+    def __init__(self, definition_dir, store_file='ESM_calibration.npz', tables=ESM_calibration_tables):
+        '''
+        A single file store of the calibration tables, with the version history of each table.
+
+        The store is loaded the first time a table is requested, it is regenerated from the .csv files if
+        the store file is missing, if any of the .csv files are newer than the store or if .csv files are
+        added or removed.
+
+        PARAMETERS
+        ----------
+
+        definition_dir : str
+            The path to the directory containing the calibration .csv files.
+
+        store_file : str, optional
+            The name of the store file, located in definition_dir.
+
+        tables : list, optional
+            The names of the tables to include in the store, each table is read from 'name.csv', the
+            historical versions are read from 'name_before<date>.csv' or 'name_old_calib_<date>.csv'.
+
+        '''
+        self.definition_dir=definition_dir
+        self.store_path=os.path.join(definition_dir, store_file)
+        self.tables=list(tables)
+        self._index=None
+        self._arrays=None
+
+
+    def _sources(self):
+        '''
+        Returns the .csv files for each table, with the date each version was replaced.
+
+        PARAMETERS
+        ----------
+
+        sources : dict, output
+            A dictionary mapping each table name to a list of (file_name, replaced_date) tuples, sorted
+            from oldest to newest. The current version is last and has a replaced_date of None.
+
+        '''
+        file_names=os.listdir(self.definition_dir)
+        sources={}
+
+        for table in self.tables:
+            history_pattern=re.compile(re.escape(table)+r'_(?:before|old_calib)(.+)\.csv$')
+            versions=[]
+            for file_name in file_names:
+                match=history_pattern.match(file_name)
+                if match:
+                    date=_calibration_date(match.group(1))
+                    if date is not None:
+                        versions.append((file_name, date))
+
+            versions.sort(key=lambda version: version[1])
+            if table+'.csv' in file_names:
+                versions.append((table+'.csv', None))
+            sources[table]=versions
+
+        return sources
+
+
+    def _is_stale(self, index):
+        '''
+        Returns True if the .csv files have changed since the store file was written.
+        '''
+        try:
+            sources=self._sources()
+        except OSError:
+            return False
+
+        current_files={file_name for versions in sources.values() for file_name, _ in versions}
+        if current_files != set(index['sources']):
+            return True
+
+        for file_name, mtime in index['sources'].items():
+            try:
+                if os.path.getmtime(os.path.join(self.definition_dir, file_name)) > mtime:
+                    return True
+            except OSError:
+                return True
+
+        return False
+
+
+    def build(self):
+        '''
+        Reads all of the .csv files and writes the store file.
+
+        The store file is written to a temporary file first and then renamed, so that other sessions never
+        read a partially written store.
+
+        '''
+        sources=self._sources()
+        index={'format' : 1, 'created' : time.time(), 'sources' : {}, 'tables' : {}, 'columns' : {}}
+        arrays={}
+        offset=0
+
+        for table, versions in sources.items():
+            index['tables'][table]=[]
+            valid_from=None
+            for i, (file_name, replaced) in enumerate(versions):
+                file_path=os.path.join(self.definition_dir, file_name)
+                df=pd.read_csv(file_path, dtype='float')
+                df.columns=[column.strip() for column in df.columns]
+                key=table+'@'+str(i)
+                for column in df.columns:
+                    arrays[key+'/'+column]=df[column].to_numpy(dtype=float)
+                    index['columns'][key+'/'+column]=[offset, len(df)]
+                    offset+=len(df)
+
+                index['sources'][file_name]=os.path.getmtime(file_path)
+                index['tables'][table].append({'key' : key, 'file' : file_name, 'columns' : list(df.columns),
+                                               'valid_from' : valid_from,
+                                               'valid_until' : None if replaced is None else replaced.isoformat()})
+                if replaced is not None:
+                    valid_from=replaced.isoformat()
+
+        # all of the columns are saved as one array, the index gives the position of each column.
+        if arrays:
+            data=np.concatenate(list(arrays.values()))
+        else:
+            data=np.zeros(0)
+        temp_path=self.store_path+'.'+str(os.getpid())+'.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                np.savez(f, index=np.array(json.dumps(index)), data=data)
+            os.replace(temp_path, self.store_path)
+        except OSError as error:
+            # the tables are still used from memory if the store file can not be written.
+            print ('unable to write the calibration store '+self.store_path+': '+str(error))
+
+        self._index=index
+        self._arrays=arrays
+
+
+    def load(self, check=True):
+        '''
+        Loads the store file, regenerating it first if required.
+
+        PARAMETERS
+        ----------
+
+        check : bool, optional
+            If True (default) the .csv files are checked and the store regenerated if any have changed.
+
+        '''
+        index=None
+        if os.path.exists(self.store_path):
+            try:
+                with np.load(self.store_path) as store:
+                    index=json.loads(str(store['index']))
+                    data=store['data']
+                arrays={key : data[offset:offset+length] for key, (offset, length) in index['columns'].items()}
+            except (OSError, ValueError, KeyError):
+                index=None
+
+        if index is None or (check and self._is_stale(index)):
+            self.build()
+        else:
+            self._index=index
+            self._arrays=arrays
+
+
+    @property
+    def index(self):
+        if self._index is None:
+            self.load()
+        return self._index
+
+
+    def _version(self, name, as_of=None):
+        '''
+        Returns the index entry for a table at a given date (None for the current version).
+        '''
+        if name not in self.index['tables'] or not self.index['tables'][name]:
+            raise RuntimeError('calibration table '+str(name)+' not found in '+self.store_path)
+
+        versions=self.index['tables'][name]
+        if as_of is None:
+            version=versions[-1]
+            # regenerate the store if the current .csv file has changed since the store was written.
+            try:
+                mtime=os.path.getmtime(os.path.join(self.definition_dir, version['file']))
+            except OSError:
+                mtime=None
+            if mtime is not None and mtime > self._index['sources'][version['file']]:
+                self.build()
+                version=self._index['tables'][name][-1]
+            return version
+
+        as_of=pd.Timestamp(as_of).isoformat()
+        for version in versions:
+            if ((version['valid_from'] is None or version['valid_from'] <= as_of) and
+                    (version['valid_until'] is None or as_of < version['valid_until'])):
+                return version
+
+        raise RuntimeError('no version of calibration table '+str(name)+' is valid as of '+as_of)
+
+
+    def table(self, name, as_of=None):
+        '''
+        Returns a calibration table as a dictionary of arrays.
+
+        PARAMETERS
+        ----------
+
+        name : str
+            The name of the table, eg. 'Und_Energy_EPU57' or 'Grt_Offset_A'.
+
+        as_of : str or datetime, optional
+            The date for which to return the calibration, the default (None) returns the current version.
+
+        table : dict, output
+            A dictionary mapping each column name to an array of values.
+
+        '''
+        version=self._version(name, as_of)
+        return {column : self._arrays[version['key']+'/'+column] for column in version['columns']}
+
+
+    def records(self, name, as_of=None):
+        '''
+        Returns the first row of a calibration table as a dictionary of floats (eg. for the offset tables).
+
+        PARAMETERS
+        ----------
+
+        name : str
+            The name of the table, eg. 'Grt_Offset_A'.
+
+        as_of : str or datetime, optional
+            The date for which to return the calibration, the default (None) returns the current version.
+
+        records : dict, output
+            A dictionary mapping each column name (eg. '800') to its value.
+
+        '''
+        return {column : float(values[0]) for column, values in self.table(name, as_of).items()}
+
+
+    def versions(self, name):
+        '''
+        Returns the versions of a calibration table.
+
+        PARAMETERS
+        ----------
+
+        name : str
+            The name of the table, eg. 'Grt_Offset_A'.
+
+        versions : pandas.DataFrame, output
+            The file name and the date range for which each version is valid.
+
+        '''
+        self._version(name)
+        return pd.DataFrame(self.index['tables'][name], columns=['file', 'valid_from', 'valid_until'])
+
+
+    def diff(self, name, as_of_old, as_of_new=None):
+        '''
+        Compares two versions of a calibration table.
+
+        PARAMETERS
+        ----------
+
+        name : str
+            The name of the table, eg. 'Grt_Offset_A'.
+
+        as_of_old : str or datetime
+            The date for the old version.
+
+        as_of_new : str or datetime, optional
+            The date for the new version, the default (None) is the current version.
+
+        difference : pandas.DataFrame, output
+            For single row tables the 'old' and 'new' values and the 'difference' (new-old) for each
+            column, for longer tables the maximum absolute difference for each column.
+
+        '''
+        old=self.table(name, as_of_old)
+        new=self.table(name, as_of_new)
+
+        columns=[column for column in old if column in new]
+        if all(len(old[column]) == 1 and len(new[column]) == 1 for column in columns):
+            return pd.DataFrame({'old' : [old[column][0] for column in columns],
+                                 'new' : [new[column][0] for column in columns],
+                                 'difference' : [new[column][0]-old[column][0] for column in columns]},
+                                index=columns)
+
+        max_difference=[]
+        for column in columns:
+            if len(old[column]) == len(new[column]):
+                max_difference.append(np.max(np.abs(new[column]-old[column])))
+            else:
+                max_difference.append(np.nan)
+
+        return pd.DataFrame({'max_difference' : max_difference}, index=columns)
+
+
+    def update(self, name, values, date=None):
+        '''
+        Writes a new current version of a single row calibration table (eg. the offsets).
+
+        The current .csv file is kept as the previous version ('name_before<date>.csv'), the new .csv file
+        is written to a temporary file first and then renamed, and the store is regenerated. If the table
+        has already been updated on the same date the earlier historical copy is kept, so there is one
+        version per date.
+
+        PARAMETERS
+        ----------
+
+        name : str
+            The name of the table, eg. 'Grt_Offset_A'.
+
+        values : dict
+            A dictionary mapping column names (eg. '800') to the new values, columns that are not included
+            keep their current values.
+
+        date : str or datetime, optional
+            The date of the new version, the default (None) is today.
+
+        versions : pandas.DataFrame, output
+            The versions of the table after the update, see versions.
+
+        '''
+        current=self.records(name)
+        unknown=[column for column in values if column not in current]
+        if unknown:
+            raise RuntimeError('columns '+str(unknown)+' not found in calibration table '+str(name))
+
+        date=pd.Timestamp(date if date is not None else datetime.datetime.now())
+        file_path=os.path.join(self.definition_dir, name+'.csv')
+        history_path=os.path.join(self.definition_dir, name+'_before'+date.strftime('%d%b%Y')+'.csv')
+        if not os.path.exists(history_path):
+            shutil.copy2(file_path, history_path)
+
+        current.update({column : float(value) for column, value in values.items()})
+        temp_path=file_path+'.'+str(os.getpid())+'.tmp'
+        pd.DataFrame([current]).to_csv(temp_path, index=False, float_format='%.8f')
+        os.replace(temp_path, file_path)
+
+        self.build()
+        return self.versions(name)
+
+
+ESM_calibration = ESM_calibration_store(os.path.join(PROFILE_STARTUP_PATH, 'motion_definition_files'))
+
+
+def benchmark_ESM_calibration(num=10):
+    '''
+    Compares the time taken to read the calibration tables from the individual .csv files and from the
+    calibration store file.
+
+    PARAMETERS
+    ----------
+
+    num : int, optional
+        The number of times to repeat each read.
+
+    results : dict, output
+        The average time (in s) for each method.
+
+    '''
+    definition_dir=ESM_calibration.definition_dir
+    ESM_calibration.load()
+
+    start=time.perf_counter()
+    for i in range(num):
+        for table in ESM_calibration.tables:
+            pd.read_csv(os.path.join(definition_dir, table+'.csv'), dtype='float').to_dict('series')
+    csv_time=(time.perf_counter()-start)/num
+
+    start=time.perf_counter()
+    for i in range(num):
+        store=ESM_calibration_store(definition_dir)
+        for table in store.tables:
+            store.table(table)
+    store_time=(time.perf_counter()-start)/num
+
+    print ('reading {} calibration tables:'.format(len(ESM_calibration.tables)))
+    print ('    .csv files : {:.4f} s'.format(csv_time))
+    print ('    store file : {:.4f} s ({:.1f}x)'.format(store_time, csv_time/store_time))
+
+    return {'csv' : csv_time, 'store' : store_time}
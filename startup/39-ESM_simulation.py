@@ -0,0 +1,118 @@
+from ophyd import Device, Component as Cpt
+from ophyd.sim import SynAxis
+
+
+###SIMULATED DEVICES
+###    The following set of code is used to create simulated versions of the PGM and EPU devices, these are
+###    used to benchmark the motion plans without moving the beamline hardware.
+
+
+class ESM_sim_motor(SynAxis):
+    '''
+    A simulated motor whose move time is set by the distance travelled and the velocity.
+
+    The velocity (in units per second) is read from the 'velocity' component, the move time is multiplied
+    by the attribute 'time_scale' to allow benchmarks to run faster than the real hardware.
+
+    '''
+    time_scale=1.
+
+    def set(self, value):
+        velocity=self.velocity.get()
+        if velocity:
+            self.delay=abs(value-self.position)/velocity*self.time_scale
+        else:
+            self.delay=0
+        return super().set(value)
+
+    @property
+    def user_setpoint(self):
+        return self.setpoint
+
+
+class ESM_sim_gap(ESM_sim_motor):
+    '''
+    A simulated undulator gap with the same safety check as UgapPositioner.
+    '''
+    other=None
+
+    def safe_to_actuate(self):
+        if self.other is None:
+            return True
+        return self.other.position > 219
+
+
+class ESM_sim_PGM(Device):
+    Mirror_Pitch = Cpt(ESM_sim_motor, kind='hinted')
+    Grating_Pitch = Cpt(ESM_sim_motor, kind='hinted')
+    Grating_Trans = Cpt(ESM_sim_motor, kind='hinted')
+    Mirror_Pitch_off = Cpt(ESM_sim_motor, kind='config')
+    Grating_Pitch_off = Cpt(ESM_sim_motor, kind='config')
+    Grating_lines = Cpt(ESM_sim_motor, kind='config')
+    Mirror_Pitch_kill = Cpt(ESM_sim_motor, kind='omitted')
+    Grating_Pitch_kill = Cpt(ESM_sim_motor, kind='omitted')
+    Energy = Cpt(ESM_sim_motor, kind='hinted')
+
+
+class ESM_sim_M3(Device):
+    Mirror_Pitch = Cpt(ESM_sim_motor, kind='hinted')
+
+
+class ESM_sim_EPU(Device, EPU_polarization_planner):
+    gap = Cpt(ESM_sim_gap, kind='hinted')
+    phase = Cpt(ESM_sim_motor, kind='hinted')
+
+
+def ESM_sim_devices(pitch_velocity=0.5, gap_velocity=1., phase_velocity=1., time_scale=1.):
+    '''
+    Creates a simulated set of the devices used by Eph.move_to_point.
+
+    The offset, line density, kill, grating translation and M3 axes move instantly, the pitches, gap and
+    phase move at the given velocities. Both undulator gaps start fully open (220 mm).
+
+    PARAMETERS
+    ----------
+
+    pitch_velocity : float, optional
+        The velocity of the M2 and grating pitch in deg/s.
+
+    gap_velocity, phase_velocity : float, optional
+        The velocity of the undulator gap and phase in mm/s.
+
+    time_scale : float, optional
+        The factor used to multiply all of the move times.
+
+    devices : dict, output
+        The simulated devices under the keywords 'PGM', 'M3', 'EPU57' and 'EPU105'.
+
+    '''
+    pgm=ESM_sim_PGM(name='sim_PGM')
+    m3=ESM_sim_M3(name='sim_M3')
+    epu57=ESM_sim_EPU(name='sim_EPU57')
+    epu105=ESM_sim_EPU(name='sim_EPU105')
+
+    epu57.gap.other=epu105.gap
+    epu105.gap.other=epu57.gap
+    epu57.period=57.
+    epu105.period=105.
+
+    for epu in (epu57, epu105):
+        epu.gap.velocity.put(0)
+        epu.gap.set(220.)
+
+    for motor in (pgm.Mirror_Pitch_off, pgm.Grating_Pitch_off, pgm.Grating_lines, pgm.Mirror_Pitch_kill,
+                  pgm.Grating_Pitch_kill, pgm.Grating_Trans, m3.Mirror_Pitch):
+        motor.velocity.put(0)
+
+    for motor in (pgm.Mirror_Pitch, pgm.Grating_Pitch, pgm.Energy):
+        motor.velocity.put(pitch_velocity)
+
+    for epu in (epu57, epu105):
+        epu.gap.velocity.put(gap_velocity)
+        epu.phase.velocity.put(phase_velocity)
+
+    for motor in (pgm.Mirror_Pitch, pgm.Grating_Pitch, pgm.Grating_Trans, pgm.Energy, m3.Mirror_Pitch,
+                  epu57.gap, epu57.phase, epu105.gap, epu105.phase):
+        motor.time_scale=time_scale
+
+    return {'PGM' : pgm, 'M3' : m3, 'EPU57' : epu57, 'EPU105' : epu105}
@@ -0,0 +1,461 @@
+import time
+import numpy as np
+from ophyd import Signal
+from bluesky.plan_stubs import abs_set, mv, wait, sleep, monitor, unmonitor, create, read, save
+from bluesky.preprocessors import stage_decorator, run_decorator, finalize_wrapper
+from bluesky.utils import short_uid
+
+
+###FLY SCANS
+###   These scans move the photon energy continuously at a set velocity while the detectors are
+###   streamed, the undulator gap follows the photon energy using the compiled Eph gap tables.
+
+
+def _fly_hinted_signals(detector):
+    '''
+    Returns the signals of a detector that correspond to the hinted fields.
+
+    PARAMETERS
+    ----------
+
+    detector : Device
+        The detector to return the signals for.
+
+    signals : list, output
+        The list of signals, in the order of detector.hints['fields'].
+
+    '''
+    signals_dict={}
+    for walk in detector.walk_signals():
+        signals_dict[walk.item.name]=walk.item
+
+    return [signals_dict[field] for field in detector.hints.get('fields', []) if field in signals_dict]
+
+
+def fly_energy(detectors, start, end, velocity, grating='800', branch='A', EPU='57', LP='LH',
+               gap_deadband=0.05, poll_time=0.1, devices=None, md=None):
+    '''
+    Moves the photon energy continuously from start to end, the undulator gap follows the photon energy.
+
+    The monochromator and undulator are first set to the start energy (using Eph.move_to_point), then the
+    PGM energy is moved to the end energy at the given velocity. While it moves the PGM energy readback
+    is used to calculate the undulator gap (using the compiled Eph gap tables), a new gap is only sent
+    once the previous gap move has finished and if it differs by more than gap_deadband. The hinted
+    detector signals and the PGM energy readback are monitored (saved as seperate streams with their
+    timestamps), at the end of the motion the detector readings are mapped to photon energy by
+    interpolating the PGM energy readback at the detector timestamps and written to the 'primary' stream.
+
+    Any QuadEM type detectors (with an 'acquire_mode' signal) are switched to continuous acquisition
+    during the motion.
+
+    PARAMETERS
+    ----------
+
+    detectors : list
+        The list of detectors to stream.
+
+    start, end : float
+        The start and end photon energies in eV.
+
+    velocity : float
+        The velocity of the PGM energy in eV/s.
+
+    grating, branch, EPU : str, optional
+        The values passed to Eph.energy_table, if EPU is None the undulator is not moved.
+
+    LP : str, optional
+        The polarization, can be 'LH' (default) or 'LV'.
+
+    gap_deadband : float, optional
+        The minimum change in undulator gap (in mm) that results in a new gap move.
+
+    poll_time : float, optional
+        The time (in s) between updates of the undulator gap.
+
+    devices : dict, optional
+        The devices to move, under the keywords 'PGM' and 'EPU', see Eph.move_to_point.
+
+    md : dict, optional
+        The metadata for the run.
+
+    uid : str, output
+        The unique id of the run.
+
+    '''
+    gap_functions = {'LH' : Eph.Und_e2g, 'LV' : Eph.Und_e2g_LV}
+    if not EPU == None and LP not in gap_functions:
+        raise RuntimeError("LP entry needs to be 'LH' or 'LV' for a fly scan")
+
+    # calculate (and range check) the values for the start and end energies.
+    table = Eph.energy_table([start, end], grating=grating, branch=branch, EPU=EPU, LP=LP)
+
+    if devices is None:
+        devices = {}
+    PGM_dev = devices['PGM'] if 'PGM' in devices else PGM
+    if EPU is None:
+        EPU_dev = None
+    elif 'EPU' in devices:
+        EPU_dev = devices['EPU']
+    else:
+        EPU_dev = ip.user_ns['EPU'+EPU]
+
+    energy_signal = getattr(PGM_dev.Energy, 'user_readback', None) or PGM_dev.Energy.readback
+    detector_signals = []
+    for detector in detectors:   detector_signals += _fly_hinted_signals(detector)
+    if not detector_signals:
+        raise RuntimeError('none of the detectors have any hinted fields to stream')
+
+    # collect the streamed values (with their timestamps) for mapping to photon energy.
+    samples = {signal.name : [] for signal in [energy_signal] + detector_signals}
+
+    def collect(value, timestamp, obj, **kwargs):
+        samples[obj.name].append((timestamp, value))
+
+    old_velocity = PGM_dev.Energy.velocity.get()
+    old_modes = {detector : detector.acquire_mode.get() for detector in detectors
+                 if hasattr(detector, 'acquire_mode')}
+    subscriptions = []
+
+    #setup standard metadata
+    X_axis = [energy_signal.name]
+    Y_axis = [signal.name for signal in detector_signals]
+    _md = {'scan_name':'fly_energy','plot_Xaxis':X_axis,'plot_Yaxis':Y_axis,'velocity':velocity,
+           'start':start,'end':end,'grating':grating,'branch':branch,'EPU':EPU,'LP':LP,
+           'detectors':[detector.name for detector in detectors],'motors':[PGM_dev.Energy.name],
+           'plan_name':'fly_energy'}
+    _md.update(md or {})
+
+    def fly_motion():
+        # move to the start energy at the current velocity.
+        yield from Eph.move_to_point(table.iloc[0], devices=devices)
+        yield from mv(PGM_dev.Energy, start)
+
+        for signal in [energy_signal] + detector_signals:
+            subscriptions.append((signal, signal.subscribe(collect, run=True)))
+            yield from monitor(signal, name=signal.name+'_monitor')
+
+        for detector in old_modes:
+            yield from mv(detector.acquire_mode, 'Continuous')
+            yield from abs_set(detector.acquire, 1)
+
+        yield from mv(PGM_dev.Energy.velocity, velocity)
+
+        fly_group = short_uid('fly')
+        gap_group = short_uid('gap')
+        status = yield from abs_set(PGM_dev.Energy, end, group=fly_group)
+        gap_status = None
+        last_gap = table['Gap'].iloc[0]
+
+        # update the undulator gap while the energy moves.
+        while status is not None and not status.done:
+            if EPU_dev is not None and (gap_status is None or gap_status.done):
+                energy = np.clip(PGM_dev.Energy.position, min(start, end), max(start, end))
+                gap = gap_functions[LP](energy, EPU=EPU)
+                if abs(gap - last_gap) > gap_deadband:
+                    gap_status = yield from abs_set(EPU_dev.gap, gap, group=gap_group)
+                    last_gap = gap
+            yield from sleep(poll_time)
+
+        yield from wait(fly_group)
+        yield from wait(gap_group)
+        if EPU_dev is not None:
+            yield from mv(EPU_dev.gap, table['Gap'].iloc[1])
+
+        for detector in old_modes:
+            yield from mv(detector.acquire, 0)
+
+        for signal in [energy_signal] + detector_signals:
+            yield from unmonitor(signal)
+
+    def restore():
+        # restore the velocity and acquisition modes and remove the subscriptions.
+        for signal, cid in subscriptions:
+            signal.unsubscribe(cid)
+        subscriptions.clear()
+        yield from mv(PGM_dev.Energy.velocity, old_velocity)
+        for detector, mode in old_modes.items():
+            yield from mv(detector.acquire, 0)
+            yield from mv(detector.acquire_mode, mode)
+
+    def write_primary():
+        # map the detector readings to photon energy and write them to the primary stream.
+        energy_samples = np.array(samples[energy_signal.name], dtype=float).reshape(-1, 2)
+        grid_samples = np.array(samples[detector_signals[0].name], dtype=float).reshape(-1, 2)
+        if len(energy_samples) < 2 or not len(grid_samples):
+            print('fly_energy: not enough streamed values to map to photon energy')
+            return
+
+        energy_samples = energy_samples[np.argsort(energy_samples[:, 0])]
+        timestamps = grid_samples[:, 0]
+        timestamps = timestamps[(timestamps >= energy_samples[0, 0]) & (timestamps <= energy_samples[-1, 0])]
+
+        soft_energy = Signal(name=energy_signal.name, kind='hinted')
+        soft_detectors = []
+        for signal in detector_signals:
+            values = np.array(samples[signal.name], dtype=float).reshape(-1, 2)
+            if len(values):
+                soft_detectors.append((Signal(name=signal.name, kind='hinted'),
+                                       np.interp(timestamps, values[:, 0], values[:, 1])))
+
+        energies = np.interp(timestamps, energy_samples[:, 0], energy_samples[:, 1])
+        for i, timestamp in enumerate(timestamps):
+            soft_energy.put(energies[i], timestamp=timestamp)
+            yield from create('primary')
+            yield from read(soft_energy)
+            for soft_signal, values in soft_detectors:
+                soft_signal.put(values[i], timestamp=timestamp)
+                yield from read(soft_signal)
+            yield from save()
+
+    @stage_decorator(detectors)
+    @run_decorator(md=_md)
+    def fly_core():
+        yield from finalize_wrapper(fly_motion(), restore())
+        yield from write_primary()
+
+    return (yield from fly_core())
+
+
+def fly_scan_1D(DETS_str, start, end, velocity, grating='800', branch='A', EPU='57', LP='LH', scan_type=None,
+                gap_deadband=0.05, poll_time=0.1):
+    '''
+    Continuous photon energy scan taking a list of detectors, the fly scan equivalent of
+    scan_1D(DETS_str, PGM.Energy, start, end, step_size).
+
+    The undulator gap follows the photon energy during the scan, see fly_energy for details. The run
+    includes the same 'plot_Xaxis' and 'plot_Yaxis' metadata as scan_1D.
+
+    PARAMETERS
+    ----------
+    DETS_str : str
+        The input string that is to be "unpacked" into a channel list, see scan_1D for the format.
+
+    start : number
+        The start photon energy in eV.
+
+    end : number
+        The end photon energy in eV.
+
+    velocity : number
+        The velocity of the PGM energy in eV/s, eg. a 630 eV range at 2 eV/s takes ~5 minutes.
+
+    grating, branch, EPU, LP : str, optional
+        The grating, branch, undulator and polarization to use, see Eph.move_to.
+
+    scan_type : string, optional
+        Optional definition of the scan type to include in the metadata.
+
+    gap_deadband : float, optional
+        The minimum change in undulator gap (in mm) that results in a new gap move.
+
+    poll_time : float, optional
+        The time (in s) between updates of the undulator gap.
+
+    uid : str, output
+        The unique id of the run.
+
+     '''
+
+    #change the "hints" on the detectors so that only the relevant info is included in LivePlot
+    #and LiveTable
+    DETS=ESM_setup_hints(DETS_str)
+    detectors=[]
+    for DET in DETS.split(','): detectors.append(ip.user_ns[DET])
+
+    #setup standard metadata
+    _md = {'scan_name':'fly_scan_1D','scan_type':scan_type}
+
+    #run the scan
+    uid=yield from fly_energy(detectors, start, end, velocity, grating=grating, branch=branch, EPU=EPU, LP=LP,
+                              gap_deadband=gap_deadband, poll_time=poll_time, md=_md)
+
+    #change the "hints" on the detectors back to the default
+    DETS=ESM_setup_hints(DETS+',@-1')
+    return uid
+
+
+def _fly_signal_name(motor, attrs, suffix):
+    '''
+    Returns the name of the first signal of a motor found in attrs, or the motor name plus suffix.
+    '''
+    for attr in attrs:
+        if hasattr(motor, attr):
+            return getattr(motor, attr).name
+    return motor.name+suffix
+
+
+def fly_map(detectors, fast_motor, fast_start, fast_stop, fast_num, slow_motor, slow_start, slow_stop, slow_num,
+            velocity, snake=True, md=None):
+    '''
+    Maps a 2D region, moving the fast motor continuously along each line while the detectors are streamed.
+
+    For each line the slow motor is moved to its value and the fast motor is moved (at its normal velocity)
+    to half a pixel before the first pixel, it is then moved at the given velocity to half a pixel after
+    the last pixel. The hinted detector signals and the fast motor readback are monitored (saved as
+    seperate streams with their timestamps). At the end of the map each detector reading is assigned a
+    fast motor position by interpolating the readback at the detector timestamps, and the readings are
+    averaged into fast_num pixels per line. The 'primary' stream contains one event per pixel, in the
+    same order as a (non snake) step scan, with the pixel centre as the fast motor setpoint and the mean
+    position as its readback. Pixels without any readings are recorded as NaN.
+
+    Any QuadEM type detectors (with an 'acquire_mode' signal) are switched to continuous acquisition
+    during the map, the velocity should be chosen so that there are several readings per pixel (ie.
+    velocity < pixel size * sample rate).
+
+    PARAMETERS
+    ----------
+
+    detectors : list
+        The list of detectors to stream.
+
+    fast_motor, slow_motor : motor
+        The motor moved continuously along each line and the motor stepped between lines.
+
+    fast_start, fast_stop, slow_start, slow_stop : float
+        The centres of the first and last pixels along each axis.
+
+    fast_num, slow_num : int
+        The number of pixels along each axis, fast_num must be at least 2.
+
+    velocity : float
+        The velocity of the fast motor (in units/s) while mapping.
+
+    snake : boolean, optional
+        If True (default) every second line is mapped from fast_stop to fast_start.
+
+    md : dict, optional
+        The metadata for the run.
+
+    uid : str, output
+        The unique id of the run.
+
+    '''
+    if fast_num < 2:
+        raise RuntimeError('a fly map needs at least 2 pixels along the fast axis')
+
+    fast_values = np.linspace(fast_start, fast_stop, fast_num)
+    slow_values = np.linspace(slow_start, slow_stop, slow_num)
+    step = (fast_stop - fast_start) / (fast_num - 1)
+
+    fast_readback = getattr(fast_motor, 'user_readback', None) or fast_motor.readback
+    detector_signals = []
+    for detector in detectors:   detector_signals += _fly_hinted_signals(detector)
+    if not detector_signals:
+        raise RuntimeError('none of the detectors have any hinted fields to stream')
+
+    # collect the streamed values (with their timestamps) for binning into pixels.
+    samples = {signal.name : [] for signal in [fast_readback] + detector_signals}
+
+    def collect(value, timestamp, obj, **kwargs):
+        samples[obj.name].append((timestamp, value))
+
+    # the slow motor value and position, and the start and end time of each line.
+    lines = []
+
+    old_velocity = fast_motor.velocity.get()
+    old_modes = {detector : detector.acquire_mode.get() for detector in detectors
+                 if hasattr(detector, 'acquire_mode')}
+    subscriptions = []
+
+    #setup standard metadata
+    _md = {'plan_name':'fly_map','detectors':[detector.name for detector in detectors],
+           'motors':[slow_motor.name, fast_motor.name],'fly_velocity':velocity,'snake':snake,
+           'num_points':fast_num*slow_num,
+           'hints':{'dimensions':[(slow_motor.hints['fields'], 'primary'), (fast_motor.hints['fields'], 'primary')]}}
+    _md.update(md or {})
+
+    def fly_lines():
+        for signal in [fast_readback] + detector_signals:
+            subscriptions.append((signal, signal.subscribe(collect, run=False)))
+            yield from monitor(signal, name=signal.name+'_monitor')
+
+        for detector in old_modes:
+            yield from mv(detector.acquire_mode, 'Continuous')
+            yield from abs_set(detector.acquire, 1)
+
+        for i, slow_value in enumerate(slow_values):
+            line_start, line_end = fast_start - step/2, fast_stop + step/2
+            if snake and i%2 == 1:
+                line_start, line_end = line_end, line_start
+
+            # move to the start of the line at the normal velocity.
+            yield from mv(fast_motor.velocity, old_velocity)
+            yield from mv(slow_motor, slow_value, fast_motor, line_start)
+            yield from mv(fast_motor.velocity, velocity)
+
+            line_t0 = time.time()
+            samples[fast_readback.name].append((line_t0, fast_motor.position))
+            yield from mv(fast_motor, line_end)
+            line_t1 = time.time()
+            samples[fast_readback.name].append((line_t1, fast_motor.position))
+
+            lines.append((slow_value, slow_motor.position, line_t0, line_t1))
+
+        for detector in old_modes:
+            yield from mv(detector.acquire, 0)
+
+        for signal in [fast_readback] + detector_signals:
+            yield from unmonitor(signal)
+
+    def restore():
+        # restore the velocity and acquisition modes and remove the subscriptions.
+        for signal, cid in subscriptions:
+            signal.unsubscribe(cid)
+        subscriptions.clear()
+        yield from mv(fast_motor.velocity, old_velocity)
+        for detector, mode in old_modes.items():
+            yield from mv(detector.acquire, 0)
+            yield from mv(detector.acquire_mode, mode)
+
+    def write_primary():
+        # bin the detector readings into pixels and write them to the primary stream.
+        readback = np.array(samples[fast_readback.name], dtype=float).reshape(-1, 2)
+        readback = readback[np.argsort(readback[:, 0])]
+        streams = {signal.name : np.array(samples[signal.name], dtype=float).reshape(-1, 2)
+                   for signal in detector_signals}
+
+        soft_signals = {name : Signal(name=name, kind='hinted') for name in
+                        [fast_readback.name, _fly_signal_name(fast_motor, ['user_setpoint', 'setpoint'], '_setpoint'),
+                         _fly_signal_name(slow_motor, ['user_readback', 'readback'], ''),
+                         _fly_signal_name(slow_motor, ['user_setpoint', 'setpoint'], '_setpoint')]
+                        + [signal.name for signal in detector_signals]}
+        fast_rb, fast_sp, slow_rb, slow_sp = list(soft_signals.values())[:4]
+
+        empty = 0
+        for slow_value, slow_position, line_t0, line_t1 in lines:
+            pixels = {}
+            for name, values in streams.items():
+                values = values[(values[:, 0] >= line_t0) & (values[:, 0] <= line_t1)]
+                position = np.interp(values[:, 0], readback[:, 0], readback[:, 1])
+                index = np.rint((position - fast_start) / step).astype(int)
+                inside = (index >= 0) & (index < fast_num)
+                counts = np.bincount(index[inside], minlength=fast_num)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    pixels[name] = np.bincount(index[inside], weights=values[inside, 1], minlength=fast_num)/counts
+                    if name == detector_signals[0].name:
+                        empty += int(np.sum(counts == 0))
+                        positions = np.bincount(index[inside], weights=position[inside], minlength=fast_num)/counts
+                        times = np.bincount(index[inside], weights=values[inside, 0], minlength=fast_num)/counts
+
+            times = np.where(np.isnan(times), line_t0, times)
+            for j, fast_value in enumerate(fast_values):
+                for signal, value in ((fast_rb, positions[j]), (fast_sp, fast_value), (slow_rb, slow_position),
+                                      (slow_sp, slow_value)):
+                    signal.put(value, timestamp=times[j])
+                for name, values in pixels.items():
+                    soft_signals[name].put(values[j], timestamp=times[j])
+                yield from create('primary')
+                for signal in soft_signals.values():
+                    yield from read(signal)
+                yield from save()
+
+        if empty:
+            print('fly_map: '+str(empty)+' pixels without any detector readings, reduce the velocity')
+
+    @stage_decorator(detectors)
+    @run_decorator(md=_md)
+    def fly_core():
+        yield from finalize_wrapper(fly_lines(), restore())
+        yield from write_primary()
+
+    return (yield from fly_core())
@@ -0,0 +1,596 @@
+import time
+import itertools
+import numpy as np
+from collections import defaultdict
+from bluesky.plan_stubs import one_nd_step
+from bluesky.preprocessors import stage_decorator, run_decorator
+
+
+###SCAN PATHS
+###   The following set of code is used to generate the paths (the ordered list of points) followed by 2D
+###   scans as numpy arrays, and to run a scan over such a path. The paths are generated without any per
+###   point python loops, so that dense maps (up to ~10^6 points) are generated in milliseconds.
+
+
+def ESM_square_spiral_path(x_centre, y_centre, x_range, y_range, x_num, y_num):
+    '''
+    Returns the points of a square spiral, centered around (x_centre, y_centre), see spiral_square.
+
+    The points are in the same order as the original spiral_square_pattern, starting from the centre and
+    going around each ring starting from its low x, low y corner. Points outside of the x_range by y_range
+    box are skipped, the test is done on the integer grid positions. NOTE: this is a change in behaviour,
+    the original implementation compared the floating point positions to the box edges and, for some
+    parameters (eg. x_num=10, y_num=11, x_range=1, y_range=2 gives 120 instead of 118 points), dropped
+    points on the edge of the box due to rounding. Those edge points are now included, the other points
+    are unchanged and in the same order.
+
+    PARAMETERS
+    ----------
+
+    x_centre, y_centre : float
+        The centre of the spiral.
+
+    x_range, y_range : float
+        The x and y widths of the spiral.
+
+    x_num : int
+        The number of x axis points.
+
+    y_num : int
+        The number of y axis points, it must be even if x_num is even and odd if x_num is odd, if not it is
+        increased by 1 to ensure this.
+
+    points : numpy.array, output
+        A (number of points) x 2 array with the x values in column 0 and the y values in column 1.
+
+    '''
+    if x_num%2==0:
+        num_st=2
+        offset=0.5
+        if y_num%2==1:
+            y_num+=1
+    else:
+        num_st=1
+        offset=0.
+        if y_num%2==0:
+            y_num+=1
+
+    delta_x = x_range/(x_num-1)
+    delta_y = y_range/(y_num-1)
+
+    # the half width of each ring and the number of points on each of its 4 sides (in grid units).
+    rings=np.arange(num_st, max(x_num,y_num)+1, 2)
+    half=np.arange(len(rings))+offset
+    side=rings-1
+
+    # each side is a (ring, side) block of points, with k the step along the side.
+    edges=np.repeat(np.arange(4*len(rings)), np.repeat(side, 4))
+    k=np.arange(len(edges))-np.repeat(np.cumsum(np.repeat(side, 4))-np.repeat(side, 4), np.repeat(side, 4))
+    ring, edge=np.divmod(edges, 4)
+    h=half[ring]
+
+    # the corner each side starts from (in units of h) and its direction (per step k).
+    ix=np.array([-1., 1., 1., -1.])[edge]*h+np.array([1., 0., -1., 0.])[edge]*k
+    iy=np.array([-1., -1., 1., 1.])[edge]*h+np.array([0., 1., 0., -1.])[edge]*k
+
+    inside=(np.abs(ix) <= (x_num-1)/2) & (np.abs(iy) <= (y_num-1)/2)
+    ix, iy=ix[inside], iy[inside]
+    if num_st==1:
+        ix, iy=np.concatenate(([0.], ix)), np.concatenate(([0.], iy))
+
+    return np.column_stack((x_centre+delta_x*ix, y_centre+delta_y*iy))
+
+
+def ESM_raster_path(x_start, x_end, x_num, y_start, y_end, y_num, snake=True):
+    '''
+    Returns the points of a raster, with x as the fast axis and y as the slow axis.
+
+    PARAMETERS
+    ----------
+
+    x_start, x_end, y_start, y_end : float
+        The start and end values of each axis.
+
+    x_num, y_num : int
+        The number of points along each axis.
+
+    snake : boolean, optional
+        If True (default) every second line is scanned from x_end to x_start.
+
+    points : numpy.array, output
+        A (x_num*y_num) x 2 array with the x values in column 0 and the y values in column 1.
+
+    '''
+    x=np.tile(np.linspace(x_start, x_end, x_num), (y_num, 1))
+    if snake:
+        x[1::2]=x[1::2, ::-1]
+    y=np.repeat(np.linspace(y_start, y_end, y_num), x_num)
+
+    return np.column_stack((x.ravel(), y))
+
+
+def ESM_fermat_path(x_centre, y_centre, x_range, y_range, dr, factor):
+    '''
+    Returns the points of a Fermat spiral, centered around (x_centre, y_centre), with the same points as
+    bluesky.plans.spiral_fermat.
+
+    PARAMETERS
+    ----------
+
+    x_centre, y_centre : float
+        The centre of the spiral.
+
+    x_range, y_range : float
+        The x and y widths of the spiral.
+
+    dr : float
+        The delta radius.
+
+    factor : float
+        The radius is divided by this value.
+
+    points : numpy.array, output
+        A (number of points) x 2 array with the x values in column 0 and the y values in column 1.
+
+    '''
+    phi = 137.508 * np.pi / 180.0
+    half_x, half_y = x_range/2, y_range/2
+
+    num_rings = int((1.5 * np.sqrt(half_x**2 + half_y**2) / (dr / factor)) ** 2)
+    i_ring = np.arange(1, num_rings)
+    radius = np.sqrt(i_ring) * dr / factor
+    x = radius*np.cos(phi*i_ring)
+    y = radius*np.sin(phi*i_ring)
+
+    inside = (np.abs(x) <= half_x) & (np.abs(y) <= half_y)
+    return np.column_stack((x_centre+x[inside], y_centre+y[inside]))
+
+
+def ESM_hilbert_path(x_start, x_end, y_start, y_end, order):
+    '''
+    Returns the points of a Hilbert curve covering a 2**order by 2**order grid, consecutive points are
+    always neighbours on the grid so the motors only ever make single steps.
+
+    PARAMETERS
+    ----------
+
+    x_start, x_end, y_start, y_end : float
+        The start and end values of each axis.
+
+    order : int
+        The order of the curve, the grid has 2**order points along each axis (eg. order=10 gives ~10^6
+        points).
+
+    points : numpy.array, output
+        A (4**order) x 2 array with the x values in column 0 and the y values in column 1.
+
+    '''
+    # each order is made of 4 copies of the previous order, transposed or reflected to join up.
+    ix=np.zeros(1)
+    iy=np.zeros(1)
+    for i in range(order):
+        s=2**i
+        ix, iy=(np.concatenate((iy, ix, ix+s, 2*s-1-iy)),
+                np.concatenate((ix, iy+s, iy+s, s-1-ix)))
+    n=2**order
+
+    delta_x=(x_end-x_start)/(n-1) if n > 1 else 0.
+    delta_y=(y_end-y_start)/(n-1) if n > 1 else 0.
+    return np.column_stack((x_start+delta_x*ix, y_start+delta_y*iy))
+
+
+def ESM_grid_points(*values, mask=None):
+    '''
+    Returns the points of a grid (the outer product of the values for each axis), optionally keeping only
+    the points selected by a mask.
+
+    PARAMETERS
+    ----------
+
+    *values : arrays
+        The values along each axis, the first axis changes fastest (eg. x_values, y_values for a raster
+        with x as the fast axis).
+
+    mask : array, optional
+        A boolean array selecting the points to keep, with the axes in reverse order (eg. mask[iy, ix] for
+        a 2D grid, like an image). The default (None) keeps all of the points.
+
+    points : numpy.array, output
+        A (number of points) x (number of axes) array with the values of axis i in column i.
+
+    '''
+    grids=np.meshgrid(*[np.asarray(value, dtype=float) for value in values[::-1]], indexing='ij')
+    points=np.column_stack([grid.ravel() for grid in grids[::-1]])
+    if mask is not None:
+        points=points[np.asarray(mask, dtype=bool).ravel()]
+    return points
+
+
+def ESM_region_points(regions):
+    '''
+    Returns the points of a list of rectangular regions of interest, points shared by overlapping regions
+    are only included once.
+
+    PARAMETERS
+    ----------
+
+    regions : list
+        A list of (x_start, x_end, x_num, y_start, y_end, y_num) tuples, one for each region.
+
+    points : numpy.array, output
+        A (number of points) x 2 array with the x values in column 0 and the y values in column 1.
+
+    '''
+    points=np.concatenate([ESM_raster_path(*region, snake=False) for region in regions])
+    _, index=np.unique(points, axis=0, return_index=True)
+    return points[np.sort(index)]
+
+
+###TRAVEL TIME OPTIMIZED PATHS
+###   The following set of code is used to order an arbitrary set of points so that the total time taken
+###   to move between them is minimized, using the velocity, acceleration and backlash of each axis. The
+###   axes move concurrently, so the time for each move is that of the slowest axis.
+
+
+def ESM_axis_parameters(motor, velocity=None, acceleration=None, backlash=None):
+    '''
+    Returns the motion parameters of an axis, used by ESM_move_times.
+
+    Any parameter not given is read from the motor if it has the matching signal ('velocity' in units/s
+    and 'acceleration' as the time in s taken to reach the velocity, as for an EpicsMotor), otherwise the
+    defaults of 1 unit/s, an instant acceleration and no backlash are used.
+
+    PARAMETERS
+    ----------
+
+    motor : object
+        The motor (or any 'setable' object).
+
+    velocity : float, optional
+        The velocity in units/s.
+
+    acceleration : float, optional
+        The acceleration in units/s^2.
+
+    backlash : float, optional
+        The backlash distance, moves in the opposite direction to its sign overshoot the target by this
+        distance and then return to it.
+
+    parameters : dict, output
+        A dictionary with the keys 'velocity', 'acceleration' and 'backlash'.
+
+    '''
+    def read(name):
+        try:
+            return float(getattr(motor, name).get())
+        except Exception:
+            return None
+
+    if velocity is None:
+        velocity=read('velocity') or 1.
+    if acceleration is None:
+        acceleration_time=read('acceleration')
+        acceleration=velocity/acceleration_time if acceleration_time else np.inf
+    if backlash is None:
+        backlash=0.
+
+    return {'velocity' : velocity, 'acceleration' : acceleration, 'backlash' : backlash}
+
+
+def _axis_move_time(distance, velocity, acceleration):
+    '''
+    Returns the time taken to move a distance with a trapezoidal (or triangular) velocity profile.
+    '''
+    if np.isinf(acceleration):
+        return distance/velocity
+    ramp=velocity**2/acceleration
+    return np.where(distance < ramp, 2*np.sqrt(distance/acceleration), distance/velocity+velocity/acceleration)
+
+
+def ESM_move_times(starts, ends, axes):
+    '''
+    Returns the time taken to move from each start point to each end point.
+
+    PARAMETERS
+    ----------
+
+    starts, ends : numpy.array
+        The start and end points, as (number of moves) x (number of axes) arrays or single points.
+
+    axes : list
+        The motion parameters of each axis, see ESM_axis_parameters.
+
+    times : numpy.array, output
+        The time of each move in s.
+
+    '''
+    delta=np.asarray(ends, dtype=float)-np.asarray(starts, dtype=float)
+    times=np.zeros(delta.shape[:-1])
+    for i, axis in enumerate(axes):
+        distance=np.abs(delta[..., i])
+        backlash=axis.get('backlash', 0.)
+        time=_axis_move_time(distance, axis['velocity'], axis['acceleration'])
+        if backlash:
+            against=np.sign(delta[..., i])==-np.sign(backlash)
+            time=np.where(against, _axis_move_time(distance+abs(backlash), axis['velocity'],
+                                                   axis['acceleration'])
+                          +_axis_move_time(abs(backlash), axis['velocity'], axis['acceleration']), time)
+        times=np.maximum(times, time)
+    return times
+
+
+def ESM_path_time(points, axes, start=None):
+    '''
+    Returns the total time taken to move through the points in order, see ESM_move_times.
+
+    PARAMETERS
+    ----------
+
+    points : numpy.array
+        The points, as a (number of points) x (number of axes) array.
+
+    axes : list
+        The motion parameters of each axis, see ESM_axis_parameters.
+
+    start : list, optional
+        The starting position of the axes, the default (None) starts at the first point.
+
+    time : float, output
+        The total move time in s.
+
+    '''
+    points=np.asarray(points, dtype=float)
+    if start is not None:
+        points=np.concatenate(([start], points))
+    return float(ESM_move_times(points[:-1], points[1:], axes).sum())
+
+
+def _snake_orders(points):
+    '''
+    Returns the snake orders (a raster with the direction reversed on alternate lines) of a set of grid
+    points, one for each choice of the fast axis and of the starting direction along each axis.
+    '''
+    indices=np.column_stack([np.unique(column, return_inverse=True)[1].ravel() for column in points.T])
+    ndim=points.shape[1]
+    orders=[]
+    for fast in range(ndim):
+        # the axes from the slowest to the fastest.
+        axes=[axis for axis in range(ndim) if axis != fast][::-1]+[fast]
+        for signs in itertools.product((1, -1), repeat=ndim):
+            keys=[]
+            line=np.zeros(len(points), dtype=int)
+            for axis in axes:
+                index=signs[axis]*indices[:, axis]
+                keys.append(np.where(line%2 == 0, index, -index))
+                line=np.unique(np.column_stack(keys), axis=0, return_inverse=True)[1].ravel()
+            orders.append(np.lexsort(keys[::-1]))
+    return orders
+
+
+def ESM_optimize_path(points, axes, start=None, max_passes=10, max_time=30.):
+    '''
+    Returns the order in which to visit a set of points that minimizes the total move time.
+
+    The fastest of a nearest neighbour tour (using the move times) and the snake orders of the points
+    (along each axis, starting from each corner) is improved by passes of 2-opt. The 2-opt passes use the
+    move time averaged over both directions (as reversing part of the path reverses the direction of its
+    moves), a pass that increases the real total time is undone, so the order is never slower than the
+    best snake order. The nearest neighbour tour takes ~(number of points)^2 operations, so it is
+    suitable for up to ~10^4 points (~5 s for 5000 points).
+
+    PARAMETERS
+    ----------
+
+    points : numpy.array
+        The points, as a (number of points) x (number of axes) array, eg. the output of ESM_grid_points.
+
+    axes : list
+        The motion parameters of each axis, see ESM_axis_parameters.
+
+    start : list, optional
+        The starting position of the axes (eg. the current motor positions), the default (None) starts at
+        the first point.
+
+    max_passes : int, optional
+        The maximum number of 2-opt passes.
+
+    max_time : float, optional
+        The maximum time (in s) spent on the 2-opt passes.
+
+    order : numpy.array, output
+        The indices of the points in the order they should be visited, ie. points[order] is the path.
+
+    '''
+    points=np.asarray(points, dtype=float)
+    if start is None:
+        nodes=points
+    else:
+        nodes=np.concatenate(([start], points))
+    num=len(nodes)
+
+    def cost(a, b):
+        return 0.5*(ESM_move_times(a, b, axes)+ESM_move_times(b, a, axes))
+
+    def total(tour):
+        return ESM_path_time(nodes[tour], axes)
+
+    # nearest neighbour tour starting from the first node.
+    tour=np.zeros(num, dtype=int)
+    visited=np.zeros(num, dtype=bool)
+    visited[0]=True
+    for i in range(1, num):
+        times=ESM_move_times(nodes[tour[i-1]], nodes, axes)
+        times[visited]=np.inf
+        tour[i]=np.argmin(times)
+        visited[tour[i]]=True
+
+    # the snake orders, which are close to optimal for a full grid, are compared to the nearest neighbour
+    # tour and the fastest is used to start the 2-opt passes.
+    offset=0 if start is None else 1
+    for order in _snake_orders(points):
+        snake=np.concatenate((np.arange(offset), order+offset))
+        if total(snake) < total(tour):
+            tour=snake
+
+    # 2-opt passes, with the first node fixed and an open end.
+    t_start=time.time()
+    best=total(tour)
+    for n_pass in range(max_passes):
+        previous=tour.copy()
+        improved=False
+        for i in range(num-2):
+            a, b=nodes[tour[i]], nodes[tour[i+1]]
+            c=nodes[tour[i+2:]]
+            d=nodes[tour[i+3:]]
+            delta=cost(a, c)-cost(a, b)
+            delta[:-1]+=cost(b, d)-cost(c[:-1], d)
+            j=np.argmin(delta)
+            if delta[j] < -1e-9:
+                tour[i+1:i+j+3]=tour[i+1:i+j+3][::-1]
+                improved=True
+            if time.time()-t_start > max_time:
+                break
+
+        new=total(tour)
+        if new > best:
+            tour=previous
+            break
+        best=new
+        if not improved or time.time()-t_start > max_time:
+            break
+
+    if start is None:
+        return tour
+    return tour[1:]-1
+
+
+def ESM_path_scan(detectors, motors, points, *, per_step=None, md=None):
+    '''
+    Scans the motors over a path given as an array, taking a reading of the detectors at each point.
+
+    This is the equivalent of scan_nd (with a cycler made of the columns of points) but the steps are
+    taken directly from the array, so no per point python objects are built in advance.
+
+    PARAMETERS
+    ----------
+
+    detectors : list
+        The list of 'readable' objects.
+
+    motors : list
+        The list of 'setable' objects, one for each column of points.
+
+    points : numpy.array
+        A (number of points) x (number of motors) array with the motor values at each point, eg. the output
+        of ESM_square_spiral_path.
+
+    per_step : callable, optional
+        Hook for customizing the action of the inner loop, see bluesky.plans.one_nd_step (the default).
+
+    md : dict, optional
+        The metadata for the run.
+
+    uid : str, output
+        The unique id of the run.
+
+    '''
+    points=np.asarray(points, dtype=float).reshape(len(points), -1)
+    if points.shape[1] != len(motors):
+        raise RuntimeError('points has '+str(points.shape[1])+' columns, for '+str(len(motors))+' motors')
+
+    _md = {'detectors': [detector.name for detector in detectors],
+           'motors': [motor.name for motor in motors],
+           'num_points': len(points),
+           'num_intervals': len(points) - 1,
+           'plan_args': {'detectors': list(map(repr, detectors)), 'motors': list(map(repr, motors)),
+                         'per_step': repr(per_step)},
+           'plan_name': 'ESM_path_scan',
+           'hints': {},
+           }
+    _md.update(md or {})
+    try:
+        dimensions = [(motor.hints['fields'], 'primary') for motor in motors]
+    except (AttributeError, KeyError):
+        pass
+    else:
+        _md['hints'].setdefault('dimensions', dimensions)
+
+    if per_step is None:
+        per_step = one_nd_step
+    pos_cache = defaultdict(lambda: None)
+
+    @stage_decorator(list(detectors) + list(motors))
+    @run_decorator(md=_md)
+    def inner_path_scan():
+        for row in points.tolist():
+            yield from per_step(detectors, dict(zip(motors, row)), pos_cache)
+
+    return (yield from inner_path_scan())
+
+
+def ESM_optimized_scan(detectors, motors, values, *, axis_parameters=None, mask=None, md=None):
+    '''
+    Scans the motors over a grid, visiting the points in the order that minimizes the total move time.
+
+    The order is found with ESM_optimize_path, starting from the current motor positions, and the scan is
+    run with ESM_path_scan. The order is found when the plan starts (a message is printed as it can take
+    several seconds for large grids).
+
+    As the events are not in raster order the start document includes 'grid_shape' (the number of values
+    for each motor) and 'grid_index' (the raster index of each point, in the order they are visited, with
+    the first motor changing fastest as for ESM_grid_points), the values for each point are found with
+    np.unravel_index(grid_index, grid_shape[::-1]).
+
+    PARAMETERS
+    ----------
+
+    detectors : list
+        The list of 'readable' objects.
+
+    motors : list
+        The list of 'setable' objects.
+
+    values : list
+        The values for each motor, see ESM_grid_points.
+
+    axis_parameters : list, optional
+        A list of dictionaries (one for each motor) overriding the 'velocity', 'acceleration' or
+        'backlash' of each motor, see ESM_axis_parameters. The default (None) reads them from the motors.
+
+    mask : array, optional
+        A boolean array selecting the grid points to include, see ESM_grid_points.
+
+    md : dict, optional
+        The metadata for the run.
+
+    uid : str, output
+        The unique id of the run.
+
+    '''
+    points=ESM_grid_points(*values, mask=mask)
+    axes=[ESM_axis_parameters(motor, **(parameters or {}))
+          for motor, parameters in zip(motors, axis_parameters or [None]*len(motors))]
+    try:
+        start=[float(motor.position) for motor in motors]
+    except Exception:
+        start=None
+
+    print ('Optimizing the order of the '+str(len(points))+' scan points ...')
+    t_start=time.time()
+    order=ESM_optimize_path(points, axes, start=start)
+    move_time=ESM_path_time(points[order], axes, start=start)
+    print ('    done in {:.1f} s, the predicted move time is {:.1f} s'.format(time.time()-t_start, move_time))
+
+    grid_index=np.arange(np.prod([len(value) for value in values]))
+    if mask is not None:
+        grid_index=grid_index[np.asarray(mask, dtype=bool).ravel()]
+
+    _md = {'plan_name': 'ESM_optimized_scan',
+           'axis_parameters': {motor.name: axis for motor, axis in zip(motors, axes)},
+           'predicted_move_time': move_time,
+           'grid_shape': [len(value) for value in values],
+           'grid_index': grid_index[order].tolist(),
+           }
+    _md.update(md or {})
+
+    return (yield from ESM_path_scan(detectors, motors, points[order], md=_md))
@@ -4,9 +4,12 @@ import matplotlib.pyplot as plt
 from scipy.interpolate import interp1d
 import scipy.optimize as opt
 import os
+import time
 from bluesky.plans import scan, adaptive_scan, spiral_fermat, spiral,scan_nd
-from bluesky.plan_stubs import abs_set, mv
+from bluesky.plan_stubs import abs_set, mv, one_1d_step, trigger_and_read
 from bluesky.preprocessors import baseline_decorator, subs_decorator
+from bluesky.preprocessors import stage_decorator, run_decorator
+from bluesky.callbacks import CallbackBase
 # from bluesky.callbacks import LiveTable, LivePlot, CallbackBase
 ###from pyOlog.SimpleOlogClient import SimpleOlogClient
 from esm import ss_csv
@@ -15,6 +18,7 @@ from collections import ChainMap
 import math
 import re
 from boltons.iterutils import chunked
+from ophyd import Kind, SoftPositioner
 
 
 
@@ -142,7 +146,7 @@ def scan_time(DETS_str,num=1,delay=0,scan_type=None):
 ###   via bluesky.
 
 
-def scan_1D(DETS_str, scan_motor, start, end ,step_size,scan_type=None,adaptive=None):
+def scan_1D(DETS_str, scan_motor, start, end ,step_size,scan_type=None,adaptive=None,peak_tracker=None):
 
     '''
     scan over a single axis taking a list of detectors at each point.
@@ -209,6 +213,11 @@ def scan_1D(DETS_str, scan_motor, start, end ,step_size,scan_type=None,adaptive=
                      threshold               : Is a threshold for going back and rescanning a region
                                                (default is 0.8).
 
+    peak_tracker : ESM_peak_tracker, optional
+        Optional peak tracking callback, if given the scan stops once the peak has been passed (see
+        ESM_peak_scan) and the peak is available from the callback. Can not be used with the adaptive
+        option.
+
      '''
 
     #change the "hints" on the detectors so that only the relevant info is included in LivePlot
@@ -245,7 +254,10 @@ def scan_1D(DETS_str, scan_motor, start, end ,step_size,scan_type=None,adaptive=
 
     #Define the scan
     def inner():
-        if adaptive is None:
+        if peak_tracker is not None:
+            return ( yield from ESM_peak_scan(detectors,scan_motor,np.linspace(start,stop,steps+1),
+                                              peak_tracker,md=_md))
+        elif adaptive is None:
             print (str(detectors)+","+str(scan_motor)+","+ str(start)+","+str(stop)+","+str(_md))
             return ( yield from scan(detectors,scan_motor,start,stop,steps+1,md=_md))
         else:
@@ -269,8 +281,13 @@ def scan_1D(DETS_str, scan_motor, start, end ,step_size,scan_type=None,adaptive=
 ###   "set" via bluesky.
 
 
+# The line index recorded in each event by scan_multi_1D(..., single_run=True).
+multi_line = SoftPositioner(name='multi_line', init_pos=0)
+
+
 def scan_multi_1D(DETS_str, scan_motor1, start1, end1, step_size1,scan_motor2, start2, end2,
-                  step_size2,snake=False,scan_type=None,adaptive=None):
+                  step_size2,snake=False,scan_type=None,adaptive=None,shared_baseline=False,
+                  single_run=False):
     '''
     Run a series of 1D scans over a second motor (each line saved seperately).
 
@@ -350,7 +367,21 @@ def scan_multi_1D(DETS_str, scan_motor1, start1, end1, step_size1,scan_motor2, s
                                                          change.
                                threshold               : Is a threshold for going back and rescanning
                                                          a region (default is 0.8).
+
+    shared_baseline : boolean, optional
+       If True the baseline devices (sd.baseline) are only read for the first line, the following lines
+       record an empty baseline and refer to the first line through the 'baseline_uid' metadata.
+
+    single_run : boolean, optional
+       If True the whole series is recorded as one run, each event includes the line number ('multi_line')
+       and the outer motor position, the value and direction of each line are recorded in the 'multi_lines'
+       metadata. Can not be used with the adaptive option.
+
+    initial_uid : str, output
+        The unique id of the first run (the only run if single_run is True).
         '''
+    if single_run and adaptive is not None:
+        raise RuntimeError('single_run can not be used with an adaptive scan')
 
     #change the "hints" on the detectors so that only the relevant info is included
     DETS=ESM_setup_hints(DETS_str)
@@ -395,44 +426,84 @@ def scan_multi_1D(DETS_str, scan_motor1, start1, end1, step_size1,scan_motor2, s
            'delta':step_size2,'multi_axis':scan_motor1.name,'multi_start':start1,'multi_stop':stop1,
            'multi_num':steps1+1, 'multi_delta':step_size1}
 
-
-    for i,c_val in enumerate(np.linspace(start1, stop1, num=(steps1+1))):
-    # Step through each of the outer motor values
-       yield from abs_set(scan_motor1, c_val, wait=True )
-
-       #add the location of this scan in the multi scan, and the intial uid.
-
-       _md.update ( {'multi_pos':i+1 , 'initial_uid': initial_uid } )
-
-
-
-       def inner_forward():
-           if adaptive is None:
-               return(yield from scan(detectors,scan_motor2,start2,stop2,steps2+1,md=_md))
-           else:
-              return( yield from adaptive_scan(detectors,Y_axis,scan_motor2.name,start2,stop2,
-                                               adaptive[0],adaptive[1], adaptive[2],adaptive[3],
-                                               adaptive[4],md=_md))
-
-       def inner_backward():
-           if adaptive is None:
-               return (yield from scan(detectors,scan_motor2,stop2,start2,steps2+1,md=_md))
-           else:
-              return( yield from adaptive_scan(detectors,Y_axis,scan_motor2,stop2,start2,
-                                               -1*adaptive[0],-1*adaptive[1], adaptive[2],
-                                               adaptive[3],adaptive[4],md=_md))
-
-       # performs the next step in the scan
-       if snake:
-           if i%2==1:
-               uid=yield from inner_backward()
-           else:
-               uid=yield from inner_forward()
-       else:
-          uid= yield from inner_forward()
-
-       if initial_uid == 'current uid':
-           initial_uid = uid
+    if single_run:
+        #record every line in one run, with the line number in each event.
+        values1=np.linspace(start1, stop1, num=(steps1+1))
+        values2=np.linspace(start2, stop2, num=(steps2+1))
+        lines, outer, inner, multi_lines = [], [], [], []
+        for i,c_val in enumerate(values1):
+            backward = snake and i%2==1
+            lines+=[i+1]*len(values2)
+            outer+=[c_val]*len(values2)
+            inner+=list(values2[::-1] if backward else values2)
+            multi_lines.append({'multi_pos':i+1, 'multi_value':float(c_val),
+                                'direction':'backward' if backward else 'forward'})
+        _md.update({'multi_lines':multi_lines, 'single_run':True})
+
+        cyc=cycler(multi_line, lines)+cycler(scan_motor1, outer)+cycler(scan_motor2, inner)
+        initial_uid=yield from scan_nd(detectors, cyc, md=_md)
+
+        #change the "hints" on the detectors back to the default
+        DETS=ESM_setup_hints(DETS+',@-1')
+
+        return initial_uid
+
+    #the baseline devices, which are only read for the first line if shared_baseline is True.
+    sd_baseline = ip.user_ns['sd'].baseline if shared_baseline and 'sd' in ip.user_ns else None
+    saved_baseline = list(sd_baseline) if sd_baseline is not None else []
+
+    def multi_lines():
+        nonlocal initial_uid
+
+        #the baseline devices are put back in a finally clause (not by finalize_wrapper, which skips its
+        #final plan when the plan is closed) so that they are restored even if the RunEngine is halted.
+        try:
+            for i,c_val in enumerate(np.linspace(start1, stop1, num=(steps1+1))):
+            # Step through each of the outer motor values
+               yield from abs_set(scan_motor1, c_val, wait=True )
+
+               #add the location of this scan in the multi scan, and the intial uid.
+
+               _md.update ( {'multi_pos':i+1 , 'initial_uid': initial_uid } )
+
+               #the baseline list is emptied in place after the first line, as it is the list read by the
+               #baseline preprocessor.
+               if i == 1 and sd_baseline is not None:
+                   sd_baseline.clear()
+                   _md.update ( {'baseline_uid': initial_uid } )
+
+               def inner_forward():
+                   if adaptive is None:
+                       return(yield from scan(detectors,scan_motor2,start2,stop2,steps2+1,md=_md))
+                   else:
+                      return( yield from adaptive_scan(detectors,Y_axis,scan_motor2.name,start2,stop2,
+                                                       adaptive[0],adaptive[1], adaptive[2],adaptive[3],
+                                                       adaptive[4],md=_md))
+
+               def inner_backward():
+                   if adaptive is None:
+                       return (yield from scan(detectors,scan_motor2,stop2,start2,steps2+1,md=_md))
+                   else:
+                      return( yield from adaptive_scan(detectors,Y_axis,scan_motor2,stop2,start2,
+                                                       -1*adaptive[0],-1*adaptive[1], adaptive[2],
+                                                       adaptive[3],adaptive[4],md=_md))
+
+               # performs the next step in the scan
+               if snake:
+                   if i%2==1:
+                       uid=yield from inner_backward()
+                   else:
+                       uid=yield from inner_forward()
+               else:
+                  uid= yield from inner_forward()
+
+               if initial_uid == 'current uid':
+                   initial_uid = uid
+        finally:
+            if sd_baseline is not None and not sd_baseline:
+                sd_baseline.extend(saved_baseline)
+
+    yield from multi_lines()
 
     #change the "hints" on the detectors back to the default
     DETS=ESM_setup_hints(DETS+',@-1')
@@ -442,7 +513,8 @@ def scan_multi_1D(DETS_str, scan_motor1, start1, end1, step_size1,scan_motor2, s
 
 def scan_2D(DETS_str, scan_motor1, start1, end1, step_size1,scan_motor2, start2, end2, step_size2,
             snake=False,concurrent=False,normal_spiral=False,fermat_spiral=False,
-            square_spiral=False,scan_type=None):
+            square_spiral=False,scan_type=None,optimized=False,axis_parameters=None,mask=None,
+            fly=False,velocity=None):
     '''
     Run a 2D scan using a list of detectors.
 
@@ -614,7 +686,42 @@ def scan_2D(DETS_str, scan_motor1, start1, end1, step_size1,scan_motor2, start2,
                 this will be set in the plan if it is not already true.
 
 
+    optimized : boolean, optional
+        Optional indicator that the points of the grid should be visited in the order that minimizes
+        the total move time (see ESM_optimize_path), starting from the current motor positions.
+
+            To use this feature include ' optimized = True' after step_size2 in the call
+
+                REQUIRED PARAMETERS FOR THIS OPTION
+                    axis_parameters : list, optional
+                        A list of 2 dictionaries (for scan_motor1 and scan_motor2) overriding the
+                        'velocity', 'acceleration' or 'backlash' of each motor, see ESM_axis_parameters.
+                        The default (None) reads the velocity and acceleration from the motors.
+
+                    mask : array, optional
+                        A boolean array, with shape (number of steps1, number of steps2), selecting the
+                        grid points to include. The default (None) includes all points.
+
+                NOTE:  The points are not in raster order, so the metadata does not include X_num,
+                Y_num, X_delta or Y_delta (eg. for fit_Gauss_1Dseries), the grid position of each point
+                is given by 'grid_shape' and 'grid_index' (see ESM_optimized_scan).
+
+
+    fly : boolean, optional
+        Optional indicator that scan_motor2 should move continuously along each line while the
+        detectors are streamed, the readings are then binned into the same pixels as the step scan
+        (see fly_map). The 'snake' option is used for the direction of each line.
+
+            To use this feature include ' fly = True, velocity = value' after step_size2 in the call
+
+                REQUIRED PARAMETERS FOR THIS OPTION
+                    velocity : number
+                        The velocity of scan_motor2 (in units/s) along each line, it should allow for
+                        several detector readings per pixel.
+
         '''
+    if fly and velocity is None:
+        raise RuntimeError('a velocity is required for a fly scan')
 
     #change the "hints" on the detectors so that only the relevant info is included
     DETS=ESM_setup_hints(DETS_str)
@@ -761,6 +868,28 @@ def scan_2D(DETS_str, scan_motor1, start1, end1, step_size1,scan_motor2, start2,
 
 
 
+    elif fly is True:
+        _md = {'scan_name':'scan_2D','plot_Xaxis':X_axis,'plot_Yaxis':Y_axis,'plot_Zaxis':Z_axis,
+               'scan_type':scan_type, 'X_axis':X_axis,'X_start':start2,'X_stop':stop2,
+               'X_num':steps2+1,'X_delta':step_size2, 'Y_axis':Y_axis,'Y_start':start1,
+               'Y_stop':stop1,'Y_num':steps1+1,'Y_delta':step_size1,'trajectory':'fly'}
+
+        uid=yield from fly_map(detectors,scan_motor2,start2,stop2,steps2+1,scan_motor1,start1,stop1,
+                               steps1+1,velocity,snake=snake,md=_md)
+
+    elif optimized is True:
+        # the events are not in raster order so the raster shape (X_num, Y_num ...) is not included, the
+        # position of each point in the grid is given by 'grid_shape' and 'grid_index' (see ESM_optimized_scan).
+        _md = {'scan_name':'scan_2D','plot_Xaxis':X_axis,'plot_Yaxis':Y_axis,'plot_Zaxis':Z_axis,
+               'scan_type':scan_type, 'X_axis':X_axis,'X_start':start2,'X_stop':stop2,
+               'Y_axis':Y_axis,'Y_start':start1,'Y_stop':stop1,'trajectory':'optimized'}
+
+        uid=yield from ESM_optimized_scan(detectors,[scan_motor2,scan_motor1],
+                                          [np.linspace(start2,stop2,steps2+1),
+                                           np.linspace(start1,stop1,steps1+1)],
+                                          axis_parameters=axis_parameters[::-1] if axis_parameters else None,
+                                          mask=mask,md=_md)
+
     else:
         _md = {'scan_name':'scan_2D','plot_Xaxis':X_axis,'plot_Yaxis':Y_axis,'plot_Zaxis':Z_axis,
                'scan_type':scan_type, 'X_axis':X_axis,'X_start':start2,'X_stop':stop2,
@@ -787,7 +916,7 @@ def scan_2D(DETS_str, scan_motor1, start1, end1, step_size1,scan_motor2, start2,
 
 
 
-def scan_ND(DETS_str, *args,concurrent=False,scan_type=None):
+def scan_ND(DETS_str, *args,concurrent=False,scan_type=None,optimized=False,axis_parameters=None):
     ''' Run an ND scan using a list of detectors.
 
 
@@ -849,7 +978,25 @@ def scan_ND(DETS_str, *args,concurrent=False,scan_type=None):
 
                            REQUIRED PARAMETERS FOR THIS OPTION
                                no extra parameters are required.
+
+    optimized : Boolean, optional
+                Optional boolean that visits the points of the grid in the order that minimizes the
+                total move time (see ESM_optimize_path), the snake values are not used.
+
+                    To use this feature include 'optimized=True' after the last motor in the call.
+
+                           REQUIRED PARAMETERS FOR THIS OPTION
+                               axis_parameters : list, optional
+                                   A list of dictionaries (one for each motor) overriding the
+                                   'velocity', 'acceleration' or 'backlash' of each motor, see
+                                   ESM_axis_parameters.
+
+                           NOTE: The points are not in raster order, so the metadata does not include
+                           the num or delta values for each axis, the grid position of each point is
+                           given by 'grid_shape' and 'grid_index' (see ESM_optimized_scan).
         '''
+    if concurrent and optimized:
+        raise RuntimeError('concurrent and optimized can not be used together')
 
     #change the "hints" on the detectors so that only the relevant info is included
     DETS=ESM_setup_hints(DETS_str)
@@ -871,6 +1018,8 @@ def scan_ND(DETS_str, *args,concurrent=False,scan_type=None):
     new_args = []
     #define the new args list to be sent to the scan plan.
     motors_list = []
+    #define the list of motor values for an optimized scan.
+    grid_values = []
 
     # This section determines the no of steps to include in order to get as close as possible to the endpoint specified.
 
@@ -920,6 +1069,7 @@ def scan_ND(DETS_str, *args,concurrent=False,scan_type=None):
             new_args.append(motor_list[1])
             new_args.append(stop)
             new_args.append(steps+1)
+            grid_values.append(np.linspace(motor_list[1],stop,steps+1))
 
             if i != 0:
                 new_args.append(motor_list[4])
@@ -949,6 +1099,19 @@ def scan_ND(DETS_str, *args,concurrent=False,scan_type=None):
 
         uid= yield from inner_prod()
 
+    elif optimized is True:
+    # if the scan visits the grid points in the order with the minimum move time, the events are not in
+    # raster order so the number of steps and step size of each axis are replaced by 'grid_shape' and
+    # 'grid_index' (see ESM_optimized_scan).
+        for key in [key for key in _md if key.startswith(('num', 'delta'))]:
+            del _md[key]
+        _md.update({'trajectory':'optimized'})
+        motors=[motor_list[0] for motor_list in chunk_args]
+
+        uid=yield from ESM_optimized_scan(detectors,motors[::-1],grid_values[::-1],
+                                          axis_parameters=axis_parameters[::-1] if axis_parameters else None,
+                                          md=_md)
+
     else:
     # if the scan is a normal outer product scan
 
@@ -978,7 +1141,340 @@ def scan_ND(DETS_str, *args,concurrent=False,scan_type=None):
 ###Alignment scans
 ###These are scans specifically written for beamline alignment.
 
-def M3_pitch_alignment(Branch="A",adaptive=False):
+
+class ESM_peak_tracker(CallbackBase):
+    def __init__(self, x_field, y_field, margin, drop=0.5, window=2):
+        '''
+        A callback that tracks the peak of a 1D scan as the points arrive.
+
+        The peak is taken as the point with the maximum y value, refined by fitting a parabola to the
+        points within 'window' points on either side of it. The peak is considered passed once the scan
+        has moved at least 'margin' beyond it and the y value has dropped by at least 'drop' times the
+        peak height (the maximum minus the minimum y value) on both sides of the peak.
+
+        PARAMETERS
+        ----------
+
+        x_field, y_field : str
+            The names of the motor and detector fields in the event documents.
+
+        margin : float
+            The distance (in x units) the scan needs to move past the peak before it is considered passed.
+
+        drop : float, optional
+            The fraction of the peak height the y value needs to drop by on both sides of the peak.
+
+        window : int, optional
+            The number of points on either side of the maximum used to refine the peak position.
+
+        '''
+        super().__init__()
+        self.x_field=x_field
+        self.y_field=y_field
+        self.margin=margin
+        self.drop=drop
+        self.window=window
+        self.x, self.y = [], []
+        self.best=None
+
+
+    def start(self, doc):
+        self.x, self.y = [], []
+        self.best=None
+
+
+    def event(self, doc):
+        if self.x_field not in doc['data'] or self.y_field not in doc['data']:
+            return
+        self.x.append(doc['data'][self.x_field])
+        self.y.append(doc['data'][self.y_field])
+        if self.best is None or self.y[-1] > self.y[self.best]:
+            self.best=len(self.y)-1
+
+
+    @property
+    def passed(self):
+        '''
+        True if the peak has been passed by the margin, see the class description.
+        '''
+        if self.best is None or self.best == 0 or self.best == len(self.y)-1:
+            return False
+
+        peak=self.y[self.best]
+        height=peak-min(self.y)
+        if height <= 0 or abs(self.x[-1]-self.x[self.best]) < self.margin:
+            return False
+
+        return (peak-self.y[-1] >= self.drop*height and
+                peak-min(self.y[:self.best]) >= self.drop*height)
+
+
+    @property
+    def peak(self):
+        '''
+        The peak position and value as a list [x, y] (as for max_in_1D), None if there are no points.
+        '''
+        if self.best is None:
+            return None
+
+        x_peak, y_peak = self.x[self.best], self.y[self.best]
+        low, high = max(self.best-self.window, 0), min(self.best+self.window+1, len(self.y))
+        if high-low >= 3:
+            x=np.array(self.x[low:high], dtype=float)
+            a, b, c = np.polyfit(x-x_peak, np.array(self.y[low:high], dtype=float), 2)
+            # only use the fit if it is a maximum within the points used.
+            if a < 0 and x.min() <= x_peak-b/(2*a) <= x.max():
+                x_peak, y_peak = x_peak-b/(2*a), c-b**2/(4*a)
+
+        return [float(x_peak), float(y_peak)]
+
+
+    @property
+    def width(self):
+        '''
+        The full width at half maximum of the peak (above the minimum y value), None if the y value has not
+        dropped below half of the peak height on both sides of the peak.
+        '''
+        if self.best is None:
+            return None
+
+        x, y = np.array(self.x, dtype=float), np.array(self.y, dtype=float)
+        half=(y[self.best]+y.min())/2
+        edges=[]
+        for side in (np.arange(self.best, -1, -1), np.arange(self.best, len(y))):
+            below=np.flatnonzero(y[side] < half)
+            if len(below) == 0:
+                return None
+            # interpolate between the last point above and the first point below half maximum.
+            i, j = side[below[0]-1], side[below[0]]
+            edges.append(x[i]+(half-y[i])*(x[j]-x[i])/(y[j]-y[i]))
+
+        return float(abs(edges[1]-edges[0]))
+
+
+def ESM_peak_scan(detectors, motor, positions, tracker, *, md=None):
+    '''
+    Steps a motor through a list of positions, stopping once the peak tracked by tracker has been passed.
+
+    PARAMETERS
+    ----------
+
+    detectors : list
+        The list of 'readable' objects.
+
+    motor : object
+        The 'setable' object to scan.
+
+    positions : list
+        The positions to step through, in order.
+
+    tracker : ESM_peak_tracker
+        The peak tracking callback, it is subscribed for the duration of the scan.
+
+    md : dict, optional
+        The metadata for the run.
+
+    uid : str, output
+        The unique id of the run.
+
+    '''
+    _md = {'detectors': [detector.name for detector in detectors],
+           'motors': [motor.name],
+           'num_points': len(positions),
+           'num_intervals': len(positions) - 1,
+           'plan_name': 'ESM_peak_scan',
+           'peak_margin': tracker.margin,
+           'hints': {'dimensions': [(motor.hints['fields'], 'primary')]},
+           }
+    _md.update(md or {})
+
+    @subs_decorator(tracker)
+    @stage_decorator(list(detectors) + [motor])
+    @run_decorator(md=_md)
+    def inner_peak_scan():
+        for position in positions:
+            yield from one_1d_step(detectors, motor, position)
+            if tracker.passed:
+                break
+
+    return (yield from inner_peak_scan())
+
+
+##    Alignment history, each accepted alignment result is appended to an HDF5 log (see ESM_snapshot_log)
+##    with one group per alignment (eg. 'M3_pitch_alignment_A'), later alignments use the recent results
+##    to scan a narrower window around the expected optimum.
+
+ESM_alignment_log = ESM_snapshot_log('/direct/XF21ID1/status_files/ESM_alignment_history.h5')
+
+
+def ESM_alignment_state():
+    '''
+    Returns the beamline state recorded with each alignment result.
+
+    PARAMETERS
+    ----------
+
+    state : dict, output
+        The photon energy ('energy') and the grating lines per mm ('grating'), NaN if they can not be read.
+
+    '''
+    return {'energy' : ESM_read_value(PGM.Energy), 'grating' : ESM_read_value(PGM.Grating_lines)}
+
+
+def ESM_record_alignment(label, state=None, **values):
+    '''
+    Appends an alignment result to the alignment history.
+
+    PARAMETERS
+    ----------
+
+    label : str
+        The name of the alignment, eg. 'M3_pitch_alignment_A'.
+
+    state : dict, optional
+        The beamline state, the default (None) reads it using ESM_alignment_state.
+
+    **values : float
+        The result, eg. x=-0.711 (the optimum x axis position), x_width=0.002 (the fitted full width at half
+        maximum, if there is one) and value=1.2E-9 (the detector value at the optimum).
+
+    '''
+    if state is None:
+        state=ESM_alignment_state()
+    result=dict(state)
+    result.update({key : np.nan if value is None else float(value) for key, value in values.items()})
+    ESM_alignment_log.append(label, pd.Series(result, dtype=float, name=_snapshot_times([time.time()])[0]))
+
+
+def ESM_alignment_history(label, columns=None, start=None, end=None, plot=False):
+    '''
+    Returns (and optionally plots) the alignment results for an alignment, eg. to follow the drift of a
+    mirror axis over time.
+
+    PARAMETERS
+    ----------
+
+    label : str
+        The name of the alignment, eg. 'M3_pitch_alignment_A'.
+
+    columns : list, optional
+        The columns to return, eg. ['x'], the default (None) returns all of them.
+
+    start, end : str or datetime, optional
+        The time range of the results to return.
+
+    plot : boolean, optional
+        If True the columns (other than the energy and grating) are plotted against time.
+
+    history : pandas.DataFrame, output
+        One row per alignment (indexed by time).
+
+    '''
+    history=ESM_alignment_log.history(label, columns=columns, start=start, end=end)
+    if plot:
+        plot_columns=[column for column in history.columns if column not in ('energy', 'grating', 'value')
+                      and not column.endswith('_width')]
+        fig, axes = plt.subplots(len(plot_columns), 1, sharex=True, squeeze=False)
+        for ax, column in zip(axes[:, 0], plot_columns):
+            ax.plot(history.index, history[column], 'o-')
+            ax.set_ylabel(column)
+        axes[0, 0].set_title(label)
+
+    return history
+
+
+def ESM_alignment_window(label, column, start, end, min_width, state=None, num_widths=3, num_recent=5,
+                         max_age=60, energy_tol=0.1, match_grating=True):
+    '''
+    Returns the search window for an alignment axis, narrowed around the recent alignment results.
+
+    The recent results (at most num_recent results, from the last max_age days, with the same grating and
+    an energy within energy_tol of the current one, if these are used) are used. The window is centred on the most recent
+    result and extends by the largest of num_widths times the median fitted width, the spread of the recent
+    results and min_width on either side. The window is limited to the full range and has the same direction
+    as it, the full range is returned if there are no suitable results.
+
+    PARAMETERS
+    ----------
+
+    label : str
+        The name of the alignment, eg. 'M3_pitch_alignment_A'.
+
+    column : str
+        The name of the axis column in the history, eg. 'x', the fitted width column is column+'_width'.
+
+    start, end : float
+        The full range of the axis.
+
+    min_width : float
+        The minimum half width of the window, eg. a few scan steps.
+
+    state : dict, optional
+        The beamline state, the default (None) reads it using ESM_alignment_state.
+
+    num_widths : float, optional
+        The half width of the window in fitted widths.
+
+    num_recent : int, optional
+        The maximum number of recent results to use.
+
+    max_age : float, optional
+        The maximum age (in days) of the results to use.
+
+    energy_tol : float, optional
+        The maximum fractional difference in photon energy of the results to use, None to use all energies.
+
+    match_grating : boolean, optional
+        If True (default) only the results with the current grating are used.
+
+    window : list, output
+        The window as [start, end, narrowed], narrowed is True if the window is narrower than the full range.
+
+    '''
+    try:
+        history=ESM_alignment_log.history(label, start=pd.Timestamp.now()-pd.Timedelta(days=max_age))
+    except (RuntimeError, OSError):
+        return [start, end, False]
+    if column not in history.columns or len(history) == 0:
+        return [start, end, False]
+
+    if state is None:
+        state=ESM_alignment_state()
+    mask=np.isfinite(history[column].to_numpy())
+    if match_grating and 'grating' in history.columns and np.isfinite(state['grating']):
+        mask&=history['grating'].to_numpy() == state['grating']
+    if energy_tol is not None and 'energy' in history.columns and np.isfinite(state['energy']):
+        mask&=np.abs(history['energy'].to_numpy()/state['energy']-1) <= energy_tol
+    recent=history[mask].iloc[-num_recent:]
+    if len(recent) == 0:
+        return [start, end, False]
+
+    positions=recent[column].to_numpy()
+    half_width=max(min_width, positions.max()-positions.min())
+    if column+'_width' in recent.columns:
+        widths=recent[column+'_width'].to_numpy()
+        widths=widths[np.isfinite(widths)]
+        if len(widths):
+            half_width=max(half_width, num_widths*np.median(widths))
+
+    low, high = min(start, end), max(start, end)
+    window_low=max(low, positions[-1]-half_width)
+    window_high=min(high, positions[-1]+half_width)
+    if window_low >= window_high or (window_low <= low and window_high >= high):
+        return [start, end, False]
+    if start > end:
+        return [float(window_high), float(window_low), True]
+    return [float(window_low), float(window_high), True]
+
+
+def _at_window_edge(position, start, end, tolerance):
+    '''
+    Returns True if an optimum is missing or within tolerance of the edge of the window it was found in.
+    '''
+    return position is None or min(abs(position-start), abs(position-end)) <= tolerance
+
+
+def M3_pitch_alignment(Branch="A",adaptive=False,track_peak=True,margin=0.001,use_history=True):
     '''
     Runs a scan of the M3 mirror pitch to the exit slit to find the maximum and then sets the pitch to this value.
 
@@ -997,6 +1493,23 @@ def M3_pitch_alignment(Branch="A",adaptive=False):
     adaptive : Boolean, optional
         This allows for the scan to be run as an adaptive scan or not.
 
+    track_peak : Boolean, optional
+        If True (default, and adaptive is False) the peak is tracked as the scan runs (see
+        ESM_peak_tracker), the scan stops once the peak has been passed by margin. On its own this only
+        saves the part of the range beyond the peak (eg. a scan with the peak in the middle of the branch A
+        range stops after ~83 of 131 points), the larger saving comes from use_history.
+
+    margin : float, optional
+        The distance (in deg) past the peak to scan when track_peak is True.
+
+    use_history : Boolean, optional
+        If True (default) the scan is first run over a window around the recent results for this branch
+        (see ESM_alignment_window), the full range is scanned if there are none or if the maximum is at the
+        edge of the window. The result is always added to the alignment history.
+
+    output : list, output
+        The pitch and intensity at the maximum, as a list [x, y].
+
     '''
 
     x_axis = M3.Ry                 # The x axis of the scan
@@ -1059,70 +1572,76 @@ def M3_pitch_alignment(Branch="A",adaptive=False):
         Diode_pos = -63                  #The position of the diode motor to be used during the scan
 
 
-    # Read the intial values for each motor that is to be moved.
-    initial_x_pos  =x_axis.position
-
-    initial_FE_hgap_pos = FE_hgap_axis.position
-    initial_FE_vgap_pos = FE_vgap_axis.position
-
-    initial_det_range = detector.em_range.get()               # The initial detector range
-    initial_det_vals_reading = detector.values_per_read.get() # The initial values per reading.
-    initial_det_avg_time = detector.averaging_time.get()      # The initial averaging time.
-    initial_det_int_time = detector.integration_time.get()    # The initial integration time.
-
-    initial_Exit_Slit_hgap_pos = Exit_Slit_hgap_motor.position # The initial horizontal gap opening
-    initial_Exit_Slit_vgap_pos = Exit_Slit_vgap_motor.position # The initial vertical gap opening
-
-    initial_diode_pos = Diode_motor.position                   # The initial location of the diode motor.
-
-    #Move the values to the starting positions for the scan.
-
-    yield from mv( x_axis,x_start, #FE_hgap_axis,FE_hgap_pos, FE_vgap_axis,FE_vgap_pos,
-                   Diode_motor,Diode_pos, Exit_Slit_hgap_motor,Exit_Slit_hgap_pos,
-                   Exit_Slit_vgap_motor,Exit_Slit_vgap_pos)
-
-    detector.em_range.put(det_range)                    # The range to use for the scan
-    detector.values_per_read.put(det_vals_reading)      # The values per reading to use.
-    detector.averaging_time.put(det_avg_time)           # The averaging time to use.
-    detector.integration_time.put(det_int_time)         # The integration time to use.
-
-    #Run the scan
-    if adaptive is False:
-        uid= yield from scan_1D(detector.name,x_axis,x_start,x_end,stepsize_min,
-                                scan_type=scan_type_str)
-    elif adaptive is True:
-        uid= yield from scan_1D(detector.name,x_axis,x_start,x_end,stepsize_min,
-                                scan_type=scan_type_str,
-                                adaptive=[stepsize_min,stepsize_max, target_delta,backstep,threshold])
-
-
-    #move everything to the initial positions
-    yield from mv( Diode_motor,initial_diode_pos, Exit_Slit_hgap_motor,initial_Exit_Slit_hgap_pos,
-                   Exit_Slit_vgap_motor,initial_Exit_Slit_vgap_pos)
-                  #FE_hgap_axis,initial_FE_hgap_pos, FE_vgap_axis,initial_FE_vgap_pos
-
+    # The axes and detector settings that are changed by the scan, these are recorded (in parallel) and
+    # restored (concurrently) once the scan finishes or fails, see ESM_restore_wrapper.
+    restore_objects=[x_axis, Diode_motor, Exit_Slit_hgap_motor, Exit_Slit_vgap_motor, #FE_hgap_axis, FE_vgap_axis,
+                     detector.em_range, detector.values_per_read, detector.averaging_time,
+                     detector.integration_time]
+
+    # The search window, narrowed around the recent results in the alignment history if there are any.
+    label=scan_type_str
+    state=ESM_alignment_state()
+    windows=[[x_start, x_end]]
+    if use_history is True:
+        window=ESM_alignment_window(label, 'x', x_start, x_end, 20*stepsize_min, state=state)
+        if window[2] is True:
+            windows.insert(0, window[:2])
+
+    tracker=None
+    if adaptive is False and track_peak is True:
+        tracker=ESM_peak_tracker(x_axis.hints['fields'][0],detector.current1.mean_value.name,margin)
+
+    def alignment_scan():
+        #Move the values to the starting positions for the scan.
+        yield from mv( x_axis,windows[0][0], #FE_hgap_axis,FE_hgap_pos, FE_vgap_axis,FE_vgap_pos,
+                       Diode_motor,Diode_pos, Exit_Slit_hgap_motor,Exit_Slit_hgap_pos,
+                       Exit_Slit_vgap_motor,Exit_Slit_vgap_pos,
+                       detector.em_range,det_range, detector.values_per_read,det_vals_reading,
+                       detector.averaging_time,det_avg_time, detector.integration_time,det_int_time)
+
+        for i, (start, end) in enumerate(windows):
+            #Run the scan
+            if tracker is not None:
+                uid= yield from scan_1D(detector.name,x_axis,start,end,stepsize_min,
+                                        scan_type=scan_type_str,peak_tracker=tracker)
+            elif adaptive is False:
+                uid= yield from scan_1D(detector.name,x_axis,start,end,stepsize_min,
+                                        scan_type=scan_type_str)
+            elif adaptive is True:
+                uid= yield from scan_1D(detector.name,x_axis,start,end,stepsize_min,
+                                        scan_type=scan_type_str,
+                                        adaptive=[stepsize_min,stepsize_max, target_delta,backstep,threshold])
+
+            #Determine the location of the maximum intensity.
+            if uid is None:
+                return None
+            if tracker is not None:
+                output=tracker.peak
+            else:
+                hdr=db[-1]
+                output=max_in_1D(hdr.start['scan_id'])
 
-    detector.em_range.put(initial_det_range)                    # The range to use for the scan
-    detector.values_per_read.put(initial_det_vals_reading)      # The values per reading to use.
-    detector.averaging_time.put(initial_det_avg_time)           # The averaging time to use.
-    detector.integration_time.put(initial_det_int_time)         # The integration time to use
+            # if the maximum is at the edge of a narrowed window the full range is scanned.
+            if i < len(windows)-1 and _at_window_edge(output[0], start, end, 2*stepsize_min):
+                print ('The maximum is at the edge of the window from the alignment history (',start,' to ',end,
+                       '), scanning the full range')
+            else:
+                return output
 
-    #Determine the location of the maximum intensity.
+    #Run the scan and move everything to the initial positions, the scan axis is also returned to its initial
+    #position as this move helps with the backlash issue I have noticed
+    output= yield from ESM_restore_wrapper(alignment_scan(), restore_objects)
 
-    if uid is not None:
-        hdr=db[-1]
-        output=max_in_1D(hdr.start['scan_id'])
-        yield from mv( x_axis,initial_x_pos ) # this move helps with the backlash issue I have noticed
+    if output is not None:
         yield from mv( x_axis,output[0] )
         #set the scan axis to the new value.
-    else:
-        yield from mv( x_axis,initial_x_pos )
-        output=None
+        ESM_record_alignment(label, state=state, x=output[0], value=output[1],
+                             x_width=tracker.width if tracker is not None else None)
 
     return output
 
 
-def FE_slits_alignment(detector_location="Diagon",mv_center=False,return_all=False):
+def FE_slits_alignment(detector_location="Diagon",mv_center=False,return_all=False,use_history=True):
     '''
     Take an image of the beam relative to the Bremstrahlung collimator using the diagon or using either branches
     gas cell diode.
@@ -1147,6 +1666,11 @@ def FE_slits_alignment(detector_location="Diagon",mv_center=False,return_all=Fal
         This allows for the routine to return all motors moved during the scan to their original locations.
         To use this set return_all = True.
 
+    use_history : Boolean, optional
+        If True (default) the scan is first run over a window around the recent results for this detector
+        (see ESM_alignment_window), the full range is scanned if there are none or if the maximum is at the
+        edge of the window. Accepted results are always added to the alignment history.
+
     '''
     # Define some parameters that are to be used in the scan, these are designed to be 'preset' and hence are not
     #'inputted' into the scan.
@@ -1244,91 +1768,79 @@ def FE_slits_alignment(detector_location="Diagon",mv_center=False,return_all=Fal
     else:
         return None
 
-    # Read the intial values for each motor that is to be moved.
-    initial_Und_gap =Und.position
-    initial_x_axis  =x_axis.position
-    initial_y_axis  =y_axis.position
-
-    initial_FE_hgap_pos = FE_hgap_axis.position
-    initial_FE_vgap_pos = FE_vgap_axis.position
-
-    if detector_location == 'Diagon':
-
-        initial_det_exp_time = detector.cam.acquire_time.value
-        initial_det_aqu_period = detector.cam.acquire_period.value
-        initial_det_num_images = detector.cam.num_images.value
-        initial_det_exp_image = detector.cam.num_exposures.value
-
-        initial_det_ROI_Xstart = detector.roi1.min_xyz.min_x.value
-        initial_det_ROI_Xsize = detector.roi1.size.x.value
-        initial_det_ROI_Ystart = detector.roi1.min_xyz.min_y.value
-        initial_det_ROI_Ysize = detector.roi1.size.y.value
-
-        initial_det_Mir_pos = det_Mir_motor.position
-        initial_det_Yag_pos = det_Yag_motor.position
-
-    elif 'Gas_cell' in detector_location:
-
-        initial_det_range = detector.em_range.get()               # The initial detector range
-        initial_det_vals_reading = detector.values_per_read.get() # The initial values per reading.
-        initial_det_avg_time = detector.averaging_time.get()      # The initial averaging time.
-        initial_det_int_time = detector.integration_time.get()    # The initial integration time.
-
-        initial_Exit_Slit_hgap_pos = Exit_Slit_hgap_motor.position # The initial horizontal gap opening
-        initial_Exit_Slit_vgap_pos = Exit_Slit_vgap_motor.position # The initial vertical gap opening
-
-        initial_PGM_Energy_pos = PGM_Energy_motor.position         #The initial photon energy.
-        initial_diode_pos = diode_motor.position                   # The initial location of the diode motor.
-
-    #ADD A CLOSE SHUTTER CALL HERE
-
-
-
-
-    #Move the values to the starting positions for the scan.
-
-    yield from mv( Und,Und_gap,  x_axis,x_start,  y_axis, y_start,
-                  FE_hgap_axis,FE_hgap_pos,  FE_vgap_axis,FE_vgap_pos)
+    # The axes and detector settings that are changed by the scan, these are recorded (in parallel) and, if
+    # 'return_all = True', restored (concurrently) once the scan finishes or fails, see ESM_restore_wrapper.
+    restore_objects=[Und, x_axis, y_axis, FE_hgap_axis, FE_vgap_axis]
 
     if detector_location == 'Diagon':
-        yield from mv (det_Mir_motor,det_Mir_pos,  det_Yag_motor,det_Yag_pos)
-
-        detector.cam.acquire_time.put(det_exp_time)
-        detector.cam.acquire_period.put(det_aqu_period)
-        detector.cam.num_images.put(det_num_images)
-        detector.cam.num_exposures.put(det_exp_image)
+        scan_settings=[det_Mir_motor,det_Mir_pos,  det_Yag_motor,det_Yag_pos,
+                       detector.cam.acquire_time,det_exp_time,  detector.cam.acquire_period,det_aqu_period,
+                       detector.cam.num_images,det_num_images,  detector.cam.num_exposures,det_exp_image,
+                       detector.roi1.min_xyz.min_x,det_ROI1_Xstart,  detector.roi1.size.x,det_ROI1_Xsize,
+                       detector.roi1.min_xyz.min_y,det_ROI1_Ystart,  detector.roi1.size.y,det_ROI1_Ysize]
 
-        detector.roi1.min_xyz.min_x.put(det_ROI1_Xstart)
-        detector.roi1.size.x.put(det_ROI1_Xsize)
-        detector.roi1.min_xyz.min_y.put(det_ROI1_Ystart)
-        detector.roi1.size.y.put(det_ROI1_Ysize)
     elif 'Gas_cell' in detector_location:
-        yield from mv(Exit_Slit_hgap_motor,Exit_Slit_hgap_pos,  Exit_Slit_vgap_motor,Exit_Slit_vgap_pos,
-                      PGM_Energy_motor,PGM_Energy_pos,   diode_motor,Diode_pos)
-
-        detector.em_range.put(det_range)                    # The range to use for the scan
-        detector.values_per_read.put(det_vals_reading)      # The values per reading to use.
-        detector.averaging_time.put(det_avg_time)           # The averaging time to use.
-        detector.integration_time.put(det_int_time)         # The integration time to use.
+        scan_settings=[Exit_Slit_hgap_motor,Exit_Slit_hgap_pos,  Exit_Slit_vgap_motor,Exit_Slit_vgap_pos,
+                       PGM_Energy_motor,PGM_Energy_pos,   Diode_motor,Diode_pos,
+                       detector.em_range,det_range,  detector.values_per_read,det_vals_reading,
+                       detector.averaging_time,det_avg_time,  detector.integration_time,det_int_time]
 
+    restore_objects.extend(scan_settings[::2])
 
+    # Read the intial values for each motor that is to be moved.
+    initial=ESM_settings_snapshot(restore_objects)
+    initial_x_axis=initial.values[x_axis]
+    initial_y_axis=initial.values[y_axis]
+
+    # The search windows [x_start, x_end, y_start, y_end], narrowed around the recent results in the alignment
+    # history if there are any. The FE slit position does not depend on the photon energy or the grating.
+    state=ESM_alignment_state()
+    windows=[[x_start, x_end, y_start, y_end]]
+    if use_history is True:
+        x_window=ESM_alignment_window(scan_type_str, 'x', x_start, x_end, 4*x_stepsize, state=state,
+                                      energy_tol=None, match_grating=False)
+        y_window=ESM_alignment_window(scan_type_str, 'y', y_start, y_end, 4*y_stepsize, state=state,
+                                      energy_tol=None, match_grating=False)
+        if x_window[2] is True or y_window[2] is True:
+            windows.insert(0, x_window[:2]+y_window[:2])
+
+    def alignment_scan():
+        #ADD A CLOSE SHUTTER CALL HERE
+
+        #Move the values to the starting positions for the scan.
+        yield from mv( Und,Und_gap,  x_axis,windows[0][0],  y_axis, windows[0][2],
+                      FE_hgap_axis,FE_hgap_pos,  FE_vgap_axis,FE_vgap_pos, *scan_settings)
+
+        #ADD AN OPEN SHUTTER CALL HERE
+
+        for i, (x_first, x_last, y_first, y_last) in enumerate(windows):
+            uid=yield from (scan_2D(detector.name,y_axis,y_first,y_last,y_stepsize,x_axis,x_first,x_last,x_stepsize,
+                                    snake=True,scan_type=scan_type_str))
+            if uid is None:
+                return None
+            # the output is [x, y, z], see max_in_2D.
+            output=max_in_2D(uid)
+
+            # if the maximum is at the edge of a narrowed window the full range is scanned.
+            if i < len(windows)-1 and (_at_window_edge(output[0], x_first, x_last, abs(x_stepsize)) or
+                                       _at_window_edge(output[1], y_first, y_last, abs(y_stepsize))):
+                print ('The maximum is at the edge of the window from the alignment history, scanning the full range')
+            else:
+                return output
 
-    #ADD AN OPEN SHUTTER CALL HERE
-
-    uid=yield from (scan_2D([detector],y_axis,y_start,y_end,y_stepsize,x_axis,x_start,x_end,x_stepsize,snake=True,
-                                scan_type=scan_type_str))
-
+    # Reset the values to the original position if 'return_all = True'
+    #ADD A CLOSE PHOTON SHUTTER LINE HERE.
+    output=yield from ESM_restore_wrapper(alignment_scan(), initial, restore=return_all)
 
-    if uid is not None:
-        hdr=db[uid]
-        output=max_in_2D(uid)
 
+    if output is not None:
+        max_x=output[0]
         max_y=output[1]
-        max_x=output[2]
 
         if (abs(max_x/initial_x_axis-1) <= accuracy_level) and (abs(max_y/initial_y_axis-1) <= accuracy_level):
             print ("The fitted FE slit position at the ",str(detector_location),
                    " detector is: FE_slit_h_center = ",max_x," FE_slit_v_center = ", max_y)
+            ESM_record_alignment(scan_type_str, state=state, x=max_x, y=max_y, value=output[2])
         else:
             mv_center=False
             print ("WARNING:: THE NEW FITTED POSITION IS DIFFERENT FROM THE NEW POSITION BY ",
@@ -1338,47 +1850,13 @@ def FE_slits_alignment(detector_location="Diagon",mv_center=False,return_all=Fal
                    ", the new position has not been set)")
 
     else:
+        mv_center=False
         max_x=None
         max_y=None
 
 
-    # Reset the values to the original position if 'return_all = True'
-    #ADD A CLOSE PHOTON SHUTTER LINE HERE.
-    if return_all is True:
-
-
-        yield from mv( Und,initial_Und_gap,  x_axis,initial_x_axis,  y_axis, initial_y_axis)
-
-        if detector_location == 'Diagon':
-            yield from mv(det_Mir_motor,initial_det_Mir_pos,  det_Yag_motor,initial_det_Yag_pos)
-
-            detector.cam.acquire_time.put(initial_det_exp_time)
-            detector.cam.acquire_period.put(initial_det_aqu_period)
-            detector.cam.num_images.put(initial_det_num_images)
-            detector.cam.num_exposures.put(initial_det_exp_image)
-
-            detector.roi1.min_xyz.min_x.put(initial_det_ROI_Xstart)
-            detector.roi1.size.x.put(initial_det_ROI_Xsize)
-            detector.roi1.min_xyz.min_y.put(initial_det_ROI_Ystart)
-            detector.roi1.size.y.put(initial_det_ROI_Ysize)
-
-        elif 'Gas_cell' in detector_location:
-            yield from mv(Exit_Slit_hgap_motor,initial_Exit_Slit_hgap_pos,
-                          Exit_Slit_vgap_motor,initial_Exit_Slit_vgap_pos,
-                          PGM_Energy_motor,initial_PGM_Energy_pos,
-                          diode_motor,initial_diode_pos)
-
-            detector.em_range.put(initial_det_range)                    # The range to use for the scan
-            detector.values_per_read.put(initial_det_vals_reading)      # The values per reading to use.
-            detector.averaging_time.put(initial_det_avg_time)           # The averaging time to use.
-            detector.integration_time.put(initial_det_int_time)         # The integration time to use.
-
-
-
     if mv_center is True:
-        yield from mv(FE_hgap_axis,max_x,  FE_vgap_axis,max_y)
-    elif return_all is True:
-        yield from mv (FE_hgap_axis,initial_FE_hgap_pos,  FE_vgap_axis,initial_FE_vgap_pos)
+        yield from mv(x_axis,max_x,  y_axis,max_y)
 
 
     #ADD AN OPEN SHUTTER CALL HERE
@@ -1386,7 +1864,8 @@ def FE_slits_alignment(detector_location="Diagon",mv_center=False,return_all=Fal
     return [max_x,max_y]
 
 
-def Mirror_alignment(axes='M1_Ry_M3_Ry',Branch='A',mv_optimum=True,return_all=True):
+def Mirror_alignment(axes='M1_Ry_M3_Ry',Branch='A',mv_optimum=True,return_all=True,method=None,
+                     use_history=True):
     '''
     Aligns the M1 and/or M3 mirrors to the exit slit but looking at the intensity and/or linewidth after
     the exit slit.
@@ -1417,6 +1896,16 @@ def Mirror_alignment(axes='M1_Ry_M3_Ry',Branch='A',mv_optimum=True,return_all=Tr
         This allows for the routine to return all motors moved during the scan to their original locations.
         To use this set return_all = True.
 
+    method : string, optional
+        The method used to find the maximum, the default (None) is a 2D grid scan over the full range, the
+        other options are 'coarse_to_fine' and 'nelder_mead' which find the maximum in far fewer points
+        (see ESM_maximize_2D and benchmark_Mirror_alignment) to the resolution of the grid step sizes.
+
+    use_history : Boolean, optional
+        If True (default) the search is first run over a window around the recent results for these axes,
+        branch and grating (see ESM_alignment_window), the full range is searched if there are none or if the
+        maximum is at the edge of the window. Accepted results are always added to the alignment history.
+
     '''
     # Define some parameters that are to be used in the scan, these are designed to be 'preset' and hence are not
     #'inputted' into the scan.
@@ -1576,90 +2065,336 @@ def Mirror_alignment(axes='M1_Ry_M3_Ry',Branch='A',mv_optimum=True,return_all=Tr
         return None
 
 
-    #Save the initial values of all moved motors so that they can be reset.
-    initial_Und_gap = Und.position                             # The initial Undulator position.
-    initial_PGM_Energy_pos = PGM_Energy_motor.position         # The initial PGM energy.
-    initial_det_range = detector.em_range.get()               # The initial detector range.
-    initial_det_vals_reading = detector.values_per_read.get() # The initial values per reading.
-    initial_det_avg_time = detector.averaging_time.get()      # The initial averaging time.
-    initial_det_int_time = detector.integration_time.get()    # The initial integration time.
-    initial_x_axis_pos = x_axis.position                       # The initial x_axis position.
-    initial_y_axis_pos = y_axis.position                       # The initial y_axis position.
-    initial_Exit_Slit_vgap_pos = Exit_Slit_vgap_motor.position # The initial vertical gap for the exit slit.
-    initial_Exit_Slit_hgap_pos = Exit_Slit_hgap_motor.position # The initial horizontal gap for the exit slit.
-    initial_FE_hgap_pos  = FE_hgap_axis.position              # The initial front end horizontal gap value.
-    initial_FE_vgap_pos  = FE_vgap_axis.position              # The initial front end vertical gap value.
-    initial_Diode_pos = Diode_motor.position                   # The initial location of the diode motor.
+    #Save the initial values of all moved motors (in parallel) so that they can be reset (concurrently) if
+    #'return_all = True', see ESM_restore_wrapper.
+    initial=ESM_settings_snapshot([Und, PGM_Energy_motor, x_axis, y_axis, Exit_Slit_vgap_motor,
+                                   Exit_Slit_hgap_motor, FE_hgap_axis, FE_vgap_axis, Diode_motor,
+                                   detector.em_range, detector.values_per_read, detector.averaging_time,
+                                   detector.integration_time])
+    initial_x_axis_pos = initial.values[x_axis]                # The initial x_axis position.
+    initial_y_axis_pos = initial.values[y_axis]                # The initial y_axis position.
+
+    exclude=[]   # The axes that are not to be reset as they have been moved to the optimum.
+
+    # The search windows [x_start, x_end, y_start, y_end], narrowed around the recent results in the alignment
+    # history if there are any, the scan is always run at PGM_Energy_pos.
+    state=dict(ESM_alignment_state(), energy=PGM_Energy_pos)
+    windows=[[x_start, x_end, y_start, y_end]]
+    if use_history is True:
+        x_window=ESM_alignment_window(scan_type_str, 'x', x_start, x_end, 20*abs(x_stepsize), state=state)
+        y_window=ESM_alignment_window(scan_type_str, 'y', y_start, y_end, 5*abs(y_stepsize), state=state)
+        if x_window[2] is True or y_window[2] is True:
+            windows.insert(0, x_window[:2]+y_window[:2])
+
+    def alignment_scan():
+        nonlocal mv_optimum
+        #Set the values to the correct initial states here.
+
+        #ADD A CLOSE SHUTTER CALL HERE.
+        yield from mv( Und,Und_gap,  x_axis,windows[0][0],  y_axis, windows[0][2],
+                       Exit_Slit_vgap_motor,Exit_Slit_vgap_pos,
+                       Exit_Slit_hgap_motor,Exit_Slit_hgap_pos,  PGM_Energy_motor,PGM_Energy_pos,
+                       FE_hgap_axis,FE_hgap_pos,    FE_vgap_axis,FE_vgap_pos,   Diode_motor,Diode_pos,
+                       detector.em_range,det_range,  detector.values_per_read,det_vals_reading,
+                       detector.averaging_time,det_avg_time,  detector.integration_time,det_int_time)
+
+        #ADD AN OPEN SHUTTER CALL HERE.
+
+        for i, (x_first, x_last, y_first, y_last) in enumerate(windows):
+            # Run the scan
+            if method is None:
+                uid=yield from (scan_2D(detector.name,y_axis,y_first,y_last,y_stepsize,x_axis,x_first,x_last,
+                                        x_stepsize,snake=False,scan_type=scan_type_str))
+            else:
+                uid,output=yield from ESM_maximize_2D([detector],detector.current1.mean_value.name,x_axis,
+                                                      x_first,x_last,y_axis,y_first,y_last,method=method,
+                                                      x_tol=abs(x_stepsize),y_tol=abs(y_stepsize),
+                                                      md={'scan_type':scan_type_str})
+
+            if uid is None:
+                break
+            if method is None:
+                hdr=db[uid]
+                output=max_in_2D(hdr.start.scan_id)
+
+            # if the maximum is at the edge of a narrowed window the full range is searched.
+            if i < len(windows)-1 and (_at_window_edge(output[0], x_first, x_last, abs(x_stepsize)) or
+                                       _at_window_edge(output[1], y_first, y_last, abs(y_stepsize))):
+                print ('The maximum is at the edge of the window from the alignment history, searching the full '
+                       'range')
+            else:
+                break
 
-    #Set the values to the correct initial states here.
 
-    #ADD A CLOSE SHUTTER CALL HERE.
-    yield from mv( Und,Und_gap,  x_axis,x_start,  y_axis, y_start, Exit_Slit_vgap_motor,Exit_Slit_vgap_pos,
-                   Exit_Slit_hgap_motor,Exit_Slit_hgap_pos,  PGM_Energy_motor,PGM_Energy_pos,
-                   FE_hgap_axis,FE_hgap_pos,    FE_vgap_axis,FE_vgap_pos,   Diode_motor,Diode_pos)
+        if uid is not None:
+            print (output)
 
-    detector.em_range.put(det_range)                    # The range to use for the scan
-    detector.values_per_read.put(det_vals_reading)      # The values per reading to use.
-    detector.averaging_time.put(det_avg_time)           # The averaging time to use.
-    detector.integration_time.put(det_int_time)         # The integration time to use.
+            # the output is [x, y, z], see max_in_2D.
+            max_x=output[0]
+            max_y=output[1]
 
-    #ADD AN OPEN SHUTTER CALL HERE.
 
-    # Run the scan
-    uid=yield from (scan_2D([detector],y_axis,y_start,y_end,y_stepsize,x_axis,x_start,x_end,x_stepsize,snake=False,
-                                scan_type=scan_type_str))
+            if abs(max_x/initial_x_axis_pos-1) <= accuracy_level and abs(max_y/initial_y_axis_pos-1) <= accuracy_level:
+                print ("The fitted x axis positions at the ",Branch," ",x_axis.name, " motor are: ",max_x,
+                       ". The fitted y axis positions at the ",Branch," ",y_axis.name, " motor are: ",max_y)
+                ESM_record_alignment(scan_type_str, state=state, x=max_x, y=max_y, value=output[2])
 
+            else:
+                mv_optimum=False
+                print ("WARNING:: THE NEW FITTED POSITION IS DIFFERENT FROM THE OLD POSITION BY ",max(abs(max_x-initial_x_axis_pos),
+                        abs(max_y-initial_y_axis_pos) ),"(The fitted x axis positions at the ",Branch," ",x_axis.name, " motor are: ",max_x,
+                       ". The fitted y axis positions at the ",Branch," ",y_axis.name, " motor are: ",max_y,". The new position has not been set")
+
+        else:
+           mv_optimum=False
+           output=None
 
-    if uid is not None:
-        hdr=db[uid]
-        output=max_in_2D(hdr.start.scan_id)
-        print (output)
+        #ADD A CLOSE PHOTON SHUTTER LINE HERE.
+        if mv_optimum is True:
+            yield from mv( x_axis,max_x,  y_axis, max_y)
+            exclude.extend([x_axis, y_axis])
 
-        max_y=output[0]
-        max_x=output[1]
+        return output
 
+    # Reset the values to the original position if 'return_all = True'
+    output=yield from ESM_restore_wrapper(alignment_scan(), initial, restore=return_all, exclude=exclude)
+
+
+    #ADD AN OPEN SHUTTER CALL HERE
+
+    return output
+
+
+
+def ESM_maximize_2D(detectors, field, x_motor, x_start, x_end, y_motor, y_start, y_end, method='coarse_to_fine',
+                    x_tol=None, y_tol=None, num=7, max_evaluations=300, md=None):
+    '''
+    Finds the position of the maximum of a detector field over 2 motor axes, in far fewer points than a grid.
 
-        if abs(max_x/initial_x_axis_pos-1) <= accuracy_level and abs(max_y/initial_y_axis_pos-1) <= accuracy_level:
-            print ("The fitted x axis positions at the ",Branch," ",x_axis_motor.name, " motor are: ",max_x,
-                   ". The fitted y axis positions at the ",Branch," ",y_axis_motor.name, " motor are: ",max_y)
+    Every evaluation (a move of both motors followed by a reading of the detectors and motors) is recorded
+    as an event in one run. The motors are never moved outside of the x_start to x_end and y_start to y_end
+    box. The methods are:
+
+        'coarse_to_fine' : A num x num grid over the box, followed by num x num grids over a box reduced
+                           (by a factor of (num-1)/2) around the best point so far, until the box half widths
+                           are below x_tol and y_tol.
+        'nelder_mead'    : A Nelder-Mead simplex search (starting from the centre of the box) until the
+                           simplex is smaller than x_tol and y_tol.
+
+    PARAMETERS
+    ----------
+
+    detectors : list
+        The list of 'readable' objects to read at each point.
+
+    field : str
+        The name of the detector field to maximize, eg. 'qem07_current1_mean_value'.
+
+    x_motor, y_motor : motor
+        The motors to move.
+
+    x_start, x_end, y_start, y_end : float
+        The limits of the search for each motor.
+
+    method : str, optional
+        The search method, 'coarse_to_fine' (default) or 'nelder_mead'.
+
+    x_tol, y_tol : float, optional
+        The required resolution for each motor, the default is 1/250 of the range.
+
+    num : int, optional
+        The number of points along each axis of the 'coarse_to_fine' grids.
+
+    max_evaluations : int, optional
+        The maximum number of evaluations.
+
+    md : dict, optional
+        The metadata for the run.
+
+    uid : str, output
+        The unique id of the run.
+
+    output : list, output
+        The x position, y position and field value at the maximum found, as for max_in_2D.
+
+    '''
+    if method not in ('coarse_to_fine', 'nelder_mead'):
+        raise RuntimeError("method needs to be 'coarse_to_fine' or 'nelder_mead'")
+
+    # the search is performed in normalized co-ordinates, (0,0) is (x_start,y_start) and (1,1) is (x_end,y_end).
+    lower=np.array([x_start, y_start], dtype=float)
+    span=np.array([x_end, y_end], dtype=float)-lower
+    tol=np.abs(np.array([x_tol if x_tol else span[0]/250, y_tol if y_tol else span[1]/250])/span)
+
+    evaluations={}
+
+    _md = {'detectors': [detector.name for detector in detectors],
+           'motors': [x_motor.name, y_motor.name],
+           'plan_name': 'ESM_maximize_2D',
+           'method': method,
+           'field': field,
+           'hints': {'dimensions': [(x_motor.hints['fields'], 'primary'), (y_motor.hints['fields'], 'primary')]},
+           }
+    _md.update(md or {})
 
+    def evaluate(point):
+        # move to (and read) a normalized point, returning the field value, repeated points are not re-read.
+        point=np.clip(point, 0, 1)
+        key=tuple(np.round(point/tol*10).astype(int))
+        if key not in evaluations:
+            if len(evaluations) >= max_evaluations:
+                return -np.inf
+            x, y = lower+point*span
+            yield from mv(x_motor, x, y_motor, y)
+            reading=yield from trigger_and_read(list(detectors)+[x_motor, y_motor])
+            evaluations[key]=(point, reading[field]['value'])
+        return evaluations[key][1]
+
+    def best():
+        return max(evaluations.values(), key=lambda evaluation: evaluation[1])
+
+    def coarse_to_fine():
+        centre, half = np.array([0.5, 0.5]), np.array([0.5, 0.5])
+        while len(evaluations) < max_evaluations:
+            for y in np.linspace(centre[1]-half[1], centre[1]+half[1], num):
+                for x in np.linspace(centre[0]-half[0], centre[0]+half[0], num):
+                    yield from evaluate(np.array([x, y]))
+            if np.all(half <= tol):
+                break
+            centre=best()[0]
+            half=np.maximum(half*2/(num-1), tol)
+
+    def nelder_mead():
+        simplex=[np.array([0.5, 0.5]), np.array([0.75, 0.5]), np.array([0.5, 0.75])]
+        values=[]
+        for point in simplex:
+            values.append((yield from evaluate(point)))
+
+        while len(evaluations) < max_evaluations:
+            order=np.argsort(values)[::-1]
+            simplex=[simplex[i] for i in order]
+            values=[values[i] for i in order]
+            if np.all(np.ptp(simplex, axis=0) <= tol):
+                break
+
+            centroid=(simplex[0]+simplex[1])/2
+            reflected=np.clip(2*centroid-simplex[2], 0, 1)
+            value=yield from evaluate(reflected)
+            if value > values[0]:
+                expanded=np.clip(3*centroid-2*simplex[2], 0, 1)
+                expanded_value=yield from evaluate(expanded)
+                if expanded_value > value:
+                    reflected, value = expanded, expanded_value
+                simplex[2], values[2] = reflected, value
+            elif value > values[1]:
+                simplex[2], values[2] = reflected, value
+            else:
+                contracted=(centroid+simplex[2])/2
+                contracted_value=yield from evaluate(contracted)
+                if contracted_value > values[2]:
+                    simplex[2], values[2] = contracted, contracted_value
+                else:
+                    # shrink towards the best point.
+                    for i in (1, 2):
+                        simplex[i]=(simplex[0]+simplex[i])/2
+                        values[i]=yield from evaluate(simplex[i])
+
+    @stage_decorator(list(detectors)+[x_motor, y_motor])
+    @run_decorator(md=_md)
+    def inner_maximize():
+        if method == 'coarse_to_fine':
+            yield from coarse_to_fine()
         else:
-            mv_optimum=False
-            print ("WARNING:: THE NEW FITTED POSITION IS DIFFERENT FROM THE OLD POSITION BY ",max(abs(max_x-initial_x_axis_pos),
-                    abs(max_y-initial_y_axis_pos) ),"(The fitted x axis positions at the ",Branch," ",x_axis_motor.name, " motor are: ",max_x,
-                   ". The fitted y axis positions at the ",Branch," ",y_axis_motor.name, " motor are: ",max_y,". The new position has not been set")
+            yield from nelder_mead()
 
-    else:
-       output=None
-       max_x=None
-       max_y=None
+    uid=yield from inner_maximize()
 
+    point, value = best()
+    x, y = lower+point*span
+    return uid, [float(x), float(y), float(value)]
 
 
-    # Reset the values to the original position if 'return_all = True'
-    #ADD A CLOSE PHOTON SHUTTER LINE HERE.
-    if return_all is True:
-        yield from mv( Und,initial_Und_gap,   Exit_Slit_vgap_motor,initial_Exit_Slit_vgap_pos,
-                       Exit_Slit_hgap_motor,initial_Exit_Slit_hgap_pos,  PGM_Energy_motor,initial_PGM_Energy_pos,
-                       FE_hgap_axis,initial_FE_hgap_pos,    FE_vgap_axis,initial_FE_vgap_pos,   Diode_motor,initial_Diode_pos   )
+def benchmark_Mirror_alignment(x_centre=-0.7061, y_centre=-3641.3, x_sigma=0.0004, y_sigma=6., noise=0.01,
+                               methods=('grid', 'coarse_to_fine', 'nelder_mead'), seed=0):
+    '''
+    Compares the number of evaluations, time taken and error of the grid scan used by Mirror_alignment
+    (M1_Ry_M3_Ry on branch A) with the ESM_maximize_2D methods.
 
-        detector.em_range.put(initial_det_range)                    # The range to use for the scan
-        detector.values_per_read.put(initial_det_vals_reading)      # The values per reading to use.
-        detector.averaging_time.put(initial_det_avg_time)           # The averaging time to use.
-        detector.integration_time.put(initial_det_int_time)         # The integration time to use.
+    The scans are run on instantly moving simulated motors with a separate RunEngine, the intensity is a 2D
+    Gaussian (with relative noise) of the two motor positions.
 
+    PARAMETERS
+    ----------
 
+    x_centre, y_centre : float
+        The position of the maximum for the M3.Ry (x) and M1.Ry (y) simulated motors.
 
-    if mv_optimum is True:
-        yield from mv( x_axis,max_x,  y_axis, max_y)
-    elif return_all is True:
-        yield from mv ( x_axis,initial_x_axis_pos,  y_axis, initial_y_axis_pos)
+    x_sigma, y_sigma : float
+        The width of the Gaussian along each axis.
 
+    noise : float, optional
+        The relative noise on the intensity.
 
-    #ADD AN OPEN SHUTTER CALL HERE
+    methods : list, optional
+        The methods to compare, 'grid' is the current grid scan.
 
-    return output
+    seed : int, optional
+        The random number seed for the noise.
 
+    results : dict, output
+        The number of evaluations, the time taken and the error (in units of the grid step size) for each
+        method.
+
+    '''
+    import time
+    from bluesky import RunEngine
+    from bluesky.plans import grid_scan
+    from ophyd.sim import SynAxis, SynSignal
+
+    x_start, x_end, x_step = -0.7085, -0.7035, 0.00002
+    y_start, y_end, y_step = -3660, -3620, 2
+
+    rng = np.random.default_rng(seed)
+    x_motor = SynAxis(name='sim_M3_Ry')
+    y_motor = SynAxis(name='sim_M1_Ry')
+    intensity = SynSignal(name='sim_intensity', func=lambda:
+                          np.exp(-(x_motor.position-x_centre)**2/(2*x_sigma**2)
+                                 -(y_motor.position-y_centre)**2/(2*y_sigma**2))*(1+noise*rng.standard_normal()))
+
+    sim_RE = RunEngine({})
+    events = []
+    sim_RE.subscribe(lambda name, doc: events.append(doc['data']) if name == 'event' else None)
+
+    results = {}
+    for method in methods:
+        events.clear()
+        start = time.perf_counter()
+        if method == 'grid':
+            sim_RE(grid_scan([intensity], y_motor, y_start, y_end, int(round((y_end-y_start)/y_step))+1,
+                             x_motor, x_start, x_end, int(round((x_end-x_start)/x_step))+1, snake_axes=False))
+            best = max(events, key=lambda data: data['sim_intensity'])
+            x, y = best['sim_M3_Ry'], best['sim_M1_Ry']
+        else:
+            output = []
+            def plan():
+                uid, maximum = yield from ESM_maximize_2D([intensity], 'sim_intensity', x_motor, x_start, x_end,
+                                                          y_motor, y_start, y_end, method=method,
+                                                          x_tol=x_step, y_tol=y_step)
+                output.extend(maximum)
+            sim_RE(plan())
+            x, y = output[:2]
+
+        results[method] = {'evaluations' : len(events), 'time' : time.perf_counter()-start,
+                           'x_error' : abs(x-x_centre)/x_step, 'y_error' : abs(y-y_centre)/y_step}
+
+    print ('{:15s} {:>12s} {:>10s} {:>16s} {:>16s}'.format('method', 'evaluations', 'time (s)', 'M3.Ry error',
+                                                          'M1.Ry error'))
+    for method, result in results.items():
+        print ('{:15s} {:12d} {:10.2f} {:10.1f} steps {:10.1f} steps'.format(method, result['evaluations'],
+                                                                           result['time'], result['x_error'],
+                                                                           result['y_error']))
+
+    return results
 
 
 def M1_M3_alignment(Branch='A',mv_optimum=False,return_all=True):
@@ -1728,54 +2463,121 @@ def ESM_setup_hints(DETS_str):
                     If no '-' is present it reverts to the default 'Total'.
 
 
+    The detector string is compiled once and cached (see ESM_compile_hints), and only the components
+    whose kind needs to change are written.
+
     DETS : Str, output
         An output string that returns a list of detectors from the list
     '''
-    #create the empty DETS list.
-    DETS=""
-
-    #split the detectors str into a list of detector strs
-    DET_list=DETS_str.split(',')
-
-    if DET_list[-1].startswith('@'):
-        #if the detector list is of format 2 type.
-        Channel_list=DET_list[-1]
-        DET_list=DET_list[:-1]
-
-        #set the hints to the unpacked detector list.
-        for i, DET_str in enumerate(DET_list):
-            if i > 0:
-                DETS += ','
-            DETS += DET_str.partition('@')[0]
-            # DAMA (mrakitin) 20180606: channel_list_unpack() returns
-            # a list of values, e.g:
-            #   ['qem12.current1.mean_value',
-            #    'qem12.current2.mean_value',
-            #    'qem12.current3.mean_value',
-            #    'qem12.current4.mean_value']
-            # that's why we need to loop through them.
-            # Also, we need to cut the name of the device
-            # ('qem12' in the example) from the string.
-            for channel in channel_list_unpack(DET_str + Channel_list, dot=True):
-                getattr(ip.user_ns[DET_str], channel.partition('.')[-1]).kind = 'hinted'
+    spec=ESM_compile_hints(DETS_str)
+    spec.apply()
+
+    return spec.DETS
+
+
+# The compiled detector specifications, keyed by DETS_str, see ESM_compile_hints.
+ESM_hint_specs={}
+
+
+class ESM_hint_spec:
+    def __init__(self, DETS_str):
+        '''
+        The compiled form of a detector string, as used by ESM_setup_hints.
+
+        The detector string is parsed once (using channel_list_unpack), the detector objects and the
+        components to be hinted (or reset to normal) are resolved and stored with the kind that each should
+        have.
+
+        PARAMETERS
+        ----------
+        DETS_str : str
+            The detector string, see ESM_setup_hints for the format.
+
+        '''
+        self.DETS_str=DETS_str
+
+        #split the detectors str into a list of detector strs
+        DET_list=DETS_str.split(',')
+        if DET_list[-1].startswith('@'):
+            #if the detector list is of format 2 type, only the listed channels are changed.
+            Channel_list=DET_list[-1]
+            DET_list=DET_list[:-1]
+            reset=False
+        else:
+            #if the detector list is of format 1 type, all other channels are set to 'normal'.
+            Channel_list=''
+            reset=True
+
+        self.DETS=','.join(DET_str.partition('@')[0] for DET_str in DET_list)
+        self.detectors={}
+        self.kinds=[]
+        for DET_str in DET_list:
+            name=DET_str.partition('@')[0]
+            det=ip.user_ns[name]
+            self.detectors[name]=det
+
+            targets={}
+            if reset:
+                for c in det.read_attrs:
+                    targets[c]=Kind.normal
+            for channel in channel_list_unpack(DET_str+Channel_list, dot=True):
+                targets[channel.partition('.')[-1]]=Kind.hinted
+
+            for c, kind in targets.items():
+                self.kinds.append((getattr(det, c), kind))
+
+
+    def valid(self):
+        '''
+        Returns True if the detectors in the user namespace are still the objects that were compiled.
+        '''
+        return all(ip.user_ns.get(name) is det for name, det in self.detectors.items())
+
+
+    def apply(self):
+        '''
+        Sets the kind of each component, only components whose kind ('normal' or 'hinted') differs are
+        changed.
+
+        PARAMETERS
+        ----------
+        changed : int, output
+            The number of components that were changed.
+
+        '''
+        changed=0
+        for component, kind in self.kinds:
+            # only the normal and hinted flags are compared, the config flag is managed by ophyd.
+            if component.kind & Kind.hinted != kind:
+                component.kind=kind
+                changed+=1
+
+        return changed
 
-    else:
-        #if the detector list is of format 1 type.
 
-        #set the hints to the unpacked detector list.
-        for i, DET_str in enumerate(DET_list):
-            if i > 0:
-                DETS += ','
-            DETS += DET_str.partition('@')[0]
-            det = ip.user_ns[DET_str.partition('@')[0]]
-            # set everytrhing unhinted
-            for c in det.read_attrs:
-                getattr(det, c).kind = 'normal'
-            # hint what we asked for
-            for c in channel_list_unpack(DET_str, dot=True):
-                getattr(det, c.partition('.')[-1]).kind = 'hinted'
+def ESM_compile_hints(DETS_str):
+    '''
+    Returns the compiled (and cached) specification for a detector string, see ESM_hint_spec.
+
+    The specification is compiled the first time a detector string is used and reused after that, unless
+    one of the detectors has been re-defined. The cache (ESM_hint_specs) can be cleared to force a
+    recompile.
 
-    return DETS
+    PARAMETERS
+    ----------
+    DETS_str : str
+        The detector string, see ESM_setup_hints for the format.
+
+    spec : ESM_hint_spec, output
+        The compiled specification.
+
+    '''
+    spec=ESM_hint_specs.get(DETS_str)
+    if spec is None or not spec.valid():
+        spec=ESM_hint_spec(DETS_str)
+        ESM_hint_specs[DETS_str]=spec
+
+    return spec
 
 
 
@@ -1823,94 +2625,14 @@ def spiral_square_pattern(x_motor, y_motor, x_centre, y_centre, x_range, y_range
     Returns
     -------
     cyc : cycler
-    '''
-
-
-    x_points, y_points = [], []
-
-    if x_num%2==0:
-        num_st= 2
-        if y_num%2==1:
-           y_num+=1
-
-        offset=0.5
-
-    else:
-        num_st=1
-        if y_num%2==0:
-            y_num+=1
-
-        offset=0
-
-        x_points.append(x_centre)
-        y_points.append(y_centre)
-
-    #print( 'x_range = '+str(x_range)+', x_num = '+str(x_num)  )
-    #print( 'y_range = '+str(y_range)+', y_num = '+str(y_num)  )
-
-    delta_x = x_range/(x_num-1)
-    delta_y = y_range/(y_num-1)
-
-
-
-    num_ring = max(x_num,y_num)
-
-    x_max=x_centre + delta_x * (x_num-1)/2
-    x_min=x_centre - delta_x * (x_num-1)/2
-
-    y_max=y_centre + delta_y * (y_num-1)/2
-    y_min=y_centre - delta_y * (y_num-1)/2
-
-
-
-
-    #print ( 'num_ring = '+str(num_ring)  )
-    for n,i_ring in enumerate(range(num_st, num_ring+1,2)):
-        #print ('x_centre: '+str(x_centre)+', delta_x: '+str(delta_x))
-        #print ('y_centre: '+str(y_centre)+', delta_y: '+str(delta_y))
-        x_ring_max=x_centre + delta_x * (n+offset)
-        y_ring_max=y_centre + delta_y * (n+offset)
-        x_ring_min=x_centre - delta_x * (n+offset)
-        y_ring_min=y_centre - delta_y * (n+offset)
-        #print('i_ring = '+str(i_ring)+', x_ring_min= '+str(x_ring_min)+', y_ring_min= '+str(y_ring_min)  )
-
-        for n in range(1, i_ring):
-            x = x_ring_min+delta_x*(n-1)
-            y = y_ring_min
-
-            if ( (x <= x_max) and (x>= x_min) and (y<=y_max) and (y>=y_min)     ):
-                x_points.append(x)
-                y_points.append(y)
-
-        for n in range(1, i_ring):
-            y = y_ring_min+delta_y*(n-1)
-            x = x_ring_max
-
-            if ( (x <= x_max) and (x>= x_min) and (y<=y_max) and (y>=y_min)     ):
-                x_points.append(x)
-                y_points.append(y)
-
-
-        for n in range(1, i_ring):
-            x = x_ring_max-delta_x*(n-1)
-            y = y_ring_max
-
-            if ( (x <= x_max) and (x>= x_min) and (y<=y_max) and (y>=y_min)     ):
-                x_points.append(x)
-                y_points.append(y)
-
-        for n in range(1, i_ring):
-            y = y_ring_max-delta_y*(n-1)
-            x = x_ring_min
-
-            if ( (x <= x_max) and (x>= x_min) and (y<=y_max) and (y>=y_min)     ):
-                x_points.append(x)
-                y_points.append(y)
-
 
+    The points are generated by ESM_square_spiral_path, which includes the points on the edge of the box that
+    were previously dropped (for some parameters) due to rounding.
+    '''
+    points = ESM_square_spiral_path(x_centre, y_centre, x_range, y_range, x_num, y_num)
 
-    cyc = cycler(x_motor, x_points)
-    cyc += cycler(y_motor, y_points)
+    cyc = cycler(x_motor, points[:,0])
+    cyc += cycler(y_motor, points[:,1])
     return cyc
 
 def spiral_square(detectors, x_motor, y_motor, x_centre, y_centre, x_range,
@@ -1949,14 +2671,8 @@ def spiral_square(detectors, x_motor, y_motor, x_centre, y_centre, x_range,
     :func:`bluesky.plans.spiral_fermat`
     :func:`bluesky.plans.relative_spiral_fermat`
     '''
-    pattern_args = dict(x_motor=x_motor, y_motor=y_motor, x_centre=x_centre,
-                        y_centre=y_centre, x_range=x_range, y_range=y_range,
-                        x_num = x_num, y_num = y_num)
-    cyc = spiral_square_pattern(**pattern_args)
-
-    # Before including pattern_args in metadata, replace objects with reprs.
-    pattern_args['x_motor'] = repr(x_motor)
-    pattern_args['y_motor'] = repr(y_motor)
+    points = ESM_square_spiral_path(x_centre, y_centre, x_range, y_range, x_num, y_num)
+
     _md = {'plan_args': {'detectors': list(map(repr, detectors)),
                          'x_motor': repr(x_motor), 'y_motor': repr(y_motor),
                          'x_centre': x_centre, 'y_centre': y_centre,
@@ -1968,4 +2684,4 @@ def spiral_square(detectors, x_motor, y_motor, x_centre, y_centre, x_range,
           }
     _md.update(md or {})
 
-    return (yield from scan_nd(detectors, cyc, per_step=per_step, md=_md))
+    return (yield from ESM_path_scan(detectors, [x_motor, y_motor], points, per_step=per_step, md=_md))
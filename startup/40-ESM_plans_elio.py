@@ -58,37 +58,15 @@ def ESM_check(return_all=False):
 
 
             ############ Read in the initial settings (motors and detectors)######
-                        #to be able to restore the initial configuration 
+                        #to be able to restore the initial configuration, the settings are read in
+                        #parallel and restored concurrently (see ESM_restore_wrapper)
 
-    initial_Und_gap =Und.position
-    initial_FE_h_center_pos  =FE_h_center.position
-    initial_FE_v_center_pos  =FE_v_center.position
-    initial_FE_hgap_pos = FE_hgap_axis.position
-    initial_FE_vgap_pos = FE_vgap_axis.position
-
-    initial_MM1_InOut_pos = M1.Mirror_InOut.position
-    initial_MM1_Pitch_pos = M1.Mirror_Pitch.position
-    initial_MM1_Roll_pos =  M1.Mirror_Roll.position 
-
-    initial_MM3_X_pos = M3.X.position 
-    initial_MM3_Y_pos = M3.Y.position 
-    initial_MM3_Z_pos = M3.Z.position 
-    initial_MM3_Yaw_pos = M3.Mirror_Yaw.position 
-    initial_MM3_Pitch_pos = M3.Mirror_Pitch.position 
-    initial_MM3_Roll_pos = M3.Mirror_Roll.position 
-    
-    initial_Exit_Slit_hgap_pos = Exit_Slit_hgap_motor.position # The initial horizontal gap opening
-    initial_Exit_Slit_vgap_pos = Exit_Slit_vgap_motor.position # The initial vertical gap opening
-
-    initial_PGM_Energy_pos = PGM_Energy_motor.position         #The initial photon energy.
-    initial_Diode_pos = Diode_motor.position                   # The initial location of the diode motor.
-
-                           # Read the initial values for the 'Gas_cell' detector settings,
- 
-    initial_det_range = detector.em_range.get()               # The initial detector range
-    initial_det_vals_reading = detector.values_per_read.get() # The initial values per reading.
-    initial_det_avg_time = detector.averaging_time.get()      # The initial averaging time.
-    initial_det_int_time = detector.integration_time.get()    # The initial integration time.
+    initial=[Und, FE_h_center, FE_v_center, FE_hgap_axis, FE_vgap_axis,
+             MM1_InOut_motor, MM1_Pitch_motor, MM1_Roll_motor,
+             MM3_X_motor, MM3_Y_motor, MM3_Z_motor, MM3_Yaw_motor, MM3_Pitch_motor, MM3_Roll_motor,
+             Exit_Slit_hgap_motor, Exit_Slit_vgap_motor, PGM_Energy_motor, Diode_motor,
+                           # the 'Gas_cell' detector settings,
+             detector.em_range, detector.values_per_read, detector.averaging_time, detector.integration_time]
 
 
             ############  define the REFERENCE beamline configuration #########   
@@ -125,84 +103,53 @@ def ESM_check(return_all=False):
     last_flux = h.table()['qem07_current1_mean_value']
 
 
-              ############  set the beamline to REFERENCE configuration #########       
+    def reference_check():
+                  ############  set the beamline to REFERENCE configuration #########       
     
-    yield from mv( Und,Und_gap,
-                   FE_h_center, FE_h_center_pos,
-                   FE_v_center, FE_v_center_pos, 
-                   FE_hgap_axis,FE_hgap_pos,
-                   FE_vgap_axis,FE_vgap_pos)
+        yield from mv( Und,Und_gap,
+                       FE_h_center, FE_h_center_pos,
+                       FE_v_center, FE_v_center_pos, 
+                       FE_hgap_axis,FE_hgap_pos,
+                       FE_vgap_axis,FE_vgap_pos)
 
-    yield from mv( MM1_InOut_motor, MM1_InOut_pos,
-                   MM1_Pitch_motor, MM1_Pitch_pos,
-                   MM1_Roll_motor, MM1_Roll_pos)
+        yield from mv( MM1_InOut_motor, MM1_InOut_pos,
+                       MM1_Pitch_motor, MM1_Pitch_pos,
+                       MM1_Roll_motor, MM1_Roll_pos)
 
-    yield from mv( MM3_X_motor, MM3_X_pos,
-                   MM3_Y_motor, MM3_Y_pos,
-                   MM3_Z_motor, MM3_Z_pos,
-                   MM3_Yaw_motor, MM3_Yaw_pos,
-                   MM3_Pitch_motor, MM3_Pitch_pos,
-                   MM3_Roll_motor, MM3_Roll_pos)
+        yield from mv( MM3_X_motor, MM3_X_pos,
+                       MM3_Y_motor, MM3_Y_pos,
+                       MM3_Z_motor, MM3_Z_pos,
+                       MM3_Yaw_motor, MM3_Yaw_pos,
+                       MM3_Pitch_motor, MM3_Pitch_pos,
+                       MM3_Roll_motor, MM3_Roll_pos)
         
-    yield from mv(PGM_Energy_motor,PGM_Energy_pos,
-                  Exit_Slit_hgap_motor,Exit_Slit_hgap_pos,
-                  Exit_Slit_vgap_motor,Exit_Slit_vgap_pos)
-    
-    yield from mv(Diode_motor,Diode_pos)
-
-    detector.em_range.put(det_range)                    # The range to use for the scan
-    detector.values_per_read.put(det_vals_reading)      # The values per reading to use.
-    detector.averaging_time.put(det_avg_time)           # The averaging time to use.
-    detector.integration_time.put(det_int_time)         # The integration time to use.
+        yield from mv(PGM_Energy_motor,PGM_Energy_pos,
+                      Exit_Slit_hgap_motor,Exit_Slit_hgap_pos,
+                      Exit_Slit_vgap_motor,Exit_Slit_vgap_pos)
+    
+        yield from mv(Diode_motor,Diode_pos,
+                      detector.em_range,det_range,                  # The range to use for the scan
+                      detector.values_per_read,det_vals_reading,    # The values per reading to use.
+                      detector.averaging_time,det_avg_time,         # The averaging time to use.
+                      detector.integration_time,det_int_time)       # The integration time to use.
                 
 
-              ############  measure the flux and compare with previous #########       
-    
-        # NB: the string 'Reference_Flux_Check' is crutial: to find the previous flux measuraments 
-
-    uid=yield from (scan_time([detector],num=1,scan_type='Reference_Flux_Check'))  
-    
-        # Read in the flux just measured in the same conditions as last time to be able to compare
-    h = next(iter(db(scan_type='Reference_Flux_Check')))
-    new_flux = h.table()['qem07_current1_mean_value']
-
-    print('old_flux = %e, new_flux = %e, prc_diff = %f' %(last_flux, new_flux, (new_flux-last_flux)/new_flux))
+                  ############  measure the flux and compare with previous #########       
     
+            # NB: the string 'Reference_Flux_Check' is crutial: to find the previous flux measuraments 
 
+        uid=yield from (scan_time([detector],num=1,scan_type='Reference_Flux_Check'))  
     
-             ############# Reset original position if 'return_all = True' #############
+            # Read in the flux just measured in the same conditions as last time to be able to compare
+        h = next(iter(db(scan_type='Reference_Flux_Check')))
+        new_flux = h.table()['qem07_current1_mean_value']
 
-    if return_all is True:
+        print('old_flux = %e, new_flux = %e, prc_diff = %f' %(last_flux, new_flux, (new_flux-last_flux)/new_flux))
 
-        yield from mv( Und,initial_Und_gap,
-                       FE_h_center,    initial_FE_h_center_pos,
-                       FE_v_center,    initial_FE_v_center_pos, 
-                       FE_hgap_axis,   initial_FE_hgap_pos,
-                       FE_vgap_axis,   initial_FE_vgap_pos)
-
-        yield from mv( MM1_InOut_motor, initial_MM1_InOut_pos,
-                       MM1_Pitch_motor, initial_MM1_Pitch_pos,
-                       MM1_Roll_motor,  initial_MM1_Roll_pos)
-        
-        yield from mv( PGM_Energy_motor,      initial_PGM_Energy_pos,
-                       Exit_Slit_hgap_motor,  initial_Exit_Slit_hgap_pos,
-                       Exit_Slit_vgap_motor,  initial_Exit_Slit_vgap_pos)
-
-        yield from mv( MM3_X_motor,     initial_MM3_X_pos,
-                       MM3_Y_motor,     initial_MM3_Y_pos,
-                       MM3_Z_motor,     initial_MM3_Z_pos,
-                       MM3_Yaw_motor,   initial_MM3_Yaw_pos,
-                       MM3_Pitch_motor, initial_MM3_Pitch_pos,
-                       MM3_Roll_motor,  initial_MM3_Roll_pos)
-        
-        yield from mv(Diode_motor,initial_Diode_pos)
 
+             ############# Reset original position if 'return_all = True' #############
 
-        detector.em_range.put(initial_det_range)                    # The range to use for the scan
-        detector.values_per_read.put(initial_det_vals_reading)      # The values per reading to use.
-        detector.averaging_time.put(initial_det_avg_time)           # The averaging time to use.
-        detector.integration_time.put(initial_det_int_time)         # The integration time to use.
-        
+    yield from ESM_restore_wrapper(reference_check(), initial, restore=return_all)
 
     return
 
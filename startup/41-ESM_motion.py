@@ -6,7 +6,8 @@ from scipy.interpolate import interp1d
 import scipy.optimize as opt
 import os
 from bluesky.plans import scan, adaptive_scan, spiral_fermat, spiral,scan_nd 
-from bluesky.plan_stubs import abs_set, mv
+from bluesky.plan_stubs import abs_set, mv, wait, sleep
+from bluesky.utils import short_uid
 from bluesky.preprocessors import baseline_decorator, subs_decorator
 # from bluesky.callbacks import LiveTable,LivePlot, CallbackBase
 #from pyOlog.SimpleOlogClient import SimpleOlogClient
@@ -15,6 +16,7 @@ from cycler import cycler
 from collections import ChainMap
 import math
 import re
+import heapq
 from builtins import input as pyinput
 from boltons.iterutils import chunked
 import sys
@@ -33,6 +35,223 @@ ip=IPython.get_ipython()
 
 ###    ESM motion device definitions
 
+##    Definition of the compiled location table used by the motion device class.
+
+class ESM_location_table:
+    def __init__(self, definition_file_path):
+        '''
+        The compiled form of a motion device definition file.
+
+        The definition file is read once and the information needed for each move is stored in a form
+        that does not need to be rebuilt: the location and axis names with their indices, an array of the
+        target positions (NaN where an axis is not moved) with a mask of the defined positions, the
+        chamber information with arrays of the transfer axis limits and the ophyd object for each axis.
+
+        PARAMETERS
+        ----------
+        definition_file_path : str
+            The path to the definition .csv file, see ESM_motion_device for the format.
+
+        '''
+        self.definition_file_path=definition_file_path
+        self.mtime=os.path.getmtime(definition_file_path)
+
+        f=pd.read_csv(definition_file_path)
+        f=f.set_index('position_info')
+
+        # the raw information, as read by ESM_motion_device.read_location_position_data.
+        self.data_dict={}
+        for row_name in f.index:
+            self.data_dict[row_name]=dict(f.loc[row_name])
+
+        self.locations=list(f.index)
+        self.location_index={location : i for i, location in enumerate(self.locations)}
+        self.axes=list(column for column in f.columns if not column.endswith('_info'))
+        self.axis_index={axis : i for i, axis in enumerate(self.axes)}
+
+        # the target positions, one row per location and one column per axis.
+        self.positions=f[self.axes].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+        self.defined=~np.isnan(self.positions)
+
+        if 'detector_list_info' in f.columns and len(self.locations) > 0:
+            self.detectors=str(self.data_dict[self.locations[0]]['detector_list_info']).split(',')
+        else:
+            self.detectors=[]
+
+        # the chambers, defined by the transfer locations (suffix '_Tr').
+        self.chambers=list(location for location in self.locations if location.endswith('_Tr'))
+        self.chambers_dict={}
+        self.chamber_locations={}
+        if len(self.chambers) <= 0:
+            self.chambers=['No chamber']
+            self.chambers_dict['No chamber']=self.chambers
+            self.chamber_names=[]
+            self.transfer_axis=None
+            self.chamber_low=np.zeros(0)
+            self.chamber_high=np.zeros(0)
+        else:
+            for pos in self.chambers:
+                self.chambers_dict[self.data_dict[pos]['chamber_info']]=self.data_dict[pos]
+                self.chamber_locations[self.data_dict[pos]['chamber_info']]=pos
+            self.chamber_names=list(self.chambers_dict.keys())
+            self.transfer_axis=self.chambers_dict[self.chamber_names[0]]['transfer_axis_name_info']
+            self.chamber_low=np.array([float(self.chambers_dict[chamber]['transfer_axis_low_limit_info'])
+                                       for chamber in self.chamber_names])
+            self.chamber_high=np.array([float(self.chambers_dict[chamber]['transfer_axis_high_limit_info'])
+                                        for chamber in self.chamber_names])
+
+        # the chamber of each location and the order of the chambers along the transfer axis.
+        self.location_chambers={}
+        for location in self.locations:
+            chamber=self.data_dict[location].get('chamber_info', np.nan)
+            self.location_chambers[location]=chamber if isinstance(chamber, str) else None
+        self.chamber_order=[self.chamber_names[i] for i in np.argsort(self.chamber_low)]
+
+        # the location graph, each location is connected to the other locations in the same chamber and
+        # each transfer location is connected to the transfer locations of the neighbouring chambers.
+        self.edges={location : [] for location in self.locations}
+        for location in self.locations:
+            for other in self.locations:
+                if other != location and self.location_chambers[other] == self.location_chambers[location]:
+                    self.edges[location].append((other, None))
+        for chamber, other in zip(self.chamber_order[:-1], self.chamber_order[1:]):
+            self.edges[self.chamber_locations[chamber]].append((self.chamber_locations[other], other))
+            self.edges[self.chamber_locations[other]].append((self.chamber_locations[chamber], chamber))
+
+        # the move schedule for each location, None for locations that are moved one axis at a time.
+        self.schedules={}
+        for location in self.locations:
+            self.schedules[location]=self.compile_schedule(location)
+
+        # the ophyd objects, axes that can not be resolved yet are resolved when first used.
+        self.objects={}
+        for axis in self.axes+self.detectors+[self.transfer_axis]:
+            if axis is not None:
+                try:
+                    self.resolve(axis)
+                except RuntimeError:
+                    pass
+
+
+    def compile_schedule(self, location):
+        '''
+        Returns the move groups and dependencies for a location, see move_group_info and move_after_info in
+        ESM_motion_device.
+
+        PARAMETERS
+        ----------
+        location : str
+            The name of the location.
+
+        schedule : list, output
+            A list of (group, axes, after) tuples in the order they can be started, where axes is the list of
+            axes in the group and after is the list of groups that must finish first. None if the location
+            has no move_group_info or move_after_info entries.
+
+        '''
+        def entries(column):
+            # split a 'name:item item; name:item' entry into a dictionary of lists.
+            value=self.data_dict[location].get(column, np.nan)
+            if not isinstance(value, str) or value.strip() == '':
+                return None
+            if value.strip() == 'None':
+                return {}
+            output={}
+            for entry in value.split(';'):
+                if entry.strip():
+                    name,_,items = entry.partition(':')
+                    output[name.strip()]=items.split()
+            return output
+
+        group_entries=entries('move_group_info')
+        after_entries=entries('move_after_info')
+        if group_entries is None and after_entries is None:
+            return None
+
+        # define the groups, in the order of the first axis in each group.
+        axis_group={}
+        for group, axes in (group_entries or {}).items():
+            for axis in axes:
+                if axis not in self.axis_index:
+                    raise RuntimeError('move_group_info for '+location+' includes unknown axis '+axis)
+                axis_group[axis]=group
+        groups={}
+        for axis, _ in self.moves(location):
+            group=axis_group.get(axis, axis.partition('_')[0])
+            groups.setdefault(group, []).append(axis)
+
+        # define the dependencies, groups with no axes to move for this location are ignored.
+        after={group : [] for group in groups}
+        for group, dependencies in (after_entries or {}).items():
+            for dependency in dependencies:
+                if dependency not in groups and dependency not in axis_group.values() and \
+                   not any(axis.partition('_')[0] == dependency for axis in self.axes):
+                    raise RuntimeError('move_after_info for '+location+' includes unknown group '+dependency)
+            if group in after:
+                after[group]=[dependency for dependency in dependencies if dependency in groups]
+
+        # order the groups so that every group follows the groups it depends on.
+        schedule=[]
+        done=set()
+        while len(schedule) < len(groups):
+            ready=[group for group in groups if group not in done and all(dep in done for dep in after[group])]
+            if not ready:
+                raise RuntimeError('move_after_info for '+location+' contains a circular dependency')
+            for group in ready:
+                schedule.append((group, groups[group], after[group]))
+                done.add(group)
+
+        return schedule
+
+
+    def resolve(self, axis):
+        '''
+        Returns the ophyd object for an axis or detector name of the form 'device_attribute'.
+
+        PARAMETERS
+        ----------
+        axis : str
+            The name of the axis, eg. 'LT_Y'.
+
+        obj : object, output
+            The ophyd object, eg. LT.Y.
+
+        '''
+        if axis not in self.objects:
+            obj,_,attr = axis.partition('_')
+            if obj not in ip.user_ns or not hasattr(ip.user_ns[obj], attr):
+                raise RuntimeError('axis '+str(axis)+' in '+self.definition_file_path+' does not exist')
+            self.objects[axis]=getattr(ip.user_ns[obj],attr)
+
+        return self.objects[axis]
+
+
+    def axes_dict(self, location):
+        '''
+        Returns a dictionary mapping every axis to its position for a location (NaN if not moved).
+        '''
+        return dict(zip(self.axes, self.positions[self.location_index[location]]))
+
+
+    def moves(self, location):
+        '''
+        Returns a list of (axis, position) tuples for the axes that are defined for a location.
+        '''
+        row=self.location_index[location]
+        return [(self.axes[i], self.positions[row, i]) for i in np.flatnonzero(self.defined[row])]
+
+
+    def chamber(self, position):
+        '''
+        Returns the name of the chamber whose transfer axis range contains a position, 'error' if none.
+        '''
+        matches=np.flatnonzero((self.chamber_low <= position) & (position <= self.chamber_high))
+        if len(matches) == 0:
+            return 'error'
+
+        return self.chamber_names[matches[-1]]
+
+
 ##    Definition of the motion device class located at ESM.
 
 class ESM_motion_device:
@@ -57,6 +276,9 @@ class ESM_motion_device:
             A dictionary that holds the information from the definition file with each sample position
             having it's own item callable by the position name keyword.
 
+        location_table: ESM_location_table
+            The compiled definition file, it is recompiled automatically when the file changes.
+
         read_location_position_data: function
             Extracts the data from the .csv definition file to data_dict
 
@@ -85,6 +307,13 @@ class ESM_motion_device:
         move_to: function
             moves the series of motors to the location defined by "location".
 
+        plan_path: function
+            finds the fastest sequence of moves to "location", through any number of chambers, use
+            verbose=True to print the steps and predicted duration without moving.
+
+        transfer_to: function
+            moves the series of motors to "location" along the path found by plan_path.
+
         DEFINITION FILE DESCRIPTION
         ---------------------------
         The definition file is a .csv file which has a column for each motor axis to be defined in the instance. The first 
@@ -113,6 +342,17 @@ class ESM_motion_device:
         For the non transfer locations all of these optional cloumns, with the exception of the chamber_info column, can
         be left blank. 
 
+        By default the axes for a location are moved one after the other, in the order of the columns. The optional
+        columns below allow the axes to be moved concurrently, they are read for each location and if both are left
+        blank for a location the axes are moved one after the other:
+
+        move_group_info - Groups of axes that move together, as 'group:axis axis; group:axis axis' (eg.
+                          'Mirrors:M1_X M3_X'). Axes not listed in a group are grouped by the device name
+                          (eg. 'M3_X' is in the group 'M3').
+        move_after_info - The groups that must finish before a group starts, as 'group:group group; group:group'
+                          (eg. 'M3:M1' moves the M3 axes together after the M1 axes have finished). Groups that
+                          are not listed start immediately, 'None' moves all of the groups concurrently.
+
         '''
 
         
@@ -121,11 +361,36 @@ class ESM_motion_device:
         self.name=name
 
         
-        #define the information dictionaries for the instance.
-        self.data_dict=self.read_location_position_data
+        #define the compiled location table for the instance, it is read when first used.
+        self._location_table=None
+
+        #define the values used to estimate the move times, see estimate_move_time.
+        self.default_velocity=1.
+        self.move_overhead=1.
 
         
     # Define the class properties here
+    @property
+    def location_table(self):
+        '''
+        Returns the compiled location table, recompiling it if the definition file has changed.
+        '''
+        try:
+            mtime=os.path.getmtime(self.definition_file_path)
+        except OSError:
+            mtime=None
+
+        if self._location_table is None or (mtime is not None and mtime != self._location_table.mtime):
+            self._location_table=ESM_location_table(self.definition_file_path)
+
+        return self._location_table
+
+
+    @property
+    def data_dict(self):
+        return self.location_table.data_dict
+
+
     @property
 
     #Define the information functions here
@@ -177,7 +442,7 @@ class ESM_motion_device:
  
         '''
         #define the locations list
-        locations_list=list( self.data_dict.keys()  )
+        locations_list=list(self.location_table.locations)
 
         return locations_list
         
@@ -198,7 +463,7 @@ class ESM_motion_device:
         '''
 
         #define the output list
-        detector_list = (self.data_dict[list(self.data_dict.keys())[0]]['detector_list_info'] ).split(',')
+        detector_list = list(self.location_table.detectors)
 
         return detector_list
     
@@ -218,8 +483,7 @@ class ESM_motion_device:
         '''
 
         #define the output list
-        axes_list = list(key for key in list(self.data_dict[ list(self.data_dict.keys())[0]  ].keys()) if not
-                         key.endswith('_info') )
+        axes_list = list(self.location_table.axes)
 
         return axes_list
 
@@ -241,15 +505,7 @@ class ESM_motion_device:
         self.to_location=to_location
         
         #define the output dictionary
-        
-        axis_dict={}
-        
-        #define the list of axes
-        axis_list=self.axes()
-
-        #define the dicionary of chamber info
-        for axis in axis_list:
-            axis_dict[axis]=self.data_dict[to_location][axis]
+        axis_dict=self.location_table.axes_dict(to_location)
         
         return axis_dict
     
@@ -268,9 +524,7 @@ class ESM_motion_device:
  
         '''
 
-        chamber_list=list(s for s in list(self.data_dict.keys()) if s.endswith('_Tr'))
-        if len(chamber_list) <= 0:
-            chamber_list=['No chamber']
+        chamber_list=list(self.location_table.chambers)
 
         return chamber_list
         
@@ -292,17 +546,7 @@ class ESM_motion_device:
         '''
 
         #define the output dictionary
-        chamber_dict={}
-        
-        #define the list of chambers
-        chamber_list=self.chambers()
-
-        if chamber_list[0] == 'No chamber':
-            chamber_dict['No chamber'] = chamber_list
-        else:
-            #define the dicionary of chamber info
-            for pos in chamber_list:
-                chamber_dict[self.data_dict[pos]['chamber_info']]=self.data_dict[pos]
+        chamber_dict=self.location_table.chambers_dict
         
         return chamber_dict
 
@@ -323,30 +567,16 @@ class ESM_motion_device:
  
         '''
 
-        # define the chamber information dictioanry
-        chamber_dict=self.chambers_dict()
-
-
-
-        chamber_name = 'error'
+        # define the compiled location table
+        table=self.location_table
 
-        if 'No chamber' in list(chamber_dict.keys()):
+        if table.transfer_axis is None:
             chamber_name= 'No chamber'
         else:
-            #define the motor record and axis attribute for the ttransfer axis
-            obj,_,attr = chamber_dict[ list(chamber_dict.keys())[0] ] ['transfer_axis_name_info'].partition('_')
-            #defien the transfer axis object
-            transfer_axis=getattr(ip.user_ns[obj],attr)
-            #determine the current transfer axis postion 
-            axis_pos=transfer_axis.position
-            #determine which chamber contains the axis position. 
-
-            for chamber in list(chamber_dict.keys()):
-                
-                if float(chamber_dict[chamber]['transfer_axis_low_limit_info']) <= axis_pos <= float(chamber_dict[chamber]['transfer_axis_high_limit_info']):
-                    chamber_name=chamber
-
-        
+            #define the transfer axis object
+            transfer_axis=table.resolve(table.transfer_axis)
+            #determine which chamber contains the current transfer axis position.
+            chamber_name=table.chamber(transfer_axis.position)
                     
         return chamber_name
 
@@ -368,9 +598,12 @@ class ESM_motion_device:
                 - 'string_and_file', indicates the routine should return a formatted string and append to a 
                    status file for the device.
                 - 'dict', indicates the routine should return a dictionary of positions.
+                - 'snapshot', indicates the routine should return the snapshot (see ESM_snapshot_log).
+            For 'string_and_file' the snapshot is also appended to the snapshot log ESM_snapshots, see
+            ESM_snapshots.history and ESM_snapshots.diff.
 
         f_string : str
-            Possible output string for formatting.
+            Possible output string for formatting, rendered from a snapshot of all of the values.
 
         status_dict : dict
             Possible outputted dictionary, which has keywords for each motor in the axis list and contains 
@@ -415,44 +648,30 @@ class ESM_motion_device:
             exit_val+=1
             
 
-        f_string='************************************************************\n'
-        f_string+=self.name+' STATUS:  '+time.strftime("%c") + '\n'
-        f_string+='************************************************************\n\n'
-  
-               
-        #step through the detectors and read the values.
-        f_string+='EPICS SIGNAL COMPONENTS\n'
-        f_string+='-----------------------\n'
+        #define the signals and axes to report, grouped by device.
         device_list=list(det_status_dict.keys())
         device_list.sort()
-        for key in device_list:
-            f_string+='    '+key+':\n'
-            key_dict = det_status_dict[key]
-            for det in key_dict:
-                obj,_,attr = det.partition('_')
-                f_string+='\t '+det.ljust(25)+' -->  %f\n' % getattr(ip.user_ns[obj],attr).value
-            f_string+='\n'           
-            
-        # step through the motors and read the values
-        f_string+='EPICS MOTOR COMPONENTS\n'
-        f_string+='-----------------------\n' 
+        det_groups={key : det_status_dict[key] for key in device_list}
+
         device_list=list(status_dict.keys())
         device_list.sort()
         print(device_list)
         ln = len(device_list)
         device_list = device_list[:-3] + device_list[ln-2:]
         print(device_list)
-        for key in device_list:
-            f_string+='    '+key+':\n'
-            key_dict = status_dict[key]
-            for axis in key_dict:
-                obj,_,attr = axis.partition('_')
-                f_string+='\t '+axis.ljust(25)+' -->  %f\n' % getattr(ip.user_ns[obj],attr).position
-            f_string+='\n'
-        
-        if output.startswith('string'):
-            print (f_string)
-            return f_string
+        motor_groups={key : status_dict[key] for key in device_list}
+
+        #read all of the signals and axes at once, recording the snapshot in the log if requested.
+        objects={}
+        for names in list(det_groups.values())+list(motor_groups.values()):
+            for name in names:
+                try:
+                    objects[name]=self.location_table.resolve(name)
+                except RuntimeError:
+                    pass
+        snapshot=ESM_snapshots.take(objects, label=self.name if output.endswith('file') else None)
+
+        f_string=ESM_render_status(self.name, snapshot, det_groups, motor_groups)
 
         if output.endswith('file'):
             fl="/direct/XF21ID1/status_files/"
@@ -461,8 +680,15 @@ class ESM_motion_device:
             f.write(f_string)
             f.close()
 
+        if output.startswith('string'):
+            print (f_string)
+            return f_string
+
         if output == 'dict':
             return status_dict        
+
+        if output == 'snapshot':
+            return snapshot
             
         
     def ask_user_continue(self,request_str):
@@ -488,8 +714,252 @@ class ESM_motion_device:
                 return valid[choice]
 
         
+    #Define the path planning functions here
+
+    def estimate_move_time(self, location, start):
+        '''
+        Returns the estimated time to move the axes for a location, using the velocity of each axis.
+
+        The axes are assumed to move one after the other, or following the move groups and dependencies
+        for locations with move_group_info or move_after_info entries (see move_axes). Axes without a
+        velocity are assumed to move at default_velocity, each move adds move_overhead.
+
+        PARAMETERS
+        ----------
+        location : str
+            The location being moved to.
+
+        start : dict
+            The starting position for each axis, axes that are missing (or NaN) are assumed not to move.
+
+        time : float, output
+            The estimated time in seconds.
+
+        '''
+        table=self.location_table
+        axis_times={}
+        for axis, position in table.moves(location):
+            distance=abs(position-start.get(axis, position))
+            axis_times[axis]=0. if np.isnan(distance) else distance/self.axis_velocity(axis)
+
+        schedule=table.schedules[location]
+        if schedule is None:
+            return sum(axis_times.values())+self.move_overhead
+
+        finish={}
+        for group, axes, after in schedule:
+            finish[group]=max([finish[dependency] for dependency in after]+[0.])+max(axis_times[axis] for axis in axes)
+
+        return max(list(finish.values())+[0.])+self.move_overhead
+
+
+    def axis_velocity(self, axis):
+        '''
+        Returns the velocity of an axis, default_velocity if the axis has no velocity.
+        '''
+        velocity=None
+        try:
+            velocity=self.location_table.resolve(axis).velocity.get()
+        except (RuntimeError, AttributeError):
+            pass
+
+        if not velocity or velocity <= 0:
+            velocity=self.default_velocity
+
+        return float(velocity)
+
+
+    def plan_path(self, location, verbose=False):
+        '''
+        Returns the fastest sequence of moves from the current position to a location.
+
+        The locations are treated as a graph: any location can be reached directly from the current position
+        or from any other location in the same chamber, and the manipulator can move between neighbouring
+        chambers (along the transfer axis) from the transfer location of one chamber to the transfer location
+        of the next. The estimated time of each move (see estimate_move_time) is used to find the shortest
+        path, which may pass through any number of chambers.
+
+        PARAMETERS
+        ----------
+        location : str
+            The location to move to.
+
+        verbose : boolean, optional
+            If True the steps, the gate valves involved and the predicted duration are printed.
+
+        steps : list, output
+            A list of dictionaries, one per move, with the keys 'to' (the location), 'chamber' (the chamber
+            moved into along the transfer axis, or None), 'gate_valve', 'gate_valve_open' and 'time' (the
+            estimated time in seconds).
+
+        '''
+        table=self.location_table
+        if location not in table.location_index:
+            raise RuntimeError('location '+str(location)+' is not defined for '+self.name)
+
+        current={}
+        for axis in table.axes:
+            try:
+                current[axis]=table.resolve(axis).position
+            except RuntimeError:
+                pass
+        from_chamber=self.current_chamber()
+        if from_chamber == 'error':
+            raise RuntimeError('current manipulator position is outside all "chamber" ranges')
+
+        def positions(name):
+            return dict(table.moves(name))
+
+        # the first move can go to any location in the current chamber.
+        start_edges=[(other, None) for other in table.locations
+                     if from_chamber == 'No chamber' or table.location_chambers[other] == from_chamber]
+
+        best={None : 0.}
+        previous={}
+        queue=[(0., 0, None)]
+        counter=1
+        while queue:
+            time_taken, _, name=heapq.heappop(queue)
+            if name == location:
+                break
+            if time_taken > best.get(name, np.inf):
+                continue
+            start=current if name is None else positions(name)
+            for other, chamber in (start_edges if name is None else table.edges[name]):
+                step_time=self.estimate_move_time(other, start)
+                if time_taken+step_time < best.get(other, np.inf):
+                    best[other]=time_taken+step_time
+                    previous[other]=(name, chamber, step_time)
+                    heapq.heappush(queue, (best[other], counter, other))
+                    counter+=1
+
+        if location not in previous:
+            raise RuntimeError('no path found from the current position to '+str(location))
+
+        steps=[]
+        name=location
+        while name is not None:
+            from_name, chamber, step_time=previous[name]
+            step={'to' : name, 'chamber' : chamber, 'gate_valve' : None, 'gate_valve_open' : None,
+                  'time' : step_time}
+            if chamber is not None:
+                step['gate_valve']=table.chambers_dict[chamber]['gate_valve_name_info']
+                step['gate_valve_open']=table.chambers_dict[chamber]['gate_valve_open_info']
+            steps.insert(0, step)
+            name=from_name
+
+        if verbose:
+            print(self.name+': path from '+from_chamber+' to '+location)
+            for i, step in enumerate(steps):
+                if step['chamber'] is None:
+                    print('    {}: move to {:<20} {:8.1f} s'.format(i+1, step['to'], step['time']))
+                else:
+                    print('    {}: transfer to {:<16} {:8.1f} s   (gate valve {}, open: {})'.format(
+                          i+1, step['to'], step['time'], step['gate_valve'], step['gate_valve_open']))
+            print('    predicted duration: {:.1f} s'.format(sum(step['time'] for step in steps)))
+
+        return steps
+
+
+    def transfer_to(self, location):
+        '''
+        Moves the manipulator to a location along the path found by plan_path.
+
+        Before any motion the user is asked to confirm the move and, for any transfer into a chamber whose
+        gate valve is to be opened manually, that the gate valve is open. Each transfer moves the transfer
+        axis and then the other axes to the transfer location of the new chamber. To print the steps and
+        predicted duration without moving use plan_path(location, verbose=True), this is not a plan so it
+        runs when called (instead of when the plan is run by the RunEngine).
+
+        PARAMETERS
+        ----------
+        location : str
+            The location to move to.
+
+        steps : list, output
+            The steps that were performed, see plan_path.
+
+        '''
+        table=self.location_table
+        steps=self.plan_path(location, verbose=True)
+
+        if self.ask_user_continue('This will move the manipulator, unless print_summary was used to call it') ==0:
+            raise RuntimeError('user quit move')
+        for step in steps:
+            if step['gate_valve_open'] in ('Yes', 'Manual'):
+                if self.ask_user_continue('gate valve '+str(step['gate_valve'])+' must be opened or closed for the '+
+                                          'transfer to '+step['chamber']+'. "ARE GATE VALVES OPEN"') ==0:
+                    raise RuntimeError('user quit move')
+
+        for step in steps:
+            if step['chamber'] is not None:
+                transfer_position=dict(table.moves(step['to']))[table.transfer_axis]
+                yield from mv(table.resolve(table.transfer_axis), transfer_position)
+            yield from self.move_axes(step['to'])
+
+        return steps
+
+
     #Define the motion functions here
 
+    def move_axes(self, location, poll_time=0.05):
+        '''
+        Moves the axes defined for a location, without any chamber transfer.
+
+        If the location has move_group_info or move_after_info entries the groups of axes are moved
+        concurrently, each group starting as soon as the groups listed in move_after_info have finished,
+        otherwise the axes are moved one after the other.
+
+        PARAMETERS
+        ----------
+
+        location : str
+            The location to move the axes to.
+
+        poll_time : float, optional
+            The time (in s) between checks for finished groups.
+
+        '''
+        table=self.location_table
+        moves=dict(table.moves(location))
+        schedule=table.schedules[location]
+
+        if schedule is None:
+            for axis, position in moves.items():
+                yield from mv(table.resolve(axis), position)
+            return
+
+        group_ids={group : short_uid(group) for group, _, _ in schedule}
+        statuses={}
+        pending=list(schedule)
+        while pending:
+            # raise the failure of any group that has failed before starting the groups that depend on it.
+            for group in statuses:
+                if any(status.done and not status.success for status in statuses[group]):
+                    yield from wait(group_ids[group])
+
+            started=[]
+            for group, axes, after in pending:
+                if all(dependency in statuses and all(status.done for status in statuses[dependency])
+                       for dependency in after):
+                    statuses[group]=[]
+                    for axis in axes:
+                        statuses[group].append((yield from abs_set(table.resolve(axis), moves[axis],
+                                                                   group=group_ids[group])))
+                    if None in statuses[group]:
+                        # no status is returned outside of the RunEngine (eg. summarize_plan).
+                        statuses[group]=[]
+                        yield from wait(group_ids[group])
+                    started.append(group)
+
+            pending=[entry for entry in pending if entry[0] not in started]
+            if pending and not started:
+                yield from sleep(poll_time)
+
+        for group_id in group_ids.values():
+            yield from wait(group_id)
+
+
     def move_to(self, location):
         
         ''' 
@@ -507,31 +977,22 @@ class ESM_motion_device:
  
         '''
 
-        #define the axes that need to be moved in the transfer.
-        axis_dict=self.axes_dict(location)
-        #print(axis_dict)
-        #print(list(axis for axis in list(axis_dict.keys())))
-        axis_list = list(axis for axis in list(axis_dict.keys()) if not np.isnan(axis_dict[axis]) )
+        #define the compiled location table.
+        table=self.location_table
 
         #check if the transfer goes between chambers
         if self.current_chamber() == 'No chamber':
             #if self.ask_user_continue('This will move the manipulator, unless print_summary was used to call it') ==0:
             #    raise RuntimeError('user quit move')
             #else:
-            for axis in axis_list:
-                #define the motor record and axis attribute for the ttransfer axis
-                obj,_,attr = axis.partition('_')
-                #define the transfer axis object
-                move_axis=getattr(ip.user_ns[obj],attr)
-                #move the axis to the new location
-                yield from mv(move_axis, axis_dict[axis] )
+            yield from self.move_axes(location)
                     
         #if the transfer has multiple chambers.
         else:
 
             from_chamber=self.current_chamber()
-            to_chamber=self.data_dict[location]['chamber_info']
-            chamber_dict=self.chambers_dict()
+            to_chamber=table.data_dict[location]['chamber_info']
+            chamber_dict=table.chambers_dict
         
             if from_chamber == 'error':
                 raise RuntimeError('current manipulator position is outside all "chamber" ranges')
@@ -541,13 +1002,7 @@ class ESM_motion_device:
                     raise RuntimeError('user quit move')
                 else:
                     #MOVE DIRECTLY TO THE NEW POSITION
-                    for axis in axis_list:
-                        #define the motor record and axis attribute for the ttransfer axis
-                        obj,_,attr = axis.partition('_')
-                        #define the transfer axis object
-                        move_axis=getattr(ip.user_ns[obj],attr)
-                        #move the axis to the new location
-                        yield from mv(move_axis, axis_dict[axis] )
+                    yield from self.move_axes(location)
                 
             elif chamber_dict[to_chamber]['gate_valve_open_info'] in ('Yes','Manual') :
                 if self.ask_user_continue('This will move the manipulator and open or close gate valves,'+
@@ -557,39 +1012,19 @@ class ESM_motion_device:
                     if self.ask_user_continue('one or more gate valves must be opened or closed  manually. "ARE GATE VALVES OPEN"') ==0:
                         raise RuntimeError('user quit move')
 
-                    else:
-        
-                        from_axes_list= list(key for key in chamber_dict[from_chamber].keys() if not key.endswith('_info') )
-                        from_axis_list=list(axis for axis in from_axes_list if not np.isnan(chamber_dict[from_chamber][axis]) )
-
                     ####MOVE TO 'FROM CHAMBER' TRANSFER POSITION####
-                    for axis in from_axis_list:
-                        if not axis.endswith('_info'):
-                            #define the motor record and axis attribute for the transfer axis
-                            obj,_,attr = axis.partition('_')
-                            #define the transfer axis object
-                            move_axis=getattr(ip.user_ns[obj],attr)
-                            #move the axis to the new location
-                            yield from mv(move_axis, chamber_dict[from_chamber][axis] )
+                    yield from self.move_axes(table.chamber_locations[from_chamber])
 
                     ####MOVE TO 'TO CHAMBER' TRANSFER POSITION ALONG 'TRANSFER AXIS'####
-                    #define the motor record and axis attribute for the transfer axis
-                    axis=chamber_dict[to_chamber]['transfer_axis_name_info']
-                    obj,_,attr = axis.partition('_')
                     #define the transfer axis object
-                    move_axis=getattr(ip.user_ns[obj],attr)
+                    axis=chamber_dict[to_chamber]['transfer_axis_name_info']
+                    move_axis=table.resolve(axis)
                     #move the axis to the new location
                     yield from mv(move_axis, chamber_dict[to_chamber][axis] )
                     
                     
                     ####MOVE TO POSITION IN 'TO CHAMBER'####
-                    for axis in axis_list:
-                        #define the motor record and axis attribute for the ttransfer axis
-                        obj,_,attr = axis.partition('_')
-                        #define the transfer axis object
-                        transfer_axis=getattr(ip.user_ns[obj],attr)
-                        #move the axis to the new location
-                        yield from mv(transfer_axis, axis_dict[axis] )
+                    yield from self.move_axes(location)
 
                     
             else:
@@ -599,35 +1034,18 @@ class ESM_motion_device:
                 else:
 
                     ####MOVE TO 'FROM CHAMBER' TRANSFER POSITION####
-                    from_axes_list= list(key for key in chamber_dict[from_chamber].keys() if not key.endswith('_info') )
-                    from_axis_list=list(axis for axis in from_axes_list if not np.isnan(chamber_dict[from_chamber][axis]) )
-                    for axis in from_axis_list:
-                        if not axis.endswith('_info'):
-                            #define the motor record and axis attribute for the transfer axis
-                            obj,_,attr = axis.partition('_')
-                            #define the transfer axis object
-                            move_axis=getattr(ip.user_ns[obj],attr)
-                            #move the axis to the new location
-                            yield from mv(move_axis, chamber_dict[from_chamber][axis] )
+                    yield from self.move_axes(table.chamber_locations[from_chamber])
 
                     ####MOVE TO 'TO CHAMBER' TRANSFER POSITION ALONG 'TRANSFER AXIS'####
-                    #define the motor record and axis attribute for the transfer axis
-                    axis=chamber_dict[to_chamber]['transfer_axis_name_info']
-                    obj,_,attr = axis.partition('_')
                     #define the transfer axis object
-                    move_axis=getattr(ip.user_ns[obj],attr)
+                    axis=chamber_dict[to_chamber]['transfer_axis_name_info']
+                    move_axis=table.resolve(axis)
                     #move the axis to the new location
                     yield from mv(move_axis, chamber_dict[to_chamber][axis] )
                     
                     
                     ####MOVE TO POSITION IN 'TO CHAMBER'####
-                    for axis in axis_list:
-                        #define the motor record and axis attribute for the ttransfer axis
-                        obj,_,attr = axis.partition('_')
-                        #define the transfer axis object
-                        transfer_axis=getattr(ip.user_ns[obj],attr)
-                        #move the axis to the new location
-                        yield from mv(transfer_axis, axis_dict[axis] )
+                    yield from self.move_axes(location)
                 
         
     
@@ -0,0 +1,136 @@
+from collections import OrderedDict
+
+
+###MEASUREMENT PRESETS
+###   The following set of code is used to define named measurement modes (eg. the gas cell diode on the A
+###   branch) as a set of detector settings and motor positions, and to apply them in one concurrent plan
+###   step (see ESM_apply_settings), instead of a series of mv and .put() calls.
+
+
+class ESM_preset:
+    def __init__(self, name, settings, description=''):
+        '''
+        A named set of detector settings and motor positions.
+
+        PARAMETERS
+        ----------
+
+        name : str
+            The name of the preset, eg. 'diode_A'.
+
+        settings : list
+            A list of (object, value) tuples, eg. [(BTA2diag.trans, -63), (qem07.em_range, '350 pC')].
+
+        description : str, optional
+            A description of the measurement mode.
+
+        '''
+        self.name=name
+        self.settings=list(settings)
+        self.description=description
+
+
+    def apply(self, verify=True, **kwargs):
+        '''
+        A plan that applies the preset, only the settings that differ from the preset are set and they are
+        all set at once, see ESM_apply_settings.
+
+        PARAMETERS
+        ----------
+
+        verify : boolean, optional
+            If True (default) the settings are read back afterwards and any that do not match are listed in a
+            warning.
+
+        **kwargs : optional
+            The other keyword arguments passed to ESM_apply_settings (atol, rtol, max_workers).
+
+        '''
+        return (yield from ESM_apply_settings(self.settings, verify=verify, action='SET TO '+self.name,
+                                              **kwargs))
+
+
+    def differences(self, atol=1e-6, rtol=1e-6):
+        '''
+        Returns the settings that differ from the preset.
+
+        PARAMETERS
+        ----------
+
+        atol, rtol : float, optional
+            The absolute and relative tolerances used to compare the settings.
+
+        differences : list, output
+            A list of (object, current value, preset value) tuples.
+
+        '''
+        values=_read_settings([obj for obj, target in self.settings])
+        return [(obj, value, target) for (obj, target), value in zip(self.settings, values)
+                if not _same_setting(obj, value, target, atol, rtol)]
+
+
+    def __repr__(self):
+        lines=[self.name+' : '+self.description]
+        for obj, target in self.settings:
+            lines.append('    '+obj.name+' = '+str(target))
+        return '\n'.join(lines)
+
+
+ESM_presets = OrderedDict()
+
+
+def ESM_define_preset(name, settings, description=''):
+    '''
+    Defines (or redefines) a measurement preset, see ESM_preset.
+
+    PARAMETERS
+    ----------
+
+    name : str
+        The name of the preset.
+
+    settings : list
+        A list of (object, value) tuples.
+
+    description : str, optional
+        A description of the measurement mode.
+
+    preset : ESM_preset, output
+        The preset, also stored in ESM_presets.
+
+    '''
+    ESM_presets[name]=ESM_preset(name, settings, description)
+    return ESM_presets[name]
+
+
+def ESM_apply_preset(name, verify=True, **kwargs):
+    '''
+    A plan that applies a measurement preset in one concurrent step, see ESM_preset.apply.
+
+    PARAMETERS
+    ----------
+
+    name : str
+        The name of the preset, the allowed values are the keys of ESM_presets.
+
+    verify : boolean, optional
+        If True (default) the settings are read back afterwards.
+
+    '''
+    if name not in ESM_presets:
+        raise RuntimeError('preset '+str(name)+' is not defined, the defined presets are: '+
+                           ', '.join(ESM_presets.keys()))
+    return (yield from ESM_presets[name].apply(verify=verify, **kwargs))
+
+
+##    Definition of the ESM presets, only the diode position and the electrometer range are included so that
+##    the other electrometer settings (eg. averaging_time, see M3_pitch_alignment) are left as they are.
+
+ESM_define_preset('diode_A', [(BTA2diag.trans, -63), (qem07.em_range, '350 pC')],
+                  'A branch gas cell diode (qem07 channel 1)')
+
+ESM_define_preset('diode_A_ch4', [(BTA2diag.trans, -87), (qem07.em_range, '12 pC')],
+                  'A branch gas cell, BTA2diag at -87 (qem07 channel 4)')
+
+ESM_define_preset('diode_B', [(BTB2diag.trans, -63), (qem12.em_range, '350 pC')],
+                  'B branch gas cell diode (qem12 channel 1)')
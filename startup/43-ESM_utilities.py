@@ -200,38 +200,68 @@ def format_channel_name(DET,Channel,Value='total', dot = False):
         else:
             sep = '_'
 
-        if 'qem' in DET.lower():
-            #if the detector is a qem.
-            if Channel == -1:
-                channel_name=''
-                for i in range(1,5):
-                    if i > 1: channel_name+=','
-                    channel_name+=DET+sep+'current'+str(i)+sep+'mean_value'
-
-            else:
-                channel_name=DET+sep+'current'+str(Channel)+sep+'mean_value'
-
-        elif 'cam' in DET.lower():
-            #if the detctor is a camera.
-            if Channel == -1:
-                channel_name=''
-                for i in range(1,5):
-                    if i > 1: channel_name+=','
-                    channel_name+=DET+sep+'stats'+str(i)+sep+'total,'
-                    channel_name+=DET+sep+'stats'+str(i)+sep+'max_value,'
-                    channel_name+=DET+sep+'stats'+str(i)+sep+'min_value'
-            else:
-                if 'max' in Value or 'min' in Value:
-                    Value+='_value'
-                channel_name=DET+sep+'stats'+str(Channel)+sep+Value
+        for key, handler in ESM_channel_handlers.items():
+            if key in DET.lower():
+                #if the detector is of this type.
+                return ','.join(handler(DET, Channel, Value, sep))
 
-        else:
-            #If the detcor type has not been determined.
-            raise ValueError("Detector type not recognised, name must contain 'qem' or 'cam'.")
+        #If the detcor type has not been determined.
+        raise ValueError('Detector type not recognised, name must contain one of '+
+                         ', '.join("'"+key+"'" for key in ESM_channel_handlers)+'.')
+
+
+def _qem_channel_names(DET, Channel, Value, sep):
+        '''
+        Returns the channel names for a quad electrometer (qem) detector, see ESM_register_channel_handler.
+        '''
+        if Channel == -1:
+            return [DET+sep+'current'+str(i)+sep+'mean_value' for i in range(1,5)]
+
+        return [DET+sep+'current'+str(Channel)+sep+'mean_value']
+
+
+def _cam_channel_names(DET, Channel, Value, sep):
+        '''
+        Returns the channel names for a camera (cam) detector, see ESM_register_channel_handler.
+        '''
+        if Channel == -1:
+            channel_names=[]
+            for i in range(1,5):
+                for value in ('total', 'max_value', 'min_value'):
+                    channel_names.append(DET+sep+'stats'+str(i)+sep+value)
+            return channel_names
 
+        if 'max' in Value or 'min' in Value:
+            Value+='_value'
+        return [DET+sep+'stats'+str(Channel)+sep+Value]
 
 
-        return channel_name
+# The channel name handlers for each detector type, keyed by the (lower case) string that the detector name
+# contains, see ESM_register_channel_handler.
+ESM_channel_handlers={'qem' : _qem_channel_names, 'cam' : _cam_channel_names}
+
+
+def ESM_register_channel_handler(key, handler):
+        '''
+        Adds (or replaces) the channel name handler for a detector type.
+
+        The handler is used by format_channel_name, and so by channel_list_unpack and ESM_setup_hints, for
+        every detector whose name contains key. Any cached detector specifications are cleared.
+
+        PARAMETERS
+        ----------
+        key : str
+            The (lower case) string that the names of this type of detector contain, eg. 'qem'.
+
+        handler : function
+            A function handler(DET, Channel, Value, sep) that returns a list of channel names for the
+            detector name DET, the channel number Channel (all channels if -1), the channel value Value
+            (eg. 'total') and the attribute separator sep ('.' or '_').
+
+        '''
+        ESM_channel_handlers[key.lower()]=handler
+        if 'ESM_hint_specs' in globals():
+            ESM_hint_specs.clear()
 
 
 def ask_user_continue(request_str):
@@ -42,14 +42,12 @@ def macro1():
         uid = yield from scan_1D('qem07',PGM.Energy,Erange[0]*Ephoton,
                                  min(Erange[1]*Ephoton,Eph.Range[grating][1]),0.5)
 
-        yield from mv(BTA2diag.trans,-87)
-        qem07.em_range.put('12 pC')
+        yield from ESM_apply_preset('diode_A_ch4')
 
         uid = yield from scan_1D('qem07@4',PGM.Energy,Erange[0]*Ephoton,
                                  min(Erange[1]*Ephoton,Eph.Range[grating][1]),0.5)
 
-        yield from mv(BTA2diag.trans,-63)
-        qem07.em_range.put('350 pC')
+        yield from ESM_apply_preset('diode_A')
 
 
 def macro2():
@@ -37,7 +37,7 @@ leem_det = LEEMDetector('XF:21ID2{LEEM}:', name='leem_det')
 #leem_det.trigger()
 
 
-def LEEM_plan(grating='600', EPU='105', E_start=100, E_stop=150, E_step=0.1):
+def LEEM_plan(grating='600', EPU='105', E_start=100, E_stop=150, E_step=0.1, single_run=False):
     #Change energy and have LEEM take image
 
      # the grating to use in the scans
@@ -48,6 +48,10 @@ def LEEM_plan(grating='600', EPU='105', E_start=100, E_stop=150, E_step=0.1):
 
     #yield from Beamline.move_to('Branch_A')
 
+    # record all of the images in one run, with the photon energy in the primary stream.
+    if single_run:
+        return (yield from scan_energy_series([leem_det], energies, grating=grating, EPU=EPU))
+
     for energy in energies:
          yield from Eph.move_to(energy, grating=grating, EPU=EPU)
          yield from bp.count([leem_det], num=1)
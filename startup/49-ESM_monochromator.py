@@ -5,8 +5,9 @@ import matplotlib.pyplot as plt
 from scipy.interpolate import interp1d
 import scipy.optimize as opt
 import os
-from bluesky.plans import count, scan, adaptive_scan, spiral_fermat, spiral,scan_nd
-from bluesky.plan_stubs import abs_set, mv
+from bluesky.plans import count, scan, adaptive_scan, spiral_fermat, spiral,scan_nd, list_scan
+from bluesky.plan_stubs import abs_set, mv, wait, one_nd_step
+from bluesky.utils import short_uid
 from bluesky.preprocessors import baseline_decorator, subs_decorator
 # from bluesky.callbacks import LiveTable,LivePlot, CallbackBase
 #from pyOlog.SimpleOlogClient import SimpleOlogClient
@@ -17,70 +18,86 @@ import math
 import re
 from boltons.iterutils import chunked
 import sys
+from ophyd import SoftPositioner
 ip=IPython.get_ipython()
 
 ### READ IN DEFINITION DICTIONARY FROM CSV FILES IN: /home2/xf21id1/.ipython/profile_collection/startup/motion_definition_files/
 
 motion_definition_dir = os.path.join(PROFILE_STARTUP_PATH, 'motion_definition_files')
 
-df = pd.read_csv(os.path.join(motion_definition_dir, 'Grt_Translation.csv'), dtype='float') #you wanted float datatype
-ESM_Grt_Translation = df.to_dict(orient='records')[0] #the[0] extract the dictionary
+# The calibration tables are read from the calibration store (see 38-ESM_calibration.py), which is
+# regenerated from the .csv files in motion_definition_dir whenever they change.
 
-df = pd.read_csv(os.path.join(motion_definition_dir, 'Grt_Offset_A.csv'), dtype='str') #you wanted float datatype
-ESM_Grt_Offset_A = df.to_dict(orient='records')[0] #the[0] extract the dictionary
 
-df = pd.read_csv(os.path.join(motion_definition_dir, 'Grt_Offset_B.csv'), dtype='str') #float datatype
-ESM_Grt_Offset_B = df.to_dict(orient='records')[0] #the[0] extract the dictionary
 
-df = pd.read_csv(os.path.join(motion_definition_dir, 'M2_Offset_A.csv'), dtype='str') #string  datatype
-ESM_M2_Offset_A = df.to_dict(orient='records')[0] #the[0] extract the dictionary
+###LOOKUP TABLE INTERPOLATION
+###    The following class is used to compile the undulator and M3 lookup tables once, so that each call
+###    only performs the range check and the interpolation.
 
-df = pd.read_csv(os.path.join(motion_definition_dir, 'M2_Offset_B.csv'), dtype='str') #string datatype
-ESM_M2_Offset_B = df.to_dict(orient='records')[0] #the[0] extract the dictionary
+class ESM_interpolator:
+    def __init__(self, x, y, name=''):
+        '''
+        A compiled 1D linear interpolator for one of the lookup tables.
 
-df = pd.read_csv(os.path.join(motion_definition_dir, 'c_value_A.csv'), dtype='float') #float datatype
-ESM_c_value_A = df.to_dict(orient='records')[0] #the[0] extract the dictionary
+        The table is sorted and converted to float arrays once, the range limits are also stored, calling
+        the interpolator returns the same values as scipy.interpolate.interp1d (linear) with the same range
+        check used by the original lookup functions.
 
-df = pd.read_csv(os.path.join(motion_definition_dir, 'c_value_B.csv'), dtype='float') #float datatype
-ESM_c_value_B = df.to_dict(orient='records')[0] #the[0] extract the dictionary
+        PARAMETERS
+        ----------
 
-df = pd.read_csv(os.path.join(motion_definition_dir, 'c_value_B.csv'), dtype='float') #float datatype
-ESM_c_value_B = df.to_dict(orient='records')[0] #the[0] extract the dictionary
+        x : list, array or pandas series
+            The independent variable values of the table.
 
-df = pd.read_csv(os.path.join(motion_definition_dir, 'Und_Energy_EPU57_theory.csv'), dtype='float') #float datatype
-ESM_Und_Energy_EPU57_theory = df.to_dict(orient='series') #the[0] extract the dictionary
+        y : list, array or pandas series
+            The dependent variable values of the table.
 
-df = pd.read_csv(os.path.join(motion_definition_dir, 'Und_Energy_EPU57_LH_theory.csv'), dtype='float') #float datatype
-ESM_Und_Energy_EPU57_LH_theory = df.to_dict(orient='series') #the[0] extract the dictionary
+        name : str, optional
+            The name of the table, used for display only.
 
-df = pd.read_csv(os.path.join(motion_definition_dir, 'Und_Energy_EPU57_LV_theory.csv'), dtype='float') #float datatype
-ESM_Und_Energy_EPU57_LV_theory = df.to_dict(orient='series') #the[0] extract the dictionary
+        '''
+        x=np.asarray(x, dtype=float)
+        y=np.asarray(y, dtype=float)
+        order=np.argsort(x, kind='mergesort')
 
-df = pd.read_csv(os.path.join(motion_definition_dir, 'Und_Energy_EPU105_theory.csv'), dtype='float') #float datatype
-ESM_Und_Energy_EPU105_theory = df.to_dict(orient='series') #the[0] extract the dictionary
+        self.name=name
+        self.x=x[order]
+        self.y=y[order]
+        self.x_min=self.x[0]
+        self.x_max=self.x[-1]
 
-df = pd.read_csv(os.path.join(motion_definition_dir, 'Und_Energy_EPU57.csv'), dtype='float') #float datatype
-ESM_Und_Energy_EPU57 = df.to_dict(orient='series')
+    def __call__(self, value, error_str='value out of range of the table'):
+        '''
+        Returns the interpolated value(s).
 
-df = pd.read_csv(os.path.join(motion_definition_dir, 'Und_Energy_EPU105.csv'), dtype='float') #float datatype
-ESM_Und_Energy_EPU105 = df.to_dict(orient='series') 
+        PARAMETERS
+        ----------
 
-df = pd.read_csv(os.path.join(motion_definition_dir, 'Und_Energy_LV_EPU105.csv'), dtype='float') #float datatype
-ESM_Und_Energy_LV_EPU105 = df.to_dict('series') 
+        value : float or array
+            The value(s) to interpolate at.
 
-df = pd.read_csv(os.path.join(motion_definition_dir, 'Und_Energy_EPU105_Cgap_theory.csv'), dtype='float') #float datatype
-ESM_Und_Energy_Cgap_EPU105_theory = df.to_dict('series') 
+        error_str : str, optional
+            The message for the RuntimeError raised if any of the value(s) are outside of the table range.
 
-df = pd.read_csv(os.path.join(motion_definition_dir, 'Und_Energy_EPU105_Cphase_theory.csv'), dtype='float') #float datatype
-ESM_Und_Energy_Cphase_EPU105_theory = df.to_dict('series') 
+        result : float or array, output
+            The interpolated value, a float if value is a scalar and an array otherwise.
 
-df = pd.read_csv(os.path.join(motion_definition_dir, 'Und_Energy_EPU57_Cgap_theory.csv'), dtype='float') #float datatype
-ESM_Und_Energy_Cgap_EPU57_theory = df.to_dict('series') 
+        '''
+        values=np.asarray(value, dtype=float)
 
-df = pd.read_csv(os.path.join(motion_definition_dir, 'Und_Energy_EPU57_Cphase_theory.csv'), dtype='float') #float datatype
-ESM_Und_Energy_Cphase_EPU57_theory = df.to_dict('series') 
+        if values.size and (values.min() < self.x_min or values.max() > self.x_max):
+            raise RuntimeError(error_str)
 
+        result=np.interp(values, self.x, self.y)
+
+        if result.ndim == 0:
+            return float(result)
+        else:
+            return result
 
+    def __repr__(self):
+        return 'ESM_interpolator({}, range=[{}, {}], points={})'.format(self.name, self.x_min, self.x_max,
+                                                                        len(self.x))
 
 
 
@@ -117,6 +134,18 @@ class ESM_monochromator_device:
         self.M3_Angle_300={}                     # the M3 pitch angle vs photon energy for 300l/mm
         self.M3_Angle_600={}                     # the M3 pitch angle vs photon energy for 600l/mm
         self.M3_Angle_800={}                     # the M3 pitch angle vs photon energy for 800l/mm
+        self.table_files={}                  # the calibration table each lookup table is read from
+        self.interpolators={}                # the compiled lookup table interpolators
+        self.as_of=None                      # the date of the calibration to use, None for the current
+        self.pv_cache={}                     # the monitored values of the PGM setpoints and offsets
+        self.pv_cache_subscriptions={}       # the subscriptions that update pv_cache
+        self.use_polarization_planner=False  # use the EPU planned (gap, phase) trajectories, see _EPU_stages
+        self.motion_speeds={'pitch' : 0.5,                 # M2/grating pitch speed (deg/s)
+                            'translation' : 1.,            # grating translation speed (mm/s)
+                            'translation_overhead' : 10.,  # pitch kill and settling per translation (s)
+                            'gap' : 1.,                    # undulator gap speed (mm/s)
+                            'phase' : 1.,                  # undulator phase speed (mm/s)
+                            'EPU_switch_overhead' : 5.}    # moving the other undulator out handshake (s)
         self.set_dicts                       # read the values to the device dictionaries
 
     # Define the class properties here
@@ -126,28 +155,33 @@ class ESM_monochromator_device:
         This routine is used to enter the values into the dictionaries
 
         '''
-        self.Grt_Translation= ESM_Grt_Translation           # grating translation position
-        self.Grt_Offset['A']= ESM_Grt_Offset_A
-        self.Grt_Offset['B']= ESM_Grt_Offset_B
-        self.M2_Offset['A']= ESM_M2_Offset_A
-        self.M2_Offset['B']= ESM_M2_Offset_B
-        self.c_value['A']= ESM_c_value_A
-        self.c_value['B']= ESM_c_value_B
-
-
-        self.Und_Energy['EPU57_theory'] = ESM_Und_Energy_EPU57_theory
-#        self.Und_Energy['EPU57_LH_theory'] = ESM_Und_Energy_EPU57_LH_theory
-#        self.Und_Energy['EPU57_LV_theory'] = ESM_Und_Energy_EPU57-LV_theory
-        
-        self.Und_Energy['EPU105_theory'] = ESM_Und_Energy_EPU105_theory
-        self.Und_Energy['EPU57'] = ESM_Und_Energy_EPU57        
-        self.Und_Energy['EPU105'] = ESM_Und_Energy_EPU105
-        self.Und_Energy_LV['EPU105'] = ESM_Und_Energy_LV_EPU105
-        self.Und_Energy_LV['EPU57'] = ESM_Und_Energy_EPU57_LV_theory 
-        self.Und_Energy_Cgap['EPU105_theory'] = ESM_Und_Energy_Cgap_EPU105_theory
-        self.Und_Energy_Cphase['EPU105_theory'] = ESM_Und_Energy_Cphase_EPU105_theory
-        self.Und_Energy_Cgap['EPU57_theory'] = ESM_Und_Energy_Cgap_EPU57_theory
-        self.Und_Energy_Cphase['EPU57_theory'] = ESM_Und_Energy_Cphase_EPU57_theory
+        as_of=self.as_of
+        self.Grt_Translation= ESM_calibration.records('Grt_Translation', as_of)     # grating translation position
+        self.Grt_Offset['A']= ESM_calibration.records('Grt_Offset_A', as_of)
+        self.Grt_Offset['B']= ESM_calibration.records('Grt_Offset_B', as_of)
+        self.M2_Offset['A']= ESM_calibration.records('M2_Offset_A', as_of)
+        self.M2_Offset['B']= ESM_calibration.records('M2_Offset_B', as_of)
+        self.c_value['A']= ESM_calibration.records('c_value_A', as_of)
+        self.c_value['B']= ESM_calibration.records('c_value_B', as_of)
+
+        # the calibration table that each lookup table is read from.
+        self.table_files[('Und_Energy','EPU57_theory')] = 'Und_Energy_EPU57_theory'
+#        self.table_files[('Und_Energy','EPU57_LH_theory')] = 'Und_Energy_EPU57_LH_theory'
+#        self.table_files[('Und_Energy','EPU57_LV_theory')] = 'Und_Energy_EPU57_LV_theory'
+        self.table_files[('Und_Energy','EPU105_theory')] = 'Und_Energy_EPU105_theory'
+        self.table_files[('Und_Energy','EPU57')] = 'Und_Energy_EPU57'
+        self.table_files[('Und_Energy','EPU105')] = 'Und_Energy_EPU105'
+        self.table_files[('Und_Energy_LV','EPU105')] = 'Und_Energy_LV_EPU105'
+        self.table_files[('Und_Energy_LV','EPU57')] = 'Und_Energy_EPU57_LV_theory'
+        self.table_files[('Und_Energy_Cgap','EPU105_theory')] = 'Und_Energy_EPU105_Cgap_theory'
+        self.table_files[('Und_Energy_Cphase','EPU105_theory')] = 'Und_Energy_EPU105_Cphase_theory'
+        self.table_files[('Und_Energy_Cgap','EPU57_theory')] = 'Und_Energy_EPU57_Cgap_theory'
+        self.table_files[('Und_Energy_Cphase','EPU57_theory')] = 'Und_Energy_EPU57_Cphase_theory'
+
+        for (table, key), name in self.table_files.items():
+            getattr(self, table)[key] = ESM_calibration.table(name, as_of)
+
+        self.interpolators={}                # force a recompile of the lookup tables
 
 
         self.Range['1200']=[130,1500]
@@ -186,6 +220,72 @@ class ESM_monochromator_device:
 
     #Define the information functions here
 
+    def _interpolator(self, table, key, x_col, y_col):
+        '''
+        Returns the compiled interpolator for one of the lookup tables.
+
+        The interpolators are compiled once and kept in self.interpolators, the entry is recompiled if the
+        modification time of the .csv file that the table was read from changes (this is skipped when an
+        older calibration has been selected using 'use_calibration').
+
+        PARAMETERS
+        ----------
+
+        table : str
+            The name of the dictionary attribute holding the table, eg. 'Und_Energy' or 'M3_Angle_300'.
+
+        key : str
+            The keyword for the table in the dictionary, eg. 'EPU57' or 'EPU105_theory'.
+
+        x_col, y_col : str
+            The column names for the independent and dependent variables, eg. 'Energy' and 'Gap'.
+
+        interpolator : ESM_interpolator, output
+            The compiled interpolator.
+
+        '''
+        cache_key=(table, key, x_col, y_col)
+        name=self.table_files.get((table, key))
+
+        #determine the modification time of the source file (None for tables defined in this file).
+        mtime=None
+        if name is not None and self.as_of is None:
+            try:
+                mtime=os.path.getmtime(os.path.join(motion_definition_dir, name+'.csv'))
+            except OSError:
+                name=None
+
+        entry=self.interpolators.get(cache_key)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+
+        #(re)read the table from the calibration store, then compile it.
+        if name is not None:
+            getattr(self, table)[key]=ESM_calibration.table(name, self.as_of)
+
+        data=getattr(self, table)[key]
+        interpolator=ESM_interpolator(data[x_col], data[y_col], name=table+'_'+key)
+        self.interpolators[cache_key]=(mtime, interpolator)
+
+        return interpolator
+
+
+    def use_calibration(self, as_of=None):
+        '''
+        Selects the calibration (offsets, c values and undulator tables) to use.
+
+        PARAMETERS
+        ----------
+
+        as_of : str or datetime, optional
+            The date of the calibration to use (eg. '2024-06-01'), the default (None) uses the current
+            calibration. See ESM_calibration.versions and ESM_calibration.diff for the available versions.
+
+        '''
+        self.as_of=as_of
+        self.set_dicts
+
+
     def Und_g2e(self,gap,EPU='57'):
         '''
         This function returns the photon energy value required for a given undulator gap and undulator.
@@ -193,155 +293,125 @@ class ESM_monochromator_device:
         PARAMETERS
         ----------
 
-        gap : float
-            The undulator gap in mm.
+        gap : float or array
+            The undulator gap in mm, an array of gaps returns an array of energies.
 
 
         EPU : str
             The undulator to use, can be '57' (default, high energy) or '105'(low energy).
 
-        photon_energy : float, output
+        photon_energy : float or array, output
             The photon energy value that is returned.
 
         '''
 
-        # check that the gap value is within the range of the undulator
-        if gap<min(self.Und_Energy['EPU'+EPU]['Gap']) or gap>max(self.Und_Energy['EPU'+EPU]['Gap']):
-            raise RuntimeError('gap value out of range of undulator')
-        else:
-        #return the photon energy
-            gtoe=interp1d(self.Und_Energy['EPU'+EPU]['Gap'],self.Und_Energy['EPU'+EPU]['Energy'])
-            photon_energy=float(gtoe(gap))
-            return photon_energy
+        gtoe=self._interpolator('Und_Energy','EPU'+EPU,'Gap','Energy')
+        return gtoe(gap, 'gap value out of range of undulator')
 
 
 
     def Und_e2g(self,photon_energy,EPU='57'):
         '''
-        This function returns the photon energy value required for a given undulator gap and undulator.
+        This function returns the undulator gap required for a given photon energy and undulator.
 
         PARAMETERS
         ----------
-        photon_energy : float
-            The photon energy value in eV.
+        photon_energy : float or array
+            The photon energy value in eV, an array of energies returns an array of gaps.
 
         EPU : str, optional
             The undulator to use, can be '57' (default, high energy) or '105'(low energy).
-        gap : float, output
+        gap : float or array, output
             The undulator gap in mm.
 
 
 
         '''
 
-        # check that the gap value is within the range of the undulator
-        if photon_energy<min(self.Und_Energy['EPU'+EPU]['Energy']) or photon_energy>max(self.Und_Energy['EPU'+EPU]['Energy']):
-            raise RuntimeError('energy value out of range of undulator')
-        else:
-        #return the photon energy
-            gtoe=interp1d(self.Und_Energy['EPU'+EPU]['Energy'],self.Und_Energy['EPU'+EPU]['Gap'])
-            gap = float(gtoe(photon_energy))
-            return gap
-
-
+        etog=self._interpolator('Und_Energy','EPU'+EPU,'Energy','Gap')
+        return etog(photon_energy, 'energy value out of range of undulator')
 
 
 
     def Und_e2g_LV(self,photon_energy,EPU='105'):
         '''
-        This function returns the photon energy value required for a given undulator gap and undulator.
+        This function returns the undulator gap required for a given photon energy and undulator in LV
+        polarization.
 
         PARAMETERS
         ----------
-        photon_energy : float
-            The photon energy value in eV.
+        photon_energy : float or array
+            The photon energy value in eV, an array of energies returns an array of gaps.
 
         EPU : str, optional
-            The undulator to use, can be '57' (default, high energy) or '105'(low energy).
-        gap : float, output
+            The undulator to use, can be '57' or '105'(default, low energy).
+        gap : float or array, output
             The undulator gap in mm.
 
 
 
         '''
 
-        # check that the gap value is within the range of the undulator
-        if photon_energy<min(self.Und_Energy_LV['EPU'+EPU]['Energy']) or photon_energy>max(self.Und_Energy_LV['EPU'+EPU]['Energy']):
-            raise RuntimeError('energy value out of range of undulator')
-        else:
-        #return the photon energy
-            gtoe=interp1d(self.Und_Energy_LV['EPU'+EPU]['Energy'],self.Und_Energy_LV['EPU'+EPU]['Gap'])
-            gap = float(gtoe(photon_energy))
-            return gap
+        etog=self._interpolator('Und_Energy_LV','EPU'+EPU,'Energy','Gap')
+        return etog(photon_energy, 'energy value out of range of undulator')
+
 
-        
     def Und_e2g_Cgap(self,photon_energy,EPU='105'):
         '''
-        This function returns the photon energy value required for a given undulator gap and undulator.
+        This function returns the undulator gap required for a given photon energy and undulator in circular
+        polarization.
 
         PARAMETERS
         ----------
-        photon_energy : float
-            The photon energy value in eV.
+        photon_energy : float or array
+            The photon energy value in eV, an array of energies returns an array of gaps.
 
         EPU : str, optional
-            The undulator to use, can be '57' (default, high energy) or '105'(low energy).
-        gap : float, output
+            The undulator to use, can be '57' or '105'(default, low energy).
+        gap : float or array, output
             The undulator gap in mm.
 
 
 
         '''
 
-        # check that the gap value is within the range of the undulator
-        if photon_energy<min(self.Und_Energy_Cgap['EPU'+EPU+'_theory']['Energy']) or photon_energy>max(self.Und_Energy_Cgap['EPU'+EPU+'_theory']['Energy']):
-            raise RuntimeError('energy value out of range of undulator')
-        else:
-        #return the photon energy
-            gtoe=interp1d(self.Und_Energy_Cgap['EPU'+EPU+'_theory']['Energy'],self.Und_Energy_Cgap['EPU'+EPU+'_theory']['Gap'])
-            gap = float(gtoe(photon_energy))
-            return gap
-
+        etog=self._interpolator('Und_Energy_Cgap','EPU'+EPU+'_theory','Energy','Gap')
+        return etog(photon_energy, 'energy value out of range of undulator')
 
 
 
     def Und_e2g_Cphase(self,photon_energy,EPU='105'):
         '''
-        This function returns the photon energy value required for a given undulator gap and undulator.
+        This function returns the undulator phase required for a given photon energy and undulator in
+        circular polarization.
 
         PARAMETERS
         ----------
-        photon_energy : float
-            The photon energy value in eV.
+        photon_energy : float or array
+            The photon energy value in eV, an array of energies returns an array of phases.
 
         EPU : str, optional
-            The undulator to use, can be '57' (default, high energy) or '105'(low energy).
-        gap : float, output
-            The undulator gap in mm.
+            The undulator to use, can be '57' or '105'(default, low energy).
+        phase : float or array, output
+            The undulator phase in mm.
 
 
 
         '''
 
-        # check that the gap value is within the range of the undulator
-        if photon_energy<min(self.Und_Energy_Cphase['EPU'+EPU+'_theory']['Energy']) or photon_energy>max(self.Und_Energy_Cphase['EPU'+EPU+'_theory']['Energy']):
-            raise RuntimeError('energy value out of range of undulator')
-        else:
-        #return the photon energy
-            gtoe=interp1d(self.Und_Energy_Cphase['EPU'+EPU+'_theory']['Energy'],self.Und_Energy_Cphase['EPU'+EPU+'_theory']['Phase'])
-            phase = float(gtoe(photon_energy))
-            return phase
+        etop=self._interpolator('Und_Energy_Cphase','EPU'+EPU+'_theory','Energy','Phase')
+        return etop(photon_energy, 'energy value out of range of undulator')
+
 
 
-        
     def M3_e2a(self,photon_energy,grt='300',EPU='105'):
         '''
-        This function returns the M3 angle given the photon energy (for now: only 300, epu105.
+        This function returns the M3 angle given the photon energy (for now: only 300, 600 and 800 with epu105).
 
         PARAMETERS
         ----------
-        photon_energy : float
-            The photon energy value in eV.
+        photon_energy : float or array
+            The photon energy value in eV, an array of energies returns an array of angles.
 
         grt : str, optional
 
@@ -353,38 +423,9 @@ class ESM_monochromator_device:
         '''
 
 
-        if grt == '300' and EPU == '105':
-
-            if photon_energy<min(self.M3_Angle_300['EPU'+EPU]['Energy']) or photon_energy>max(self.M3_Angle_300['EPU'+EPU]['Energy']):
-                                                      # check that the gap value is within the range of the undulator
-                 raise RuntimeError('energy value out of range of undulator')
-            else:
-                                                       #return the photon energy
-                etoa=interp1d(self.M3_Angle_300['EPU'+EPU]['Energy'],self.M3_Angle_300['EPU'+EPU]['ang'])
-                angle = float(etoa(photon_energy))
-                return angle
-
-        elif grt == '600'and EPU == '105':
-
-            if photon_energy<min(self.M3_Angle_600['EPU'+EPU]['Energy']) or photon_energy>max(self.M3_Angle_600['EPU'+EPU]['Energy']):
-                                                      # check that the gap value is within the range of the undulator
-                 raise RuntimeError('energy value out of range of undulator')
-            else:
-                                                       #return the photon energy
-                etoa=interp1d(self.M3_Angle_600['EPU'+EPU]['Energy'],self.M3_Angle_600['EPU'+EPU]['ang'])
-                angle = float(etoa(photon_energy))
-                return angle
-
-        elif grt == '800' and EPU == '105':
-
-            if photon_energy<min(self.M3_Angle_800['EPU'+EPU]['Energy']) or photon_energy>max(self.M3_Angle_800['EPU'+EPU]['Energy']):
-                                                      # check that the gap value is within the range of the undulator
-                 raise RuntimeError('energy value out of range of undulator')
-            else:
-                                                       #return the photon energy
-                etoa=interp1d(self.M3_Angle_800['EPU'+EPU]['Energy'],self.M3_Angle_800['EPU'+EPU]['ang'])
-                angle = float(etoa(photon_energy))
-                return angle
+        if grt in ('300', '600', '800') and EPU == '105':
+            etoa=self._interpolator('M3_Angle_'+grt,'EPU'+EPU,'Energy','ang')
+            return etoa(photon_energy, 'energy value out of range of undulator')
 
 
     def PGM_angles(self, photon_energy,grating,EPU='57',c=None):
@@ -393,8 +434,8 @@ class ESM_monochromator_device:
 
         PARAMETERS
         ----------
-        photon_energy : float
-            The photon energy value in eV.
+        photon_energy : float or array
+            The photon energy value in eV, an array of energies returns arrays of angles.
 
         grating : str
             The lines per mm of the grating to use, can be '300', '600', '800' or '1200'.
@@ -409,17 +450,20 @@ class ESM_monochromator_device:
 
         angles : dict, output
             A dictionary containing the calculated values under the key-words 'alpha', 'beta',
-            'gamma' and 'c'. The angles are returned in degrees.
+            'gamma' and 'c'. The angles are returned in degrees, as floats for a single photon energy
+            or as arrays for an array of photon energies.
 
 
 
         '''
+        X = np.asarray(photon_energy, dtype=float) #energy range in eV
+
         # check that the energy is in the range of the grating and the undulator
-        if (self.Range[grating][0]> photon_energy) or (self.Range[grating][1]< photon_energy):
+        if (self.Range[grating][0]> X.min()) or (self.Range[grating][1]< X.max()):
             raise RuntimeError('photon energy out of range for grating,'+
                                'use Eph.Range to determine the correct grating and EPU')
         if not EPU == None:
-            if (self.Range['EPU'+EPU][0]> photon_energy) or (self.Range['EPU'+EPU][1]< photon_energy):
+            if (self.Range['EPU'+EPU][0]> X.min()) or (self.Range['EPU'+EPU][1]< X.max()):
                 raise RuntimeError('photon energy out of range for undulator,'+
                                    'use Eph.Range to determine the correct grating and EPU')
 
@@ -439,28 +483,208 @@ class ESM_monochromator_device:
         k = [300.0, 600.0, 800.0, 1200.0] #ln per mm
         a1 = [0.0582427, 0.0933142, 0.123453, 0.231924] # VLS first grating coeff
         rad2dg = 180/np.pi
-        b2, X, L, A0, A2, C, alp, beta, gamma  = 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0
         i = k.index(float(grating))
         b2 = -a1[i]/(2*k[i])
-        X= photon_energy #energy range in eV
         L = (1.24/X)*0.001  # wavelenght in mm
         A0 = (k[i]*L)
         A2 = A0*rb*b2
-        if c==None:
+        if c is None:
             C = np.sqrt((2*A2 + 4*(A2/A0)**2 + (4+2*A2-A0**2)*r -4*(A2/A0)*
                      np.sqrt((1+r)**2 + 2*A2*(1+r) -r*A0**2))/(-4 + A0**2 -4*A2 +4*(A2/A0)**2))
         else:
-            C=c
+            C = np.full_like(X, c, dtype=float)
 
         alp = np.arcsin(-A0/(C**2-1) + np.sqrt(1+(C*A0)**2/(C**2-1)**2))   #in radians
         beta = np.arccos(C*np.cos(alp))   # in radians
         gamma = ( alp + beta )/2
 
         angles={'alpha' : alp*rad2dg , 'beta' : beta*rad2dg , 'gamma' : gamma*rad2dg, 'c' : C  }
+
+        # return floats for a single photon energy.
+        if X.ndim == 0:
+            angles={key : float(value) for key, value in angles.items()}
+
         return angles
 
 
-    def change_offsets(self, grating, branch):
+    def energy_table(self, energies, grating='800', branch='A', EPU='57', LP='LH', c='constant'):
+        '''
+        Returns a table of the monochromator and undulator values for a list of photon energies.
+
+        All of the values required to move to each photon energy are calculated, and all of the energies
+        are checked against the grating and undulator ranges, before any motion occurs. The table can
+        then be replayed point by point using 'move_to_point'.
+
+        PARAMETERS
+        ----------
+
+        energies : float, list or array
+            The photon energy value(s) in eV.
+
+        grating : str, optional
+            The lines per mm of the grating to use, can be '300', '600', '800' (default) or '1200'.
+
+        branch : str, optional
+            The beamline branch which is to be used, can be 'A' (default) or 'B'.
+
+        EPU : str, optional
+            The undulator to use, can be '57' (default, high energy), '105'(low energy) or None.
+
+        LP : str, optional
+            The polarization to use, can be 'LH' (default), 'LV', 'CL' or 'CR'.
+
+        c : str, optional
+            This is an optional call to define if the c value should be calculated ('calc') or if the
+            pre-defined dictionary should be used ('constant', default).
+
+        table : pandas.DataFrame, output
+            The table with one row per photon energy, the columns are 'Energy', 'M2_Pitch',
+            'Grating_Pitch', 'alpha', 'c', 'Gap', 'Phase', 'M2_Offset', 'Grt_Offset', 'Grt_Translation',
+            'M3_Pitch', 'grating', 'branch', 'EPU' and 'LP'.
+
+        '''
+        energies=np.atleast_1d(np.asarray(energies, dtype=float))
+
+        if grating not in self.Range:
+            raise RuntimeError("grating entry needs to be '300', '600', '800' or '1200'")
+        if branch not in self.c_value:
+            raise RuntimeError("branch entry needs to be 'A' or 'B'")
+        if LP not in ('LH', 'LV', 'CL', 'CR'):
+            raise RuntimeError("LP entry needs to be 'LH', 'LV', 'CL' or 'CR'")
+
+        # check that all of the requested values are within the range of both the EPU and the grating.
+        out_of_range=(energies < self.Range[grating][0]) | (energies > self.Range[grating][1])
+        if out_of_range.any():
+            raise RuntimeError('photon energies {} out of range for grating,'.format(energies[out_of_range])+
+                               'use Eph.Range to determine the correct grating and EPU')
+        if not EPU==None:
+            out_of_range=(energies < self.Range['EPU'+EPU][0]) | (energies > self.Range['EPU'+EPU][1])
+            if out_of_range.any():
+                raise RuntimeError('photon energies {} out of range for EPU,'.format(energies[out_of_range])+
+                                   'use Eph.Range to determine the correct grating and EPU')
+
+        if c=='calc':
+            c_val = None
+        else:
+            c_val= self.c_value[branch][grating]
+
+        angles=self.PGM_angles(energies, grating, EPU=EPU, c=c_val)
+
+        # determine the undulator gap and phase for each photon energy.
+        gap=np.full_like(energies, np.nan)
+        phase=np.full_like(energies, np.nan)
+        if not EPU==None:
+            if LP == 'LH':
+                gap=self.Und_e2g(energies, EPU=EPU)
+                phase=np.zeros_like(energies)
+            elif LP == 'LV':
+                gap=self.Und_e2g_LV(energies, EPU=EPU)
+                phase=np.full_like(energies, float(EPU)/2)
+            else:
+                gap=self.Und_e2g_Cgap(energies, EPU=EPU)
+                phase=self.Und_e2g_Cphase(energies, EPU=EPU)
+                if LP == 'CR':
+                    phase=-phase
+
+        # Line added for Jurek on March 20, 2023
+        if branch == 'B':
+            if grating =='1200':
+                M3_pitch = -0.7335
+            else:
+                M3_pitch = -0.7361
+        else:
+            M3_pitch = np.nan
+
+        table=pd.DataFrame({'Energy' : energies,
+                            'M2_Pitch' : angles['gamma'],
+                            'Grating_Pitch' : angles['beta'],
+                            'alpha' : angles['alpha'],
+                            'c' : angles['c'],
+                            'Gap' : gap,
+                            'Phase' : phase,
+                            'M2_Offset' : float(self.M2_Offset[branch][grating]),
+                            'Grt_Offset' : float(self.Grt_Offset[branch][grating]),
+                            'Grt_Translation' : self.Grt_Translation[grating],
+                            'M3_Pitch' : M3_pitch,
+                            'grating' : grating,
+                            'branch' : branch,
+                            'EPU' : EPU,
+                            'LP' : LP})
+
+        return table
+
+
+    def cached_value(self, signal):
+        '''
+        Returns the value of a signal from the monitor fed cache.
+
+        The first call for a signal subscribes to it (a CA monitor for EPICS signals), after that the value
+        is updated by the monitor and no Channel Access read is required. If the signal is disconnected, or
+        no value has arrived yet, the value is read directly.
+
+        PARAMETERS
+        ----------
+
+        signal : Signal
+            The signal to return the value of.
+
+        value : output
+            The current value of the signal.
+
+        '''
+        if signal not in self.pv_cache_subscriptions:
+            self.pv_cache[signal] = None
+
+            def update_cache(value, **kwargs):
+                self.pv_cache[signal] = value
+
+            self.pv_cache_subscriptions[signal] = signal.subscribe(update_cache, run=True)
+
+        value = self.pv_cache.get(signal)
+        if value is None or not getattr(signal, 'connected', True):
+            value = signal.get()
+            self.pv_cache[signal] = value
+
+        return value
+
+
+    def cache_matches(self, signal, value, atol=1e-9):
+        '''
+        Returns True if the cached value of a signal matches the requested value.
+
+        PARAMETERS
+        ----------
+
+        signal : Signal
+            The signal to compare.
+
+        value : float
+            The requested value.
+
+        atol : float, optional
+            The absolute tolerance for the comparison.
+
+        match : bool, output
+            True if the values match (and no write is required).
+
+        '''
+        try:
+            return bool(np.isclose(float(self.cached_value(signal)), float(value), rtol=0, atol=atol))
+        except (TypeError, ValueError):
+            return False
+
+
+    def clear_pv_cache(self):
+        '''
+        Removes the subscriptions and empties the PV cache, the next move reads all of the values again.
+        '''
+        for signal, cid in self.pv_cache_subscriptions.items():
+            signal.unsubscribe(cid)
+        self.pv_cache_subscriptions={}
+        self.pv_cache={}
+
+
+    def change_offsets(self, grating, branch, M2_offset=None, Grt_offset=None, PGM_dev=None):
         '''
         This routine is used to change the grating and M2 mirror offsets using set.
 
@@ -477,13 +701,32 @@ class ESM_monochromator_device:
         branch : str
             The beamline branch which is to be used, can be 'A' (default) or 'B'.
 
+        M2_offset, Grt_offset : float, optional
+            The M2 and grating offsets to use, if omitted they are read from the offset dictionaries.
+
+        PGM_dev : Monochromator, optional
+            The monochromator device to use, defaults to PGM.
+
         '''
+        if PGM_dev is None:
+            PGM_dev = PGM
+        if M2_offset is None:
+            M2_offset = float(self.M2_Offset[branch][grating])
+        if Grt_offset is None:
+            Grt_offset = float(self.Grt_Offset[branch][grating])
+
         #3/17/21 Note - commented out changing USE/SET, which should not be needed and may cause loss of home pos
         #yield from mv(PGM.Mirror_Pitch_set, 1 , PGM.Grating_Pitch_set, 1)
 
-        yield from mv(PGM.Mirror_Pitch_off, float(self.M2_Offset[branch][grating]) ,
-                      PGM.Grating_Pitch_off, float(self.Grt_Offset[branch][grating]),
-                      PGM.Grating_lines,float(grating) )
+        # only write the values that differ from the current (cached) values.
+        move_args = []
+        for signal, value in ((PGM_dev.Mirror_Pitch_off, M2_offset), (PGM_dev.Grating_Pitch_off, Grt_offset),
+                              (PGM_dev.Grating_lines, float(grating))):
+            if not self.cache_matches(signal, value):
+                move_args += [signal, value]
+
+        if move_args:
+            yield from mv(*move_args)
 
         #yield from mv(PGM.Mirror_Pitch_set, 0 , PGM.Grating_Pitch_set, 0)
 
@@ -492,7 +735,8 @@ class ESM_monochromator_device:
 
 
 
-    def move_to(self,photon_energy,grating='800',branch='A',EPU='57',LP='LH', c='constant',shutter='close'):
+    def move_to(self,photon_energy,grating='800',branch='A',EPU='57',LP='LH', c='constant',shutter='close',
+                concurrent=False):
         '''
         Sets the monochromator and undulator to the correct values for the given photon energy
 
@@ -520,17 +764,57 @@ class ESM_monochromator_device:
         shutter : str, optional
             This string is used to to optionally have the shutter remain open during the move.
 
+        concurrent : bool, optional
+            If True the undulator moves run alongside the M2 and grating pitch steps, see 'move_to_point'.
+
         '''
 
 
-        # check that the requested value is within the range of both the EPU and the grating.
-        if (self.Range[grating][0]> photon_energy) or (self.Range[grating][1]< photon_energy):
-            raise RuntimeError('photon energy out of range for grating,'+
-                               'use Eph.Range to determine the correct grating and EPU')
-        elif not EPU==None:
-            if (self.Range['EPU'+EPU][0]> photon_energy) or (self.Range['EPU'+EPU][1]< photon_energy):
-                raise RuntimeError('photon energy out of range for EPU,'+
-                                   'use Eph.Range to determine the correct grating and EPU')
+        # calculate (and range check) the values for the requested photon energy.
+        table=self.energy_table(photon_energy, grating=grating, branch=branch, EPU=EPU, LP=LP, c=c)
+
+        yield from self.move_to_point(table.iloc[0], shutter=shutter, concurrent=concurrent)
+
+
+    def move_to_point(self, point, shutter='close', concurrent=False, devices=None):
+        '''
+        Sets the monochromator and undulator to the values from one row of an energy table.
+
+        PARAMETERS
+        ----------
+
+        point : pandas.Series or dict
+            One row of the table returned by 'energy_table'.
+
+        shutter : str, optional
+            This string is used to to optionally have the shutter remain open during the move.
+
+        concurrent : bool, optional
+            If True the undulator moves are issued as a separate group that runs alongside the M2 and grating
+            pitch steps, the routine waits for both at the end. The undulator moves are only overlapped if
+            the gap is safe to actuate (UgapPositioner.safe_to_actuate), otherwise they are done after the
+            PGM as for concurrent=False (default).
+
+        devices : dict, optional
+            The devices to move, under the keywords 'PGM', 'M3' and 'EPU', these default to PGM, M3 and
+            the EPU from the point. Used to run the motion on simulated devices.
+
+        '''
+        grating=point['grating']
+        branch=point['branch']
+        EPU=point['EPU']
+        LP=point['LP']
+
+        if devices is None:
+            devices = {}
+        PGM_dev = devices['PGM'] if 'PGM' in devices else PGM
+        M3_dev = devices['M3'] if 'M3' in devices else M3
+        if EPU is None:
+            EPU_dev = None
+        elif 'EPU' in devices:
+            EPU_dev = devices['EPU']
+        else:
+            EPU_dev = ip.user_ns['EPU'+EPU]
 
         #shut the front end shutter prior to moving.
         # DAMA (mrakitin): commenting it out on 06/02/2018
@@ -539,85 +823,138 @@ class ESM_monochromator_device:
         #     yield from mv(shutter_FOE, 'Close')
 
         #Set the offsets and translations for the requested locations.
-        yield from self.change_offsets(grating, branch)
-        if PGM.Grating_Trans.user_setpoint.value != self.Grt_Translation[grating]:
-            yield from mv(PGM.Mirror_Pitch_kill, 1)
-            yield from mv(PGM.Grating_Pitch_kill, 1)
-            yield from mv(PGM.Grating_Trans, self.Grt_Translation[grating])
+        yield from self.change_offsets(grating, branch, M2_offset=point['M2_Offset'],
+                                       Grt_offset=point['Grt_Offset'], PGM_dev=PGM_dev)
+        if not self.cache_matches(PGM_dev.Grating_Trans.user_setpoint, point['Grt_Translation']):
+            yield from mv(PGM_dev.Mirror_Pitch_kill, 1)
+            yield from mv(PGM_dev.Grating_Pitch_kill, 1)
+            yield from mv(PGM_dev.Grating_Trans, point['Grt_Translation'])
 
         # Line added for Jurek on March 20, 2023
         if branch == 'B':
-            if grating =='1200':
-                yield from mv(M3.Mirror_Pitch, -0.7335)
-            else:
-                yield from mv(M3.Mirror_Pitch, -0.7361)
+            yield from mv(M3_dev.Mirror_Pitch, point['M3_Pitch'])
 
         #print('PGM M2 pos', PGM.Mirror_Pitch.position)
         #print('PGM GR pos', PGM.Grating_Pitch.position)
 
+        # determine the sequence of undulator moves.
+        EPU_stages = self._EPU_stages(point, EPU_dev)
+        if concurrent and EPU_stages and not EPU_dev.gap.safe_to_actuate():
+            print('EPU'+EPU+' gap is not safe to actuate, moving the EPU after the PGM')
+            concurrent = False
+
+        EPU_group = short_uid('EPU')
+        EPU_statuses = []
+
+        def EPU_advance():
+            # issue the next stage of undulator moves if the previous stage has finished.
+            nonlocal EPU_statuses
+            if EPU_stages and all(status.done for status in EPU_statuses):
+                if not all(status.success for status in EPU_statuses):
+                    # leave the failure to be raised by the final wait.
+                    EPU_stages.clear()
+                    return
+                EPU_statuses = []
+                for obj, value in EPU_stages.pop(0):
+                    EPU_statuses.append((yield from abs_set(obj, value, group=EPU_group)))
+                if None in EPU_statuses:
+                    # no status is returned outside of the RunEngine (eg. summarize_plan).
+                    EPU_statuses = []
+                    yield from wait(EPU_group)
+
+        if concurrent:
+            yield from EPU_advance()
+
         #Determine the number of steps and make the step arrays to use when moving the photon energy.
-        n_steps=int(max(round( abs(self.PGM_angles(photon_energy,grating,EPU=EPU)['gamma']- PGM.Mirror_Pitch.position)/1  ),
-                        round( abs(self.PGM_angles(photon_energy,grating,EPU=EPU)['beta']- PGM.Grating_Pitch.position)/2  ) ) )
+        n_steps=int(max(round( abs(point['M2_Pitch']- PGM_dev.Mirror_Pitch.position)/1  ),
+                        round( abs(point['Grating_Pitch']- PGM_dev.Grating_Pitch.position)/2  ) ) )
         if n_steps == 0: n_steps = 1 # if the number of steps is 0 set it to 1
 
         #print('n = ', n_steps)
 
         # divide the range of motion of M2 and the grating into 'n_steps' even steps
-
-        if c=='calc':
-            c_val = None
-        else:
-            c_val= self.c_value[branch][grating]
-
-
         if n_steps==1:
-            M2_steps=[(self.PGM_angles(photon_energy,grating,EPU=EPU,
-                                             c=c_val)['gamma'])]
-            GRT_steps=[(self.PGM_angles(photon_energy,grating,EPU=EPU,
-                                             c=c_val)['beta'])]
+            M2_steps=[point['M2_Pitch']]
+            GRT_steps=[point['Grating_Pitch']]
         else:
-            M2_steps=np.linspace(PGM.Mirror_Pitch.position,
-                             self.PGM_angles(photon_energy,grating,EPU=EPU,
-                                             c=c_val)['gamma'], num=n_steps)
-            GRT_steps=np.linspace(PGM.Grating_Pitch.position,
-                              self.PGM_angles(photon_energy,grating,EPU=EPU,
-                                              c=c_val)['beta'], num=n_steps)
+            M2_steps=np.linspace(PGM_dev.Mirror_Pitch.position, point['M2_Pitch'], num=n_steps)
+            GRT_steps=np.linspace(PGM_dev.Grating_Pitch.position, point['Grating_Pitch'], num=n_steps)
 
 
         for i in range(n_steps):   # set position of M2 pitch and GRT pitch step by step.
-            yield from mv(PGM.Mirror_Pitch, M2_steps[i],    PGM.Grating_Pitch, GRT_steps[i])
+            yield from mv(PGM_dev.Mirror_Pitch, M2_steps[i],    PGM_dev.Grating_Pitch, GRT_steps[i])
+            if concurrent:
+                yield from EPU_advance()
 
 #        print('arrived here')
         # next line removed in march 22 (Elio)
-#        yield from mv(PGM.Focus_Const, self.PGM_angles(photon_energy,grating,EPU=EPU, c=c_val)['c'],
-#                      PGM.Energy, photon_energy)
+#        yield from mv(PGM.Focus_Const, point['c'], PGM.Energy, point['Energy'])
+
+        if concurrent:
+            # finish the remaining undulator moves.
+            while EPU_stages:
+                yield from wait(EPU_group)
+                yield from EPU_advance()
+            yield from wait(EPU_group)
+        else:
+            for stage in EPU_stages:
+                yield from mv(*[item for pair in stage for item in pair])
+
+
+    def _EPU_stages(self, point, EPU_dev):
+        '''
+        Returns the sequence of undulator moves required for one row of an energy table.
+
+        If self.use_polarization_planner is True (and the undulator has a planner, see
+        EPU_polarization_planner) the planned safe trajectory is used, which moves the gap and phase
+        together where the safe envelope allows, otherwise the gap and phase are moved one at a time.
+
+        PARAMETERS
+        ----------
+
+        point : pandas.Series or dict
+            One row of the table returned by 'energy_table'.
+
+        EPU_dev : EPU
+            The undulator device to move, None for no undulator moves.
+
+        stages : list, output
+            A list of stages to be moved one after the other, each stage is a list of (positioner, value)
+            tuples that are moved together.
+
+        '''
+        EPU=point['EPU']
+        LP=point['LP']
+        stages=[]
+
+        if EPU==None:
+            return stages
+
+        if self.use_polarization_planner and hasattr(EPU_dev, 'polarization_stages'):
+            return EPU_dev.polarization_stages(point['Gap'], point['Phase'])
+
+        if LP == 'LH':
+            if  np.abs(EPU_dev.phase.readback.value)  < 0.1:
+                 print('already LH phase')
+                 pass
+            else:
+                 stages.append([(EPU_dev.phase, point['Phase'])])
+            stages.append([(EPU_dev.gap, point['Gap'])])
+        elif LP == 'LV':
+#            stages.append([(EPU_dev.gap, 100.0)])
+            if  np.abs(EPU_dev.phase.readback.value - point['Phase']) < 0.1:
+                print('already LV phase')
+                pass
+            else:
+                stages.append([(EPU_dev.phase, point['Phase'])])
+            stages.append([(EPU_dev.gap, point['Gap'])])
+        elif LP in ('CL', 'CR'):
+            stages.append([(EPU_dev.gap, 100.0)])
+            stages.append([(EPU_dev.phase, point['Phase'])])
+            stages.append([(EPU_dev.gap, point['Gap'])])
+
+        return stages
 
-                        
-        if not EPU==None:
-            if LP == 'LH':
-                if  np.abs(getattr(ip.user_ns['EPU'+EPU],'phase').readback.value)  < 0.1:
-                     print('already LH phase')
-                     pass
-                else:
-                     yield from mv(getattr(ip.user_ns['EPU'+EPU],'phase'), 0.0 )
-                yield from mv(getattr(ip.user_ns['EPU'+EPU],'gap'), self.Und_e2g(photon_energy,EPU=EPU) )
-            elif LP == 'LV':
-#                yield from mv(getattr(ip.user_ns['EPU'+EPU],'gap'), 100.0 )                
-                if  np.abs(getattr(ip.user_ns['EPU'+EPU],'phase').readback.value - float(EPU)/2) < 0.1:
-                    print('already LV phase')
-                    pass
-                else:
-                    yield from mv(getattr(ip.user_ns['EPU'+EPU],'phase'), float(EPU)/2 )
-                yield from mv(getattr(ip.user_ns['EPU'+EPU],'gap'), self.Und_e2g_LV(photon_energy,EPU=EPU) )
-            elif LP == 'CL':
-                yield from mv(getattr(ip.user_ns['EPU'+EPU],'gap'), 100.0 )                
-                yield from mv(getattr(ip.user_ns['EPU'+EPU],'phase'), self.Und_e2g_Cphase(photon_energy,EPU=EPU) )
-                yield from mv(getattr(ip.user_ns['EPU'+EPU],'gap'), self.Und_e2g_Cgap(photon_energy,EPU=EPU) )
-            elif LP == 'CR':
-                yield from mv(getattr(ip.user_ns['EPU'+EPU],'gap'), 100.0 )                
-                yield from mv(getattr(ip.user_ns['EPU'+EPU],'phase'),-self.Und_e2g_Cphase(photon_energy,EPU=EPU) )
-                yield from mv(getattr(ip.user_ns['EPU'+EPU],'gap'), self.Und_e2g_Cgap(photon_energy,EPU=EPU) )
-                
         # if shutter is 'close':
         #     yield from mv(shutter_FOE, 'Open')
 
@@ -632,8 +969,233 @@ class ESM_monochromator_device:
 #        return
 
 
+    def estimate_move_time(self, previous, point):
+        '''
+        Returns an estimate of the time taken to move between two rows of energy tables.
 
+        The estimate uses the speeds in self.motion_speeds, it includes the grating translation (with the
+        pitch kills), the M2 and grating pitch moves, moving the other undulator out when the undulator is
+        changed and the undulator gap and phase moves (including the move to 100 mm for circular
+        polarization). The PGM and undulator moves are assumed to be sequential.
 
+        PARAMETERS
+        ----------
+
+        previous : pandas.Series, dict or None
+            The row for the starting point, if None the time is 0.
+
+        point : pandas.Series or dict
+            The row for the end point.
+
+        time : float, output
+            The estimated time in seconds.
+
+        '''
+        if previous is None:
+            return 0.
+
+        speeds=self.motion_speeds
+        move_time=0.
+
+        if previous['grating'] != point['grating']:
+            move_time+=(speeds['translation_overhead'] +
+                        abs(point['Grt_Translation']-previous['Grt_Translation'])/speeds['translation'])
+
+        move_time+=max(abs(point['M2_Pitch']-previous['M2_Pitch']),
+                       abs(point['Grating_Pitch']-previous['Grating_Pitch']))/speeds['pitch']
+
+        if point['EPU'] is None:
+            return move_time
+
+        if previous['EPU'] != point['EPU']:
+            # move the previous undulator out, the new undulator starts open.
+            if previous['EPU'] is not None:
+                move_time+=speeds['EPU_switch_overhead'] + abs(220.-previous['Gap'])/speeds['gap']
+            previous_gap, previous_phase = 220., 0.
+        else:
+            previous_gap, previous_phase = previous['Gap'], previous['Phase']
+
+        if point['LP'] in ('CL', 'CR'):
+            move_time+=(abs(previous_gap-100.) + abs(100.-point['Gap']))/speeds['gap']
+        else:
+            move_time+=abs(point['Gap']-previous_gap)/speeds['gap']
+        move_time+=abs(point['Phase']-previous_phase)/speeds['phase']
+
+        return move_time
+
+
+    def plan_campaign(self, targets, branch='A', gratings=('300', '600', '800', '1200'), EPUs=('57', '105'),
+                      start=None, c='constant', max_permutations=5040):
+        '''
+        Returns the order and grating/undulator for a set of photon energies that minimizes the estimated
+        total motion time.
+
+        Every target is assigned to a grating and undulator whose ranges (Eph.Range and the undulator
+        tables) include the photon energy. The sets of grating/undulator configurations that cover all of
+        the targets are enumerated, for each set the configurations are visited in every order (or
+        greedily if there are more than max_permutations orders) with the energies in each configuration
+        grouped by polarization and swept alternately up and down. The sequence with the lowest estimated
+        motion time (see estimate_move_time) is returned.
+
+        The result can be used directly with Eph.move_to, eg.:
+
+            for move in Eph.plan_campaign([(100,'LH'), (500,'LH'), (250,'LV')]):
+                yield from Eph.move_to(**move)
+                yield from count(detectors)
+
+        PARAMETERS
+        ----------
+
+        targets : list
+            The list of photon energies, or of (photon_energy, polarization) tuples, polarization is 'LH'
+            (default), 'LV', 'CL' or 'CR'.
+
+        branch : str, optional
+            The beamline branch which is to be used, can be 'A' (default) or 'B'.
+
+        gratings : list, optional
+            The gratings that can be used.
+
+        EPUs : list, optional
+            The undulators that can be used.
+
+        start : dict, optional
+            The current configuration, as move_to keywords (photon_energy, grating, EPU and LP), used to
+            include the cost of the first move.
+
+        c : str, optional
+            Passed to Eph.energy_table.
+
+        max_permutations : int, optional
+            The maximum number of configuration orders to try for each set of configurations.
+
+        moves : list, output
+            The list of move_to keyword dictionaries (photon_energy, grating, branch, EPU, LP and c), in the
+            order in which they should be executed.
+
+        '''
+        import itertools
+
+        targets=[(float(target), 'LH') if np.ndim(target) == 0 else (float(target[0]), target[1])
+                 for target in targets]
+        if not targets:
+            return []
+
+        gap_tables={'LH' : ('Und_Energy', ''), 'LV' : ('Und_Energy_LV', ''),
+                    'CL' : ('Und_Energy_Cgap', '_theory'), 'CR' : ('Und_Energy_Cgap', '_theory')}
+
+        # determine the rows for each feasible (target, configuration) combination.
+        configs=[(grating, EPU) for grating in gratings for EPU in EPUs]
+        rows={}
+        for config in configs:
+            grating, EPU=config
+            for LP in {LP for _, LP in targets}:
+                table, suffix=gap_tables[LP]
+                gap_table=getattr(self, table).get('EPU'+EPU+suffix)
+                if gap_table is None:
+                    continue
+                energies=[energy for energy, target_LP in targets if target_LP == LP and
+                          self.Range[grating][0] <= energy <= self.Range[grating][1] and
+                          self.Range['EPU'+EPU][0] <= energy <= self.Range['EPU'+EPU][1] and
+                          np.min(gap_table['Energy']) <= energy <= np.max(gap_table['Energy'])]
+                if energies:
+                    energy_table=self.energy_table(energies, grating=grating, branch=branch, EPU=EPU, LP=LP, c=c)
+                    for _, row in energy_table.iterrows():
+                        rows[(row['Energy'], LP, config)]=row
+
+        unreachable=[target for target in targets if not any(target+(config,) in rows for config in configs)]
+        if unreachable:
+            raise RuntimeError('photon energies {} can not be reached with gratings {} and EPUs {},'.format(
+                               unreachable, list(gratings), list(EPUs))+
+                               'use Eph.Range to determine the correct grating and EPU')
+
+        start_row=None
+        if start is not None:
+            start_row=self.energy_table(start['photon_energy'], grating=start.get('grating', '800'),
+                                        branch=branch, EPU=start.get('EPU', '57'), LP=start.get('LP', 'LH'),
+                                        c=c).iloc[0]
+
+        def group_rows(config, group_targets, previous):
+            # order the targets for one configuration, by polarization then alternating energy sweeps.
+            ordered=[]
+            for LP in sorted({LP for _, LP in group_targets}):
+                energies=sorted(energy for energy, target_LP in group_targets if target_LP == LP)
+                last=ordered[-1] if ordered else previous
+                if last is not None and abs(last['Energy']-energies[-1]) < abs(last['Energy']-energies[0]):
+                    energies.reverse()
+                ordered+=[rows[(energy, LP, config)] for energy in energies]
+            return ordered
+
+        def sequence_time(sequence, previous):
+            total=0.
+            for row in sequence:
+                total+=self.estimate_move_time(previous, row)
+                previous=row
+            return total
+
+        def assign(subset):
+            # assign each target to one configuration in the subset.
+            groups={config : [] for config in subset}
+            ambiguous=[]
+            for target in targets:
+                options=[config for config in subset if target+(config,) in rows]
+                if not options:
+                    return None
+                if len(options) == 1:
+                    groups[options[0]].append(target)
+                else:
+                    ambiguous.append((target, options))
+            for target, options in ambiguous:
+                # the configuration whose energy span increases the least.
+                def span_increase(config):
+                    energies=[energy for energy, _ in groups[config]]
+                    if not energies:
+                        return float('inf')
+                    return max(0., min(energies)-target[0], target[0]-max(energies))
+                groups[min(options, key=span_increase)].append(target)
+            if any(not group for group in groups.values()):
+                return None
+            return groups
+
+        def best_order(groups):
+            # try every order of the configurations, or build the order greedily.
+            config_list=list(groups)
+            best=(float('inf'), None)
+            if math.factorial(len(config_list)) <= max_permutations:
+                orders=itertools.permutations(config_list)
+            else:
+                order=[]
+                previous=start_row
+                remaining=list(config_list)
+                while remaining:
+                    config=min(remaining, key=lambda config: sequence_time(
+                               group_rows(config, groups[config], previous)[:1], previous))
+                    order.append(config)
+                    remaining.remove(config)
+                    previous=group_rows(config, groups[config], previous)[-1]
+                orders=[order]
+            for order in orders:
+                sequence=[]
+                previous=start_row
+                for config in order:
+                    sequence+=group_rows(config, groups[config], previous)
+                    previous=sequence[-1]
+                total=sequence_time(sequence, start_row)
+                if total < best[0]:
+                    best=(total, sequence)
+            return best
+
+        # enumerate the covering subsets of configurations, smallest first.
+        used_configs=[config for config in configs if any(key[2] == config for key in rows)]
+        best=(float('inf'), None)
+        for size in range(1, len(used_configs)+1):
+            for subset in itertools.combinations(used_configs, size):
+                groups=assign(subset)
+                if groups is not None:
+                    best=min(best, best_order(groups), key=lambda result: result[0])
+
+        return [{'photon_energy' : float(row['Energy']), 'grating' : row['grating'], 'branch' : branch,
+                 'EPU' : row['EPU'], 'LP' : row['LP'], 'c' : c} for row in best[1]]
 
 
     def pgm_cal(self, grating_density_mm=300, e_real_eV = np.array([100]*5),\
@@ -663,7 +1225,7 @@ class ESM_monochromator_device:
             The beamline branch which is to be used, can be 'A' (default) or 'B'.
 
         update_offsets: boolean
-	    To write in the files of the offsets. Still not implemented 
+	    To write in the files of the offsets. Still not implemented, see pgm_cal_batch 
 
         '''
 
@@ -783,34 +1345,128 @@ class ESM_monochromator_device:
         plt.text(l+0.05*(r-l),b+0.5*(t-b),' GRT_density = ' + str(f_grating_density_mm(x[2])) +'\n\n Moff(deg)=' + str(x[0]) + '\n\n Goff(deg)=' + str(x[1]),\
                  fontsize = 10, fontweight ='bold')
 #        print(x)
-        import csv
-        with open('/home2/xf21id1/.ipython/profile_collection/startup/motion_definition_files/M2_Offset_{}.csv'.format(branch)) as f:
-            csv.reader0 = csv.reader(f)
-            for ln, row in enumerate(csv.reader0):
-                if ln == 0:
-                   indx = row.index(str(grating_density_mm))
-                if ln ==  1:
-                   grt_off = float(row[indx])
-                   print('current M2 offset: {:.6f}'.format(grt_off))
-                   print('M2 correction: {:.6f}'.format(x[0]))
-                   print('updated M2 offset: {:.6f}'.format(grt_off - x[0]))
-
-        with open('/home2/xf21id1/.ipython/profile_collection/startup/motion_definition_files/Grt_Offset_{}.csv'.format(branch)) as f1:
-            csv.reader1 = csv.reader(f1)
-            for ln, row in enumerate(csv.reader1):
-                if ln == 0:
-                   indx = row.index(str(grating_density_mm))
-                if ln ==  1:
-                   grt_off = float(row[indx])
-                   print('current grating offset: {:.6f}'.format(grt_off))
-                   print('grating correction: {:.6f}'.format(x[1]))
-                   print('updated grating offset: {:.6f}'.format(grt_off - x[1]))
+        grt_off = self.M2_Offset[branch][str(grating_density_mm)]
+        print('current M2 offset: {:.6f}'.format(grt_off))
+        print('M2 correction: {:.6f}'.format(x[0]))
+        print('updated M2 offset: {:.6f}'.format(grt_off - x[0]))
+
+        grt_off = self.Grt_Offset[branch][str(grating_density_mm)]
+        print('current grating offset: {:.6f}'.format(grt_off))
+        print('grating correction: {:.6f}'.format(x[1]))
+        print('updated grating offset: {:.6f}'.format(grt_off - x[1]))
         return
 
 
+    def _pgm_cal_angles(self, grating, e_display, cff):
+        '''
+        Returns the PGM mirror and grating angles (in deg) used for the measured energies, using the same
+        grating equations as pgm_cal.
+        '''
+        x = float(grating)*0.001239852/np.asarray(e_display, dtype=float)
+        y = np.asarray(cff, dtype=float)
+        alpha = np.arcsin((x-np.sqrt(x**2-(x**2+y**2-1)*(1-y**2)))/(1-y**2))
+        beta = np.arcsin((x*y**2-np.sqrt(x**2*y**4-(y**2-1)*(y**2*x**2+1-y**2)))/(y**2-1))
+
+        return 90*(np.pi-alpha+beta)/np.pi, (np.pi/2+beta)*180.0/np.pi
+
+
+    def _pgm_cal_fit(self, grating, mirror_deg, grating_deg, e_real):
+        '''
+        Fits the M2 and grating offset corrections (in deg) for one grating, see pgm_cal_batch.
+        '''
+        from scipy.optimize import least_squares
+
+        K = 1239.852*float(grating)/10**6
+        deg = np.pi/180.0
+
+        def angles(x):
+            alpha = np.pi/2+deg*((grating_deg-x[1])-2*(mirror_deg-x[0]))
+            beta = deg*(grating_deg-x[1])-np.pi/2
+            return alpha, beta
+
+        def residuals(x):
+            alpha, beta = angles(x)
+            return K/(np.sin(alpha)+np.sin(beta)) - e_real
+
+        def jacobian(x):
+            alpha, beta = angles(x)
+            scale = K/(np.sin(alpha)+np.sin(beta))**2
+            return np.column_stack((-scale*np.cos(alpha)*2*deg, scale*(np.cos(alpha)+np.cos(beta))*deg))
+
+        result = least_squares(residuals, np.zeros(2), jac=jacobian, method='lm')
+        if not result.success:
+            raise RuntimeError('PGM offset fit failed for the '+str(grating)+' grating: '+result.message)
+
+        return result.x, residuals(np.zeros(2)), result.fun
+
+
+    def pgm_cal_batch(self, measurements, update_offsets=False, max_workers=None):
+        '''
+        Calculates the PGM offset corrections for every grating and branch in a set of measurements.
+
+        This is the batch version of pgm_cal, the measured photon energies for each grating and branch are
+        fitted independently (in parallel) to give the M2 and grating offset corrections to be SUBTRACTED
+        from the current offsets. If update_offsets is True the new offsets are written to the offset
+        tables as a new version in the calibration store (see ESM_calibration.update) and the calibration
+        is reloaded.
+
+        PARAMETERS
+        ----------
 
+        measurements : pandas.DataFrame or dict
+            The measurements, with one row per measurement and the columns 'grating' (eg. '800'), 'branch'
+            ('A' or 'B'), 'e_real' (the ideal target photon energy), 'e_display' (the measured photon energy)
+            and 'cff' (the cff value used for the measurement).
 
+        update_offsets : boolean, optional
+            If True the new offsets are written to the calibration tables.
 
+        max_workers : int, optional
+            The maximum number of fits to run in parallel, the default (None) uses one per grating and branch.
+
+        results : pandas.DataFrame, output
+            The current offsets, the corrections, the updated offsets and the rms energy error (in eV) before
+            and after the correction for each grating and branch.
+
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+
+        measurements = pd.DataFrame(measurements)
+        missing = {'grating', 'branch', 'e_real', 'e_display', 'cff'} - set(measurements.columns)
+        if missing:
+            raise RuntimeError('measurements are missing the columns '+str(sorted(missing)))
+        measurements = measurements.astype({'grating' : str, 'branch' : str})
+
+        groups = []
+        for (grating, branch), group in measurements.groupby(['grating', 'branch'], sort=True):
+            if branch not in self.M2_Offset or grating not in self.M2_Offset[branch]:
+                raise RuntimeError('no offsets found for the '+grating+' grating on branch '+branch)
+            if len(group) < 2:
+                raise RuntimeError('at least 2 measurements are required to fit the '+grating+
+                                   ' grating on branch '+branch)
+            mirror_deg, grating_deg = self._pgm_cal_angles(grating, group['e_display'], group['cff'])
+            groups.append((grating, branch, mirror_deg, grating_deg, group['e_real'].to_numpy(dtype=float)))
+
+        with ThreadPoolExecutor(max_workers=max_workers or max(len(groups), 1)) as executor:
+            fits = list(executor.map(lambda group: self._pgm_cal_fit(group[0], *group[2:]), groups))
+
+        results = []
+        for (grating, branch, mirror_deg, _, _), (x, before, after) in zip(groups, fits):
+            results.append({'grating' : grating, 'branch' : branch, 'points' : len(mirror_deg),
+                            'M2_Offset' : self.M2_Offset[branch][grating], 'M2_correction' : x[0],
+                            'M2_Offset_new' : self.M2_Offset[branch][grating]-x[0],
+                            'Grt_Offset' : self.Grt_Offset[branch][grating], 'Grt_correction' : x[1],
+                            'Grt_Offset_new' : self.Grt_Offset[branch][grating]-x[1],
+                            'rms_before' : np.sqrt(np.mean(before**2)), 'rms_after' : np.sqrt(np.mean(after**2))})
+        results = pd.DataFrame(results)
+
+        if update_offsets:
+            for branch, rows in results.groupby('branch'):
+                ESM_calibration.update('M2_Offset_'+branch, dict(zip(rows['grating'], rows['M2_Offset_new'])))
+                ESM_calibration.update('Grt_Offset_'+branch, dict(zip(rows['grating'], rows['Grt_Offset_new'])))
+            self.set_dicts
+
+        return results
 
 
 ## Define the instances of the ESM_device class
@@ -818,9 +1474,324 @@ class ESM_monochromator_device:
 #The monochromator definition.
 Eph=ESM_monochromator_device('Eph')
 
-def scan_energy(detectors, energies, grating='800', branch='A', EPU='57', LP='LH', c='constant', shutter='close'):
-    for energy in energies:
-        yield from Eph.move_to(energy, grating=grating, branch=branch, EPU=EPU, LP=LP, c=c, shutter=shutter)
+def scan_energy(detectors, energies, grating='800', branch='A', EPU='57', LP='LH', c='constant', shutter='close',
+                concurrent=False, single_run=False, md=None):
+    # record all of the energies as events in one run, see scan_energy_series.
+    if single_run:
+        return (yield from scan_energy_series(detectors, energies, grating=grating, branch=branch, EPU=EPU, LP=LP,
+                                              c=c, shutter=shutter, concurrent=concurrent, md=md))
+
+    # calculate, and range check, all of the energies before the first move.
+    table = Eph.energy_table(energies, grating=grating, branch=branch, EPU=EPU, LP=LP, c=c)
+    for _, point in table.iterrows():
+        yield from Eph.move_to_point(point, shutter=shutter, concurrent=concurrent)
         yield from count(detectors)
 
 
+# The photon energy axis recorded by scan_energy_series, it is moved by the scan after Eph.move_to_point has
+# set the monochromator and undulator.
+Eph_energy = SoftPositioner(name='Eph_energy', egu='eV', init_pos=0)
+
+
+def scan_energy_series(detectors, energies, grating='800', branch='A', EPU='57', LP='LH', c='constant',
+                       shutter='close', concurrent=False, devices=None, md=None):
+    '''
+    Records a photon energy series as a single run, with one event per photon energy.
+
+    The energies are calculated (and range checked) using Eph.energy_table before the run starts, at each
+    step the monochromator and undulator are moved using Eph.move_to_point, then the photon energy axis
+    'Eph_energy' and the detectors are read into the 'primary' stream. This gives one start/stop document
+    and one baseline reading for the series, compared to one run per energy for scan_energy.
+
+    PARAMETERS
+    ----------
+
+    detectors : list
+        The list of detectors to read at each photon energy.
+
+    energies : list or array
+        The photon energies in eV.
+
+    grating, branch, EPU, LP, c : str, optional
+        The values passed to Eph.energy_table.
+
+    shutter : str, optional
+        Passed to Eph.move_to_point.
+
+    concurrent : bool, optional
+        If True the undulator moves run alongside the M2 and grating pitch steps, see Eph.move_to_point.
+
+    devices : dict, optional
+        The devices to move, see Eph.move_to_point, used to run the scan on simulated devices.
+
+    md : dict, optional
+        Additional metadata for the run.
+
+    uid : str, output
+        The unique id of the run.
+
+    '''
+    table = Eph.energy_table(energies, grating=grating, branch=branch, EPU=EPU, LP=LP, c=c)
+    points = iter([point for _, point in table.iterrows()])
+
+    #This section determines the Y axis and X axis variable names to plot for the scan.
+    Y_axis = []
+    for detector in detectors:   Y_axis += detector.hints.get('fields', [])
+    X_axis = Eph_energy.hints['fields']
+
+    #setup standard metadata
+    _md = {'scan_name':'scan_energy_series','plot_Xaxis':X_axis,'plot_Yaxis':Y_axis,
+           'grating':grating,'branch':branch,'EPU':EPU,'LP':LP}
+    _md.update(md or {})
+
+    def per_step(detectors, step, pos_cache):
+        # move the monochromator and undulator, then record the energy and the detectors.
+        point = next(points)
+        yield from Eph.move_to_point(point, shutter=shutter, concurrent=concurrent, devices=devices)
+        yield from one_nd_step(detectors, step, pos_cache)
+
+    return (yield from list_scan(detectors, Eph_energy, list(table['Energy']), per_step=per_step, md=_md))
+
+
+def benchmark_Eph_interpolators(num=10000, EPU='57'):
+    '''
+    Compares the time taken to calculate the undulator gap using the original (interp1d built on each call)
+    method and the compiled interpolators, both per value and for a vectorized array of values.
+
+    PARAMETERS
+    ----------
+
+    num : int, optional
+        The number of photon energy values to calculate the gap for.
+
+    EPU : str, optional
+        The undulator to use, can be '57' (default, high energy) or '105'(low energy).
+
+    results : dict, output
+        The total time (in s) for each method and the maximum difference between the gap values.
+
+    '''
+    import time
+
+    table=Eph.Und_Energy['EPU'+EPU]
+    energies=np.linspace(min(table['Energy']), max(table['Energy']), num)
+
+    #the original method, an interp1d object built for each value.
+    start=time.perf_counter()
+    legacy=[float(interp1d(table['Energy'], table['Gap'])(energy)) for energy in energies]
+    legacy_time=time.perf_counter()-start
+
+    #the compiled interpolator, one call per value.
+    start=time.perf_counter()
+    compiled=[Eph.Und_e2g(energy, EPU=EPU) for energy in energies]
+    compiled_time=time.perf_counter()-start
+
+    #the compiled interpolator, one call for the array of values.
+    start=time.perf_counter()
+    vectorized=Eph.Und_e2g(energies, EPU=EPU)
+    vectorized_time=time.perf_counter()-start
+
+    results={'legacy': legacy_time, 'compiled': compiled_time, 'vectorized': vectorized_time,
+             'max_difference': float(max(np.max(np.abs(np.array(legacy)-np.array(compiled))),
+                                         np.max(np.abs(np.array(legacy)-vectorized))))}
+
+    print ('Und_e2g for {} energies on EPU{}:'.format(num, EPU))
+    print ('    interp1d per call  : {:.4f} s'.format(legacy_time))
+    print ('    compiled per call  : {:.4f} s ({:.1f}x)'.format(compiled_time, legacy_time/compiled_time))
+    print ('    compiled vectorized: {:.4f} s ({:.1f}x)'.format(vectorized_time, legacy_time/vectorized_time))
+    print ('    max difference     : {:.3g} mm'.format(results['max_difference']))
+
+    return results
+
+
+
+def benchmark_Eph_concurrent(energies=(250, 500, 900, 400, 1200), grating='800', branch='A', EPU='57', LP='LH',
+                             time_scale=0.02, **kwargs):
+    '''
+    Compares the time taken to change the photon energy with sequential and concurrent PGM/EPU motion.
+
+    The moves are run on simulated devices (see ESM_sim_devices) with a separate RunEngine, so no beamline
+    hardware is moved.
+
+    PARAMETERS
+    ----------
+
+    energies : list, optional
+        The photon energies to move to, one after the other.
+
+    grating, branch, EPU, LP : str, optional
+        The values passed to Eph.energy_table.
+
+    time_scale : float, optional
+        The factor used to multiply all of the simulated move times.
+
+    **kwargs : dict, optional
+        Passed to ESM_sim_devices, eg. the velocities of the simulated axes.
+
+    results : dict, output
+        The total time (in s) of the moves for each mode.
+
+    '''
+    import time
+    from bluesky import RunEngine
+
+    table = Eph.energy_table(energies, grating=grating, branch=branch, EPU=EPU, LP=LP)
+    sim_RE = RunEngine({})
+
+    results={}
+    for concurrent in (False, True):
+        sim_devices = ESM_sim_devices(time_scale=time_scale, **kwargs)
+        devices = {'PGM' : sim_devices['PGM'], 'M3' : sim_devices['M3']}
+        if EPU is not None:
+            devices['EPU'] = sim_devices['EPU'+EPU]
+
+        def plan():
+            for _, point in table.iterrows():
+                yield from Eph.move_to_point(point, concurrent=concurrent, devices=devices)
+
+        start=time.perf_counter()
+        sim_RE(plan())
+        results['concurrent' if concurrent else 'sequential']=time.perf_counter()-start
+
+    print ('Eph.move_to_point for {} energies (time_scale={}):'.format(len(table), time_scale))
+    print ('    sequential : {:.2f} s'.format(results['sequential']))
+    print ('    concurrent : {:.2f} s ({:.0f}% reduction)'.format(results['concurrent'],
+                                                              100*(1-results['concurrent']/results['sequential'])))
+
+    return results
+
+
+
+def benchmark_scan_energy_series(num=100, num_baseline=12):
+    '''
+    Compares the time per photon energy for scan_energy (one run per energy) and scan_energy_series (one run).
+
+    The scans are run on instantly moving simulated devices (see ESM_sim_devices) with a separate RunEngine
+    that reads 'num_baseline' simulated devices as a baseline, so that only the per point run overhead is
+    compared.
+
+    PARAMETERS
+    ----------
+
+    num : int, optional
+        The number of photon energies in the series.
+
+    num_baseline : int, optional
+        The number of simulated baseline devices.
+
+    results : dict, output
+        The time per point (in s) and the number of documents for each plan.
+
+    '''
+    import time
+    from bluesky import RunEngine, SupplementalData
+    from ophyd.sim import SynAxis, det
+
+    sim_devices = ESM_sim_devices(time_scale=0)
+    devices = {'PGM' : sim_devices['PGM'], 'M3' : sim_devices['M3'], 'EPU' : sim_devices['EPU57']}
+    energies = np.linspace(400, 500, num)
+
+    sim_RE = RunEngine({})
+    sim_sd = SupplementalData(baseline=[SynAxis(name='baseline'+str(i)) for i in range(num_baseline)])
+    sim_RE.preprocessors.append(sim_sd)
+    documents = []
+    sim_RE.subscribe(lambda name, doc: documents.append(name))
+
+    def per_energy():
+        # equivalent to scan_energy, one run per photon energy.
+        table = Eph.energy_table(energies)
+        for _, point in table.iterrows():
+            yield from Eph.move_to_point(point, devices=devices)
+            yield from count([det])
+
+    results = {}
+    for name, plan in (('scan_energy', per_energy),
+                       ('scan_energy_series', lambda: scan_energy_series([det], energies, devices=devices))):
+        documents.clear()
+        start = time.perf_counter()
+        sim_RE(plan())
+        results[name] = {'time_per_point' : (time.perf_counter()-start)/num, 'documents' : len(documents)}
+
+    print ('{} photon energies with {} baseline devices:'.format(num, num_baseline))
+    for name, result in results.items():
+        print ('    {:20s}: {:.2f} ms per point, {} documents'.format(name, 1000*result['time_per_point'],
+                                                                      result['documents']))
+
+    return results
+
+
+def benchmark_pgm_cal_batch(points=5, num=5, seed=0):
+    '''
+    Compares the time taken to fit the PGM offsets for every grating and branch one at a time (using the
+    per point fitting function and numerical jacobian of pgm_cal) and with Eph.pgm_cal_batch.
+
+    The measurements are simulated from random offset errors, the fitted corrections are checked against
+    them. The offset tables are not updated.
+
+    PARAMETERS
+    ----------
+
+    points : int, optional
+        The number of cff values measured for each grating and branch.
+
+    num : int, optional
+        The number of times to repeat each fit.
+
+    seed : int, optional
+        The seed for the random offset errors.
+
+    results : dict, output
+        The average time (in s) for each method and the largest error in the fitted corrections (in deg).
+
+    '''
+    import time
+    from scipy.optimize import least_squares
+
+    rng = np.random.default_rng(seed)
+    rows = []
+    errors = {}
+    for branch in ('A', 'B'):
+        for grating in ('300', '600', '800', '1200'):
+            x = rng.normal(scale=0.002, size=2)
+            errors[(grating, branch)] = x
+            e_display = np.full(points, np.mean(Eph.Range[grating]))
+            cff = np.linspace(1.8, 2.4, points)
+            mirror_deg, grating_deg = Eph._pgm_cal_angles(grating, e_display, cff)
+            alpha = np.pi/2+np.pi/180.0*((grating_deg-x[1])-2*(mirror_deg-x[0]))
+            beta = np.pi/180.0*(grating_deg-x[1])-np.pi/2
+            e_real = 1239.852/(10**6/float(grating)*(np.sin(alpha)+np.sin(beta)))
+            for i in range(points):
+                rows.append({'grating' : grating, 'branch' : branch, 'e_real' : e_real[i],
+                             'e_display' : e_display[i], 'cff' : cff[i]})
+    measurements = pd.DataFrame(rows)
+
+    def loop_fit():
+        for (grating, branch), group in measurements.groupby(['grating', 'branch']):
+            mirror_deg, grating_deg = Eph._pgm_cal_angles(grating, group['e_display'], group['cff'])
+            e_real = group['e_real'].to_numpy()
+            def F(x):
+                return np.array([1239.852/(10**6/float(grating)*(np.sin(np.pi/2+np.pi/180.0*((j-x[1])-2*(i-x[0])))+
+                                                                  np.sin((j-x[1])/180.0*np.pi-np.pi/2)))
+                                 for (i, j) in zip(mirror_deg, grating_deg)]) - e_real
+            least_squares(F, [0, 0, 0])
+
+    start = time.perf_counter()
+    for i in range(num):
+        loop_fit()
+    loop_time = (time.perf_counter()-start)/num
+
+    start = time.perf_counter()
+    for i in range(num):
+        results = Eph.pgm_cal_batch(measurements)
+    batch_time = (time.perf_counter()-start)/num
+
+    max_error = max(max(abs(row['M2_correction']-errors[(row['grating'], row['branch'])][0]),
+                        abs(row['Grt_correction']-errors[(row['grating'], row['branch'])][1]))
+                    for _, row in results.iterrows())
+
+    print ('fitting the offsets of {} gratings/branches ({} points each):'.format(len(errors), points))
+    print ('    one at a time : {:.4f} s'.format(loop_time))
+    print ('    pgm_cal_batch : {:.4f} s ({:.1f}x)'.format(batch_time, loop_time/batch_time))
+    print ('    largest correction error : {:.2e} deg'.format(max_error))
+
+    return {'loop' : loop_time, 'batch' : batch_time, 'max_error' : max_error}
@@ -0,0 +1,173 @@
+import time
+from collections import OrderedDict
+from ophyd import Device
+
+
+###BASELINE CACHE
+###   The following set of code is used to serve the baseline readings (sd.baseline) from a cache that is
+###   kept up to date by CA monitors, instead of reading every axis of the baseline devices over CA at the
+###   start and end of each run. Only the values whose monitors are disconnected (or stale) are read.
+
+
+class ESM_cached_device:
+    def __init__(self, device, max_age=None):
+        '''
+        A read only wrapper around a device, with the readings served from a cache of monitored values.
+
+        Every signal included in the device reading or configuration is subscribed to once, the cached
+        value is updated by each monitor callback. When a reading is requested the cached values are used,
+        except for the signals that are disconnected, have not received a value, or (if max_age is given)
+        whose cached value was received more than max_age seconds ago, these signals are read directly.
+
+        PARAMETERS
+        ----------
+
+        device : Device
+            The device to wrap, eg. M1.
+
+        max_age : float, optional
+            The maximum time (in s) since the last monitor callback for a cached value to be used, the
+            default (None) uses the cached value as long as the signal is connected.
+
+        '''
+        self.device=device
+        self.name=device.name
+        self.parent=None
+        self.max_age=max_age
+
+        # the signals (by data key) included in the reading and the configuration of the device.
+        self.read_signals=self._signals(device.read_attrs)
+        self.config_signals=self._signals(device.configuration_attrs)
+
+        self.cache={}
+        self._describe=None
+        self._describe_configuration=None
+        self.subscriptions=[]
+        for key, signal in list(self.read_signals.items())+list(self.config_signals.items()):
+            if key not in self.cache:
+                self.cache[key]=None
+                self.subscriptions.append((signal, signal.subscribe(self._update(key), run=True)))
+
+
+    def _signals(self, attrs):
+        '''
+        Returns the signals (by data key) for a list of attributes of the device, sub-devices are skipped
+        as their signals are included in the list.
+        '''
+        signals=OrderedDict()
+        for attr in attrs:
+            signal=getattr(self.device, attr)
+            if not isinstance(signal, Device):
+                signals[signal.name]=signal
+        return signals
+
+
+    def _update(self, key):
+        '''
+        Returns the monitor callback that updates the cached value of a data key.
+        '''
+        def callback(value, timestamp=None, **kwargs):
+            if timestamp is None:
+                timestamp=time.time()
+            self.cache[key]=({'value' : value, 'timestamp' : timestamp}, time.time())
+        return callback
+
+
+    def stale(self, keys=None):
+        '''
+        Returns the data keys whose cached value can not be used, see the class description.
+
+        PARAMETERS
+        ----------
+
+        keys : list, optional
+            The data keys to check, the default (None) checks all of the cached keys.
+
+        stale : list, output
+            The list of data keys that need to be read directly.
+
+        '''
+        now=time.time()
+        stale=[]
+        for key in (self.cache if keys is None else keys):
+            entry=self.cache.get(key)
+            signal=self.read_signals.get(key, self.config_signals.get(key))
+            if entry is None or not signal.connected:
+                stale.append(key)
+            elif self.max_age is not None and now-entry[1] > self.max_age:
+                stale.append(key)
+        return stale
+
+
+    def _read(self, signals):
+        '''
+        Returns the reading of a set of signals, from the cache where possible.
+        '''
+        stale=set(self.stale(signals.keys()))
+        reading=OrderedDict()
+        for key, signal in signals.items():
+            if key in stale:
+                self.cache[key]=(signal.read()[key], time.time())
+            reading[key]=self.cache[key][0]
+        return reading
+
+
+    def read(self):
+        return self._read(self.read_signals)
+
+
+    def read_configuration(self):
+        return self._read(self.config_signals)
+
+
+    def describe(self):
+        if self._describe is None:
+            self._describe=self.device.describe()
+        return self._describe
+
+
+    def describe_configuration(self):
+        if self._describe_configuration is None:
+            self._describe_configuration=self.device.describe_configuration()
+        return self._describe_configuration
+
+
+    @property
+    def hints(self):
+        return self.device.hints
+
+
+    def clear(self):
+        '''
+        Removes the monitor subscriptions.
+        '''
+        for signal, cid in self.subscriptions:
+            signal.unsubscribe(cid)
+        self.subscriptions.clear()
+
+
+    def __repr__(self):
+        return 'ESM_cached_device('+repr(self.device)+')'
+
+
+def ESM_cached_baseline(devices, max_age=None):
+    '''
+    Returns a list of cached wrappers for a list of baseline devices, see ESM_cached_device.
+
+    Devices that are already wrapped are not wrapped again.
+
+    PARAMETERS
+    ----------
+
+    devices : list
+        The baseline devices, eg. [M1, PGM, M3].
+
+    max_age : float, optional
+        The maximum time (in s) since the last monitor callback for a cached value to be used.
+
+    baseline : list, output
+        The list of cached devices, to be used as sd.baseline.
+
+    '''
+    return [device if isinstance(device, ESM_cached_device) else ESM_cached_device(device, max_age=max_age)
+            for device in devices]
@@ -20,7 +20,10 @@ This section is used to define a few settings values that are used for all scans
 
 #sd.baseline = [BeamSource, EPU105, FEslit, M1, PGM, M3, ExitSlitA, ExitSlitB, M4A, M4B, LT, SP]
 #sd.baseline = [BeamSource,EPU57, EPU105, FEslit, M1, PGM, M3, ExitSlitA, ExitSlitB, M4A, M4B, LT, SP]
-sd.baseline = [BeamSource,EPU57, EPU105, FEslit, M1, PGM, M3, ExitSlitA, ExitSlitB, M4A, M4B, LT]
+#The baseline devices are read from a cache kept up to date by CA monitors (see 79-ESM_baseline.py), only
+#the values whose monitors are disconnected are read over CA at the start and end of each scan.
+sd.baseline = ESM_cached_baseline([BeamSource,EPU57, EPU105, FEslit, M1, PGM, M3, ExitSlitA, ExitSlitB, M4A,
+                                   M4B, LT])
 
 #This line command defines the list of motor axes that are to be displayed when using the magics
 # command %wa.